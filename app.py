@@ -1,21 +1,50 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, g
+from flask import Response, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import case, func
 from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import text
+from sqlalchemy import event
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import object_session as sa_object_session
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from werkzeug.utils import safe_join
+from bisect import bisect_left
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+import base64
+import gzip
 import hashlib
+import hmac
+import json
 import math
+import mimetypes
 import os
+import queue
 import re
+import shutil
+import struct
+import threading
 import time
+import unicodedata
+
+try:
+    import numpy as np  # ma trận ETA nhiều chuyến tính bằng vector (có trong requirements.txt)
+except ImportError:
+    # Chỉ để môi trường tối giản vẫn chạy: ETA lùi về Python thuần (cùng kết quả, chậm hơn nhiều với tuyến dài)
+    np = None
+    print("numpy warning: chưa cài numpy -> ma trận ETA dùng Python thuần (pip install -r requirements.txt)")
 
 app = Flask(__name__)
 
-# Cấu hình Flask & database (ưu tiên env để dễ deploy)
+# Cấu hình Flask & database (ưu tiên env để dễ deploy).
+# Chỉ cấu hình, không chạm DB (không create_all/ALTER/query) -> worker gunicorn và script khởi động nhanh.
+# Tạo/nâng cấp schema chạy riêng 1 lần: `flask --app app bootstrap`.
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
 db_url = os.getenv("DATABASE_URL") or os.getenv("SQLALCHEMY_DATABASE_URI")
@@ -28,17 +57,49 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "08082004258046121011")
 
 db = SQLAlchemy(app)
+
 OSRM_BASE_URL = os.getenv("OSRM_BASE_URL", "https://router.project-osrm.org").rstrip("/")
 OSRM_PROFILE = os.getenv("OSRM_PROFILE", "driving")  # driving/foot/bike tùy server
 OSRM_TIMEOUT = float(os.getenv("OSRM_TIMEOUT", "8"))
 OSRM_MAX_COORDS = int(os.getenv("OSRM_MAX_COORDS", "70"))  # tránh gửi quá nhiều điểm
+OSRM_CONNECT_TIMEOUT = float(os.getenv("OSRM_CONNECT_TIMEOUT", "3"))  # timeout bắt tay TCP/TLS (OSRM_TIMEOUT là timeout đọc)
+OSRM_POOL_SIZE = int(os.getenv("OSRM_POOL_SIZE", "10"))  # số kết nối keep-alive giữ sẵn mỗi worker
+OSRM_RETRIES = int(os.getenv("OSRM_RETRIES", "2"))  # số lần thử lại (backoff + jitter), worker nền
+OSRM_REQUEST_DEADLINE_SEC = float(os.getenv("OSRM_REQUEST_DEADLINE_SEC", "10"))  # tổng thời gian tối đa khi gọi OSRM trong request
+OSRM_MAX_CHUNKS = int(os.getenv("OSRM_MAX_CHUNKS", "8"))  # tuyến dài: tối đa N cửa sổ OSRM_MAX_COORDS điểm
+OSRM_CHUNK_WORKERS = int(os.getenv("OSRM_CHUNK_WORKERS", "4"))  # số luồng gọi song song các cửa sổ (1 pool/worker)
 BUS_TRIP_CAPACITY = int(os.getenv("BUS_TRIP_CAPACITY", "80"))  # bus đô thị: không theo ghế
-BUS_SCHEDULE_HORIZON_MIN = int(os.getenv("BUS_SCHEDULE_HORIZON_MIN", "360"))  # auto-generate N phút sắp tới
+BUS_SCHEDULE_HORIZON_MIN = int(os.getenv("BUS_SCHEDULE_HORIZON_MIN", "360"))  # hiển thị chuyến trong N phút sắp tới
 BUS_OSRM_DURATION_FACTOR = float(os.getenv("BUS_OSRM_DURATION_FACTOR", "1.25"))  # bus chậm hơn xe hơi (OSRM driving)
 BUS_STOP_DWELL_SEC = int(os.getenv("BUS_STOP_DWELL_SEC", "15"))  # dừng đón/trả khách mỗi trạm (ước tính)
 BUS_FALLBACK_SPEED_KMH = float(os.getenv("BUS_FALLBACK_SPEED_KMH", "22"))  # fallback nếu OSRM fail
-STOP_OFFSET_CACHE_TTL_SEC = int(os.getenv("STOP_OFFSET_CACHE_TTL_SEC", "900"))
-_STOP_OFFSET_CACHE = {}
+STOP_OFFSET_CACHE_TTL_SEC = int(os.getenv("STOP_OFFSET_CACHE_TTL_SEC", "900"))  # khoảng cách tối thiểu giữa 2 lần thử OSRM/tuyến
+OSRM_BACKGROUND_OFFSETS = os.getenv("OSRM_BACKGROUND_OFFSETS", "1").strip() == "1"  # worker nền tính offset bằng OSRM
+OSRM_BREAKER_FAILURES = int(os.getenv("OSRM_BREAKER_FAILURES", "3"))  # lỗi liên tiếp trước khi ngắt mạch
+OSRM_BREAKER_COOLDOWN_SEC = float(os.getenv("OSRM_BREAKER_COOLDOWN_SEC", "120"))  # thời gian ngắt mạch
+STATIC_MTIME_TTL_SEC = float(os.getenv("STATIC_MTIME_TTL_SEC", "5"))  # chưa build-assets: stat lại file static sau N giây (?v=mtime)
+ROUTE_REVISION_TTL_SEC = float(os.getenv("ROUTE_REVISION_TTL_SEC", "2"))  # làm mới revision tuyến (đồng bộ giữa các worker)
+BOARD_TICK_SEC = float(os.getenv("BOARD_TICK_SEC", "10"))  # chu kỳ tính bảng giờ trạm cho SSE
+BOARD_KEEPALIVE_SEC = float(os.getenv("BOARD_KEEPALIVE_SEC", "20"))  # gửi comment keep-alive nếu không có thay đổi
+BOARD_LIMIT = int(os.getenv("BOARD_LIMIT", "8"))  # số chuyến trên bảng giờ mỗi trạm
+BOARD_MAX_STOPS = int(os.getenv("BOARD_MAX_STOPS", "20"))  # số trạm tối đa trong 1 stream
+NETWORK_SHAPE_TOLERANCE_M = float(os.getenv("NETWORK_SHAPE_TOLERANCE_M", "25"))  # sai số giản lược hình dạng tuyến (mét)
+STOP_CLUSTER_RADIUS_M = float(os.getenv("STOP_CLUSTER_RADIUS_M", "80"))  # trạm cùng tên trong N mét = 1 trạm vật lý (đường kính cụm tối đa)
+STOP_CLUSTER_SAME_SPOT_M = float(os.getenv("STOP_CLUSTER_SAME_SPOT_M", "20"))  # trạm cách nhau <= N mét luôn gom (bất kể tên)
+NEARBY_GRID_CELL_M = float(os.getenv("NEARBY_GRID_CELL_M", "250"))  # cạnh ô lưới index không gian cho /api/stops/nearby
+NEARBY_MAX_RADIUS_M = float(os.getenv("NEARBY_MAX_RADIUS_M", "3000"))  # bán kính tối đa khi tìm trạm gần
+PLANNER_WALK_SPEED_MPS = float(os.getenv("PLANNER_WALK_SPEED_MPS", "1.2"))  # tốc độ đi bộ khi lập lộ trình
+PLANNER_ACCESS_RADIUS_M = float(os.getenv("PLANNER_ACCESS_RADIUS_M", "800"))  # đi bộ từ điểm đi / tới điểm đến tối đa N mét
+PLANNER_TRANSFER_RADIUS_M = float(os.getenv("PLANNER_TRANSFER_RADIUS_M", "300"))  # đi bộ chuyển tuyến giữa trạm trong N mét
+PLANNER_MIN_TRANSFER_SEC = int(os.getenv("PLANNER_MIN_TRANSFER_SEC", "60"))  # thời gian tối thiểu để chuyển tuyến
+PLANNER_MAX_TRANSFERS = int(os.getenv("PLANNER_MAX_TRANSFERS", "3"))  # số lần chuyển tuyến tối đa
+PLANNER_TIMETABLE_TTL_SEC = float(os.getenv("PLANNER_TIMETABLE_TTL_SEC", "60"))  # đọc lại giờ xuất bến (chuyến thêm/hủy) sau N giây
+USER_CACHE_TTL_SEC = float(os.getenv("USER_CACHE_TTL_SEC", "0"))  # cache thông tin tài khoản đăng nhập (0 = tắt)
+CARD_INDEX_SYNC_SEC = float(os.getenv("CARD_INDEX_SYNC_SEC", "1"))  # đọc thay đổi thẻ từ worker khác tối đa 1 lần/N giây (0 = mỗi lần soát)
+CARD_BATCH_MAX_TAPS = int(os.getenv("CARD_BATCH_MAX_TAPS", "10000"))  # số lượt quẹt tối đa / 1 request soát thẻ hàng loạt
+VALIDATOR_API_KEY = os.getenv("VALIDATOR_API_KEY", "").strip()  # khoá cho máy soát vé trên xe (header X-Validator-Key)
+CARD_SNAPSHOT_KEY = os.getenv("CARD_SNAPSHOT_KEY", "").strip()  # khoá HMAC ký snapshot/delta thẻ (trống -> SECRET_KEY)
+_STOP_OFFSET_CACHE = {}  # (tuyen_id, huong, stops_signature) -> legs OSRM
 
 # ==================== CÁC MODEL DỮ LIỆU ====================
 
@@ -83,6 +144,7 @@ class TuyenXe(db.Model):
     ghiChu = db.Column(db.Text)                  # tùy chọn, thông tin thêm
     khoangCachKm = db.Column(db.Float)           # khoảng cách tuyến (km)
     tanSuatPhut = db.Column(db.Integer)          # tần suất (phút/chuyến)
+    phienBan = db.Column(db.Integer, default=1)  # tăng khi trạm/thông số tuyến đổi (ETag API tuyến)
 
     chuyen_xes = db.relationship("ChuyenXe", backref="tuyen", lazy=True)
     tram_dungs = db.relationship(
@@ -100,9 +162,65 @@ class ChuyenXe(db.Model):
     ngayKhoiHanh = db.Column(db.String(20))
     gioKhoiHanh = db.Column(db.String(20))
     huong = db.Column(db.String(10), default="DI")  # DI/VE (bus đô thị)
+    # Chuyến theo tần suất được tính từ lịch (không lưu). Chỉ lưu ngoại lệ:
+    # None/THUONG (chuyến thường đã lưu, vd có vé), THEM (thêm), HUY (hủy), DOI_GIO (dời giờ)
+    loaiChuyen = db.Column(db.String(20))
+    gioGoc = db.Column(db.String(20))  # DOI_GIO/HUY: giờ gốc theo lịch bị thay thế
+    # Giờ xuất bến kiểu timestamp (đồng bộ từ ngayKhoiHanh + gioKhoiHanh) để lọc/sắp xếp/LIMIT ngay trong SQL
+    departure_at = db.Column(db.DateTime)
 
     ve_xe = db.relationship("VeXe", backref="chuyen", lazy=True)
 
+    __table_args__ = (
+        db.Index("idx_trip_route_dir_departure", "tuyen_id", "huong", "departure_at"),
+    )
+
+
+def _parse_hhmm_minutes(raw):
+    m = re.match(r"^\s*(\d{1,2})\s*:\s*(\d{2})\s*$", str(raw or ""))
+    if not m:
+        return None
+    h = int(m.group(1))
+    mi = int(m.group(2))
+    if h < 0 or h > 23 or mi < 0 or mi > 59:
+        return None
+    return h * 60 + mi
+
+
+def _parse_departure_at(ngay, gio):
+    t_min = _parse_hhmm_minutes(gio)
+    if t_min is None:
+        return None
+    try:
+        day = datetime.strptime(str(ngay or "").strip(), "%Y-%m-%d")
+    except ValueError:
+        return None
+    return day + timedelta(minutes=t_min)
+
+
+def normalize_trip_slot(ngay, gio):
+    """(ngày, giờ) nhập từ form -> ("YYYY-MM-DD", "HH:MM") chuẩn (so khớp index unique & departure_at); None nếu sai."""
+    t_min = _parse_hhmm_minutes(gio)
+    if t_min is None:
+        return None
+    try:
+        day = datetime.strptime(str(ngay or "").strip(), "%Y-%m-%d")
+    except ValueError:
+        return None
+    return day.strftime("%Y-%m-%d"), f"{t_min // 60:02d}:{t_min % 60:02d}"
+
+
+def parse_local_iso(raw):
+    """Tham số `at` (ISO) -> datetime naive giờ máy chủ như lịch chạy; có offset (+07:00, Z) thì quy đổi. ValueError nếu sai dạng."""
+    dt = datetime.fromisoformat(str(raw).strip().replace("Z", "+00:00"))
+    return dt.astimezone().replace(tzinfo=None) if dt.tzinfo else dt
+
+
+@event.listens_for(ChuyenXe, "before_insert")
+@event.listens_for(ChuyenXe, "before_update")
+def _sync_trip_departure_at(mapper, connection, target):
+    target.departure_at = _parse_departure_at(target.ngayKhoiHanh, target.gioKhoiHanh)
+
 
 class HoaDon(db.Model):
     __tablename__ = "hoa_don"
@@ -145,6 +263,24 @@ class TheTu(db.Model):
     payment_method = db.Column(db.String(30))  # CASH / BANK / OTHER
     payment_ref = db.Column(db.String(120))
     proof_url = db.Column(db.Text)
+    # Phiên bản thay đổi (tăng dần toàn cục) cho snapshot/delta thẻ của máy soát vé
+    phienBan = db.Column(db.Integer, index=True)
+
+
+class TheTuDaXoa(db.Model):
+    # Bia mộ thẻ đã xóa: delta thẻ cần biết mã nào phải gỡ khỏi máy soát vé
+    __tablename__ = "the_tu_da_xoa"
+    id = db.Column(db.Integer, primary_key=True)
+    maSoThe = db.Column(db.String(50))
+    phienBan = db.Column(db.Integer, index=True)
+    thoiGianXoa = db.Column(db.String(30))
+
+
+class BoDemPhienBanThe(db.Model):
+    # 1 dòng duy nhất (id=1): nguồn phiên bản thẻ tăng dần, khoá dòng khi ghi -> không cấp trùng
+    __tablename__ = "card_version_counter"
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
 
 
 class TramDung(db.Model):
@@ -157,15 +293,43 @@ class TramDung(db.Model):
     lat = db.Column(db.Float, nullable=False)
     lng = db.Column(db.Float, nullable=False)
     huong = db.Column(db.String(10))
+    # Hướng đã chuẩn hoá (NULL/dữ liệu cũ -> DI), đồng bộ từ `huong`; index (tuyen_id, huongChuan, thuTuTrenTuyen)
+    huongChuan = db.Column(db.String(10), default="DI")
     tuyen_id = db.Column(db.Integer, db.ForeignKey("tuyen_xe.maTuyen"), nullable=False)
     tuyen = db.relationship("TuyenXe", back_populates="tram_dungs")
 
+    __table_args__ = (
+        db.Index("idx_stop_route_dir_order", "tuyen_id", "huongChuan", "thuTuTrenTuyen"),
+    )
 
-# ==================== KHỞI TẠO DB & ADMIN ====================
 
-with app.app_context():
-    db.create_all()
+@event.listens_for(TramDung, "before_insert")
+@event.listens_for(TramDung, "before_update")
+def _sync_stop_direction(mapper, connection, target):
+    target.huongChuan = "VE" if (target.huong or "").strip().upper() == "VE" else "DI"
 
+
+class StopOffset(db.Model):
+    """Offset (giây/mét) của từng trạm tính từ trạm đầu, lưu sẵn theo tuyến + hướng."""
+    __tablename__ = "stop_offset"
+    __table_args__ = (
+        db.Index("idx_stop_offset_route_dir_stop", "tuyen_id", "huong", "tram_id", unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    tuyen_id = db.Column(db.Integer, db.ForeignKey("tuyen_xe.maTuyen"), nullable=False)
+    huong = db.Column(db.String(10), nullable=False)  # DI/VE (đã chuẩn hoá)
+    tram_id = db.Column(db.Integer, db.ForeignKey("tram_dung.maTram", ondelete="CASCADE"), nullable=False)
+    offset_s = db.Column(db.Float, nullable=False)
+    dist_m = db.Column(db.Float, nullable=False)
+    source = db.Column(db.String(30))                # fallback / osrm
+    stops_sig = db.Column(db.String(40))             # `_stops_signature` lúc tính: trạm không đổi -> giữ offset OSRM
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# ==================== KHỞI TẠO DB & ADMIN ====================
+
+def ensure_default_admin():
     if not TaiKhoan.query.filter_by(vai_tro="ADMIN").first():
         dialect = None
         try:
@@ -272,56 +436,325 @@ def ensure_schema():
                 conn.execute(text("ALTER TABLE ve_xe ADD COLUMN maSoVe VARCHAR(50)"))
             if "thoiGianSuDung" not in ticket_cols:
                 conn.execute(text("ALTER TABLE ve_xe ADD COLUMN thoiGianSuDung VARCHAR(30)"))
+            # Index / unique constraint: xem MIGRATIONS (chạy cho cả SQLite và Postgres)
+    except Exception as e:
+        print("ensure_schema warning:", e)
 
-            try:
-                conn.execute(text("""
-                  CREATE UNIQUE INDEX IF NOT EXISTS idx_card_code_unique
-                  ON the_tu (maSoThe)
-                """))
-            except Exception:
-                pass
+# ==================== MIGRATION (SQLite + Postgres) ====================
+# Mỗi migration chạy đúng 1 lần, ghi version vào bảng schema_migrations.
+# Tên cột camelCase phải đặt trong "..." (Postgres phân biệt hoa/thường khi SQLAlchemy tạo bảng).
 
-            try:
-                conn.execute(text("""
-                  CREATE UNIQUE INDEX IF NOT EXISTS idx_ticket_code_unique
-                  ON ve_xe (maSoVe)
-                """))
-            except Exception:
-                pass
+def _add_column_if_missing(conn, table, column, ddl_type):
+    cols = {c["name"] for c in sa_inspect(conn).get_columns(table)}
+    if column not in cols:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN "{column}" {ddl_type}'))
 
-            # Tránh tạo trùng chuyến theo tuyến/ngày/giờ/hướng khi auto-generate lịch
-            try:
-                conn.execute(text("""
-                  CREATE UNIQUE INDEX IF NOT EXISTS idx_trip_unique_departure
-                  ON chuyen_xe (tuyen_id, ngayKhoiHanh, gioKhoiHanh, huong)
-                """))
-            except Exception:
-                # nếu DB đã có dữ liệu trùng, tránh làm app chết; code sẽ tự tránh trùng ở mức logic
-                pass
 
-            # Ngăn double-book ghế (trừ ghế đã hủy)
-            try:
-                conn.execute(text("""
-                  CREATE UNIQUE INDEX IF NOT EXISTS idx_ve_unique_seat_active
-                  ON ve_xe (chuyen_id, soGhe)
-                  WHERE trangThai != 'DA_HUY'
-                """))
-            except Exception:
-                pass
+def _create_index_safely(conn, ddl):
+    # Index thường (chỉ để tăng tốc): lỗi thì cảnh báo rồi bỏ qua; SAVEPOINT để không hỏng cả transaction (Postgres)
+    try:
+        with conn.begin_nested():
+            conn.execute(text(ddl))
     except Exception as e:
-        print("ensure_schema warning:", e)
+        print("migration warning:", e)
+
+
+def _create_unique_index(conn, ddl):
+    # Unique index là ràng buộc dữ liệu: không tạo được (dữ liệu cũ bị trùng) thì migration phải lỗi,
+    # không ghi version -> dọn dữ liệu trùng rồi chạy lại `flask migrate`.
+    try:
+        conn.execute(text(ddl))
+    except Exception as e:
+        raise RuntimeError(f"Không tạo được unique index (dữ liệu cũ bị trùng?), hãy dọn rồi migrate lại: {e}") from e
+
+
+def _migration_001_stop_direction(conn):
+    # Hướng chuẩn hoá (NULL/dữ liệu cũ -> DI) để index phục vụ được truy vấn trạm theo hướng
+    _add_column_if_missing(conn, "tram_dung", "huongChuan", "VARCHAR(10)")
+    conn.execute(text("""
+      UPDATE tram_dung
+      SET "huongChuan" = CASE WHEN UPPER(TRIM(COALESCE(huong, ''))) = 'VE' THEN 'VE' ELSE 'DI' END
+    """))
+    _create_index_safely(conn, """
+      CREATE INDEX IF NOT EXISTS idx_stop_route_dir_order
+      ON tram_dung (tuyen_id, "huongChuan", "thuTuTrenTuyen")
+    """)
+
+
+def _migration_002_trip_columns(conn):
+    _add_column_if_missing(conn, "chuyen_xe", "loaiChuyen", "VARCHAR(20)")
+    _add_column_if_missing(conn, "chuyen_xe", "gioGoc", "VARCHAR(20)")
+    _add_column_if_missing(
+        conn, "chuyen_xe", "departure_at",
+        "TIMESTAMP" if conn.dialect.name == "postgresql" else "DATETIME",
+    )
+    _create_index_safely(conn, """
+      CREATE INDEX IF NOT EXISTS idx_trip_route_dir_departure
+      ON chuyen_xe (tuyen_id, huong, departure_at)
+    """)
+
+
+def _migration_003_unique_codes(conn):
+    _create_unique_index(conn, """
+      CREATE UNIQUE INDEX IF NOT EXISTS idx_card_code_unique
+      ON the_tu ("maSoThe")
+    """)
+    _create_unique_index(conn, """
+      CREATE UNIQUE INDEX IF NOT EXISTS idx_ticket_code_unique
+      ON ve_xe ("maSoVe")
+    """)
+    # Tránh trùng chuyến theo tuyến/ngày/giờ/hướng
+    _create_unique_index(conn, """
+      CREATE UNIQUE INDEX IF NOT EXISTS idx_trip_unique_departure
+      ON chuyen_xe (tuyen_id, "ngayKhoiHanh", "gioKhoiHanh", huong)
+    """)
+    # Ngăn double-book ghế (trừ ghế đã hủy)
+    _create_unique_index(conn, """
+      CREATE UNIQUE INDEX IF NOT EXISTS idx_ve_unique_seat_active
+      ON ve_xe (chuyen_id, "soGhe")
+      WHERE "trangThai" != 'DA_HUY'
+    """)
+
+
+def _migration_004_card_version(conn):
+    _add_column_if_missing(conn, "the_tu", "phienBan", "INTEGER")
+    conn.execute(text('UPDATE the_tu SET "phienBan" = "maThe" WHERE "phienBan" IS NULL'))
+    _create_index_safely(conn, """
+      CREATE INDEX IF NOT EXISTS "ix_the_tu_phienBan"
+      ON the_tu ("phienBan")
+    """)
+
+
+def _migration_005_route_revision(conn):
+    _add_column_if_missing(conn, "tuyen_xe", "phienBan", "INTEGER")
+    conn.execute(text('UPDATE tuyen_xe SET "phienBan" = 1 WHERE "phienBan" IS NULL'))
+
+
+def _migration_006_card_version_counter(conn):
+    conn.execute(text("""
+      CREATE TABLE IF NOT EXISTS card_version_counter (
+        id INTEGER PRIMARY KEY,
+        value INTEGER NOT NULL
+      )
+    """))
+    if conn.execute(text("SELECT 1 FROM card_version_counter WHERE id = 1")).first() is None:
+        conn.execute(
+            text("INSERT INTO card_version_counter (id, value) VALUES (1, :v)"),
+            {"v": _max_card_version(conn)},
+        )
 
-with app.app_context():
+
+def _migration_007_stop_offset_signature(conn):
+    _add_column_if_missing(conn, "stop_offset", "stops_sig", "VARCHAR(40)")
+
+
+MIGRATIONS = [
+    (1, "stop_direction_normalized", _migration_001_stop_direction),
+    (2, "trip_departure_at", _migration_002_trip_columns),
+    (3, "unique_codes_and_trips", _migration_003_unique_codes),
+    (4, "card_version", _migration_004_card_version),
+    (5, "route_revision", _migration_005_route_revision),
+    (6, "card_version_counter", _migration_006_card_version_counter),
+    (7, "stop_offset_signature", _migration_007_stop_offset_signature),
+]
+
+
+def run_migrations():
+    """Chạy các migration chưa áp dụng (theo thứ tự version). Trả về list version đã chạy."""
+    applied_now = []
+    with db.engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # nhiều gunicorn worker khởi động cùng lúc -> chỉ 1 worker chạy migration
+            conn.execute(text("SELECT pg_advisory_xact_lock(20240801)"))
+        conn.execute(text("""
+          CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            applied_at VARCHAR(30)
+          )
+        """))
+        done = {r[0] for r in conn.execute(text("SELECT version FROM schema_migrations"))}
+        for version, name, fn in MIGRATIONS:
+            if version in done:
+                continue
+            fn(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                {"v": version, "n": name, "t": datetime.utcnow().isoformat(timespec="seconds")},
+            )
+            applied_now.append(version)
+    return applied_now
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Áp dụng migration còn thiếu (index, unique constraint, cột mới) cho DB hiện tại."""
+    applied = run_migrations()
+    backfill_trip_departure_at()
+    backfill_stop_offsets()
+    print(f"[OK] applied={applied or 'none'}")
+
+
+def backfill_stop_offsets():
+    """Lưu offset cho (tuyến, hướng) có trạm tọa độ nhưng chưa có dòng `stop_offset` (DB cũ). Trả về số tuyến đã tính."""
+    have = set(db.session.query(StopOffset.tuyen_id, StopOffset.huong).distinct().all())
+    want = set(
+        db.session.query(TramDung.tuyen_id, TramDung.huongChuan)
+        .filter(TramDung.lat.isnot(None), TramDung.lng.isnot(None))
+        .distinct()
+        .all()
+    )
+    missing = {}
+    for tuyen_id, d in want - have:
+        missing.setdefault(tuyen_id, []).append(d)
+    for tuyen_id, dirs in sorted(missing.items()):
+        tuyen = db.session.get(TuyenXe, tuyen_id)
+        if tuyen:
+            # chạy từ CLI (bootstrap/migrate): không mở thread OSRM nền, request đọc đầu tiên sẽ xếp hàng
+            rebuild_stop_offsets(tuyen, dirs=tuple(sorted(dirs)), commit=False, schedule_osrm=False)
+    db.session.commit()
+    return len(missing)
+
+
+def backfill_trip_departure_at():
+    """Điền `departure_at` cho chuyến cũ (trước khi có cột). Trả về số dòng đã cập nhật."""
+    rows = (
+        db.session.query(ChuyenXe.maChuyen, ChuyenXe.ngayKhoiHanh, ChuyenXe.gioKhoiHanh)
+        .filter(ChuyenXe.departure_at.is_(None))
+        .all()
+    )
+    updates = [
+        {"maChuyen": trip_id, "departure_at": dt}
+        for (trip_id, ngay, gio) in rows
+        if (dt := _parse_departure_at(ngay, gio)) is not None
+    ]
+    if updates:
+        db.session.execute(db.update(ChuyenXe), updates)
+        db.session.commit()
+    return len(updates)
+
+
+def bootstrap_db():
+    """Tạo bảng, bổ sung cột SQLite cũ, chạy migration, backfill, tạo admin mặc định (chạy 1 lần khi deploy)."""
+    db.create_all()
     ensure_schema()
+    applied = run_migrations()
+    backfill_trip_departure_at()
+    backfill_stop_offsets()
+    ensure_default_admin()
+    return applied
+
+
+@app.cli.command("bootstrap")
+def bootstrap_command():
+    """Khởi tạo/nâng cấp schema DB (thay cho việc mỗi worker tự chạy DDL khi import)."""
+    applied = bootstrap_db()
+    print(f"[OK] schema ready, migrations applied={applied or 'none'}")
 
 
 # ==================== HÀM TIỆN ÍCH ====================
 
+class UserPrincipal:
+    """
+    Thông tin tài khoản đăng nhập (đọc 1 lần/request bằng 1 truy vấn, kèm hồ sơ khách hàng).
+    Không phải ORM object: cần KhachHang thật thì dùng `.khach_hang` (lazy, theo khoá chính).
+    """
+    __slots__ = ("id", "email", "vai_tro", "trangThai", "khach_hang_id", "hoTen")
+
+    def __init__(self, id, email, vai_tro, trangThai, khach_hang_id, hoTen):
+        self.id = id
+        self.email = email
+        self.vai_tro = vai_tro
+        self.trangThai = trangThai
+        self.khach_hang_id = khach_hang_id
+        self.hoTen = hoTen
+
+    @property
+    def khach_hang(self):
+        if self.khach_hang_id is None:
+            return None
+        return db.session.get(KhachHang, self.khach_hang_id)
+
+
+# {user_id: (ts, UserPrincipal)} — chỉ dùng khi USER_CACHE_TTL_SEC > 0
+_USER_CACHE = {}
+_USER_CACHE_LOCK = threading.Lock()
+
+
+def _load_user_principal(uid):
+    row = (
+        db.session.query(
+            TaiKhoan.id, TaiKhoan.email, TaiKhoan.vai_tro, TaiKhoan.trangThai,
+            KhachHang.maKH, KhachHang.hoTen,
+        )
+        .outerjoin(KhachHang, KhachHang.tai_khoan_id == TaiKhoan.id)
+        .filter(TaiKhoan.id == uid)
+        .order_by(KhachHang.maKH.asc())
+        .first()
+    )
+    return UserPrincipal(*row) if row else None
+
+
+def invalidate_user_cache(uid):
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(uid, None)
+    if g and getattr(g, "_user_principal_uid", None) == uid:
+        g.pop("_user_principal_uid", None)
+        g.pop("_user_principal", None)
+
+
 def current_user():
     uid = session.get("user_id")
     if uid is None:
         return None
-    return db.session.get(TaiKhoan, uid)
+
+    # 1 lần/request: handler + context processor + template dùng chung
+    if getattr(g, "_user_principal_uid", None) == uid:
+        return g._user_principal
+
+    principal = None
+    if USER_CACHE_TTL_SEC > 0:
+        hit = _USER_CACHE.get(uid)
+        if hit and (time.time() - hit[0]) < USER_CACHE_TTL_SEC:
+            principal = hit[1]
+    if principal is None:
+        principal = _load_user_principal(uid)
+        if principal is not None and USER_CACHE_TTL_SEC > 0:
+            with _USER_CACHE_LOCK:
+                _USER_CACHE[uid] = (time.time(), principal)
+
+    g._user_principal_uid = uid
+    g._user_principal = principal
+    return principal
+
+
+@event.listens_for(TaiKhoan, "after_update")
+@event.listens_for(TaiKhoan, "after_delete")
+def _track_user_change(mapper, connection, target):
+    sess = sa_object_session(target)
+    if sess is not None:
+        sess.info.setdefault("user_changes", set()).add(target.id)
+
+
+@event.listens_for(KhachHang, "after_insert")
+@event.listens_for(KhachHang, "after_update")
+@event.listens_for(KhachHang, "after_delete")
+def _track_customer_change(mapper, connection, target):
+    sess = sa_object_session(target)
+    if sess is not None and target.tai_khoan_id is not None:
+        sess.info.setdefault("user_changes", set()).add(target.tai_khoan_id)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_changed_users(sess):
+    # đổi vai trò/trạng thái/hồ sơ -> bỏ cache (các worker khác hết hạn theo USER_CACHE_TTL_SEC)
+    for uid in sess.info.pop("user_changes", ()):
+        invalidate_user_cache(uid)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_user_changes(sess):
+    sess.info.pop("user_changes", None)
 
 
 def ensure_customer(user):
@@ -417,94 +850,192 @@ def _compute_headway_minutes(tuyen, window_minutes, dirs_count=2):
     return None
 
 
-def ensure_upcoming_trips(tuyen, now=None, horizon_min=None):
+VirtualTrip = namedtuple("VirtualTrip", "maChuyen tuyen_id ngayKhoiHanh gioKhoiHanh huong")
+
+
+def timetable_departures(tuyen, day, dirs=None, from_dt=None, to_dt=None, limit=None, ctx=None):
     """
-    Bus đô thị: tự sinh chuyến sắp tới theo khung giờ + tần suất.
-    - Chỉ sinh trong khoảng [now, now + horizon] để tránh DB phình to.
-    - Sinh theo hướng DI/VE nếu tuyến có dữ liệu trạm cho hướng đó.
+    Lịch xuất bến của tuyến trong ngày `day` (date), kiểu GTFS frequencies:
+    - Chuyến thường tính số học từ khung giờ + headway (không cần dòng ChuyenXe).
+    - Dòng ChuyenXe là ngoại lệ: THEM (thêm), HUY (hủy), DOI_GIO (dời giờ), hoặc chuyến thường đã lưu
+      (có vé / dữ liệu cũ) -> thay thế chuyến tính từ lịch cùng giờ/hướng.
+    - `from_dt`/`to_dt`/`limit`: lọc khoảng giờ xuất bến; phần dòng đã lưu được lọc/sắp xếp/LIMIT trong SQL
+      (index tuyen_id, huong, departure_at), phần chuyến tính từ lịch nhảy thẳng tới chuyến đầu tiên trong khoảng.
+    - `ctx`: RouteContext của tuyến (mặc định lấy từ request hiện tại) cho khung giờ/headway/hướng có trạm.
+    Trả về list dict sắp theo giờ xuất bến: trip_id (None nếu chuyến ảo), date, time, direction, dt, virtual.
     """
     if not tuyen:
-        return 0
+        return []
+
+    date_str = day.strftime("%Y-%m-%d")
+    day_start = datetime.combine(day, datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+    lo = max(day_start, from_dt) if from_dt else day_start
+    hi = min(day_end - timedelta(minutes=1), to_dt) if to_dt else day_end - timedelta(minutes=1)
+    if hi < lo:
+        return []
+
+    ctx = ctx or route_context(tuyen)
+    wanted = [normalize_direction(d) for d in (dirs or ("DI", "VE"))]
+
+    base_q = ChuyenXe.query.filter(ChuyenXe.tuyen_id == tuyen.maTuyen, ChuyenXe.huong.in_(wanted))
+    listed_q = (
+        base_q
+        .filter(
+            ChuyenXe.departure_at >= lo,
+            ChuyenXe.departure_at <= hi,
+            or_(ChuyenXe.loaiChuyen.is_(None), ChuyenXe.loaiChuyen != "HUY"),
+        )
+        .order_by(ChuyenXe.departure_at.asc(), ChuyenXe.huong.asc(), ChuyenXe.maChuyen.asc())
+    )
+    if limit:
+        listed_q = listed_q.limit(int(limit))
+    listed = listed_q.all()
+    # HUY / DOI_GIO trong ngày: ẩn chuyến tính từ lịch ở giờ gốc (thường rất ít dòng)
+    overrides = base_q.filter(
+        ChuyenXe.departure_at >= day_start,
+        ChuyenXe.departure_at < day_end,
+        ChuyenXe.loaiChuyen.in_(("HUY", "DOI_GIO")),
+    ).all()
+
+    overridden = set()
+    for r in list(listed) + overrides:
+        kind = (r.loaiChuyen or "THUONG").upper()
+        # DOI_GIO chỉ chiếm giờ gốc: giờ mới có thể trùng 1 chuyến thường khác, chuyến đó vẫn chạy
+        if kind == "DOI_GIO":
+            raw = r.gioGoc
+        elif kind == "HUY":
+            raw = r.gioGoc or r.gioKhoiHanh
+        else:
+            raw = r.gioKhoiHanh
+        t_min = _parse_hhmm_minutes(raw)
+        if t_min is not None:
+            overridden.add((normalize_direction(r.huong), t_min))
+
+    out = [
+        {
+            "trip_id": r.maChuyen,
+            "route_id": tuyen.maTuyen,
+            "date": date_str,
+            "time": r.departure_at.strftime("%H:%M"),
+            "direction": normalize_direction(r.huong),
+            "dt": r.departure_at,
+            "virtual": False,
+            "kind": (r.loaiChuyen or "THUONG").upper(),
+        }
+        for r in listed
+    ]
 
+    # Dòng đã lưu bị cắt bởi LIMIT -> chuyến ảo từ giờ đó trở đi có thể bị ẩn bởi dòng chưa đọc
+    if limit and len(listed) >= int(limit):
+        hi = min(hi, listed[-1].departure_at - timedelta(minutes=1))
+
+    lo_min = int((lo - day_start).total_seconds() // 60) + (1 if lo.second or lo.microsecond else 0)
+    hi_min = int((hi - day_start).total_seconds() // 60)
+    minutes = ctx.departure_minutes
+    if minutes and hi_min >= lo_min:
+        first_min = minutes[0]
+        step = (minutes[1] - minutes[0]) if len(minutes) > 1 else 1
+        k0 = max(0, _ceil_div_int(lo_min - first_min, step))
+        for d in wanted:
+            if d not in ctx.dirs_with_stops:
+                continue
+            taken = 0
+            for t_min in minutes[k0:]:
+                if t_min > hi_min:
+                    break
+                if (d, t_min) in overridden:
+                    continue
+                out.append({
+                    "trip_id": None,
+                    "route_id": tuyen.maTuyen,
+                    "date": date_str,
+                    "time": f"{t_min // 60:02d}:{t_min % 60:02d}",
+                    "direction": d,
+                    "dt": day_start + timedelta(minutes=t_min),
+                    "virtual": True,
+                    "kind": "THUONG",
+                })
+                taken += 1
+                if limit and taken >= int(limit):
+                    break
+
+    out.sort(key=lambda x: (x["dt"], x["direction"], x["trip_id"] or 0))
+    return out[:int(limit)] if limit else out
+
+
+def upcoming_departures(tuyen, now=None, dirs=None, offset_s=0.0, grace_min=0, horizon_min=None, limit=None,
+                        ctx=None):
+    """
+    Chuyến sắp tới trong ngày: giữ chuyến có (giờ xuất bến + offset_s) >= now - grace_min,
+    tối đa `horizon_min` phút sắp tới. `offset_s` là offset của trạm (0 = bến đầu).
+    """
     now = now or datetime.now()
     horizon_min = BUS_SCHEDULE_HORIZON_MIN if horizon_min is None else int(horizon_min)
-    horizon_min = max(30, min(horizon_min, 24 * 60))
-
-    window = _parse_operating_window_minutes(tuyen.thoiGianHoatDong)
-    if not window:
-        return 0
-    start_min, end_min = window
-    window_minutes = end_min - start_min
-
-    # xác định hướng có dữ liệu trạm
-    dirs = []
-    for d in ("DI", "VE"):
-        st = stop_stats_for_direction(tuyen, d)
-        if st.get("stops", 0) > 0:
-            dirs.append(d)
-
-    if not dirs:
-        return 0
-
-    # nếu chỉ có 1 hướng dữ liệu, vẫn hiểu là tuyến 2 chiều (DI+VE) để tính headway từ "số chuyến/ngày"
-    dirs_count_for_schedule = 2 if len(dirs) == 1 else len(dirs)
-
-    headway = _compute_headway_minutes(tuyen, window_minutes, dirs_count=dirs_count_for_schedule)
-    if not headway:
-        return 0
+    shift = timedelta(seconds=float(offset_s or 0.0))
+    return timetable_departures(
+        tuyen,
+        now.date(),
+        dirs=dirs,
+        from_dt=now - timedelta(minutes=grace_min) - shift,
+        to_dt=now + timedelta(minutes=horizon_min) - shift,
+        limit=limit,
+        ctx=ctx,
+    )
 
-    # chỉ sinh cho hôm nay (demo). Nếu muốn: mở rộng sang ngày kế tiếp.
-    date_str = now.strftime("%Y-%m-%d")
-    now_min = now.hour * 60 + now.minute
 
-    from_min = max(start_min, now_min)
-    to_min = min(end_min, from_min + horizon_min)
-    if to_min < from_min:
-        return 0
+def departures_page(tuyen, day, dirs=None, after=None, from_dt=None, limit=20):
+    """
+    1 trang lịch xuất bến theo keyset (giờ xuất bến, hướng, trip_id):
+    - `after`: khóa của phần tử cuối trang trước (dt, direction, trip_id) -> seek thẳng tới dt đó.
+    - Trả về (items, next_key); next_key None nếu hết ngày.
+    """
+    limit = max(1, int(limit))
+    start = after[0] if after else from_dt
+    fetch = limit + 1
+    while True:
+        deps = timetable_departures(tuyen, day, dirs=dirs, from_dt=start, limit=fetch)
+        items = [d for d in deps if not after or _departure_key(d) > after]
+        # còn thiếu do nhiều chuyến trùng đúng giờ con trỏ -> đọc rộng thêm
+        if len(items) > limit or len(deps) < fetch:
+            break
+        fetch *= 2
 
-    # căn về mốc headway tính từ start_min
-    offset = (from_min - start_min) % headway
-    first = from_min if offset == 0 else (from_min + (headway - offset))
+    has_more = len(items) > limit
+    items = items[:limit]
+    next_key = _departure_key(items[-1]) if (has_more and items) else None
+    return items, next_key
 
-    times = []
-    t = first
-    while t <= to_min:
-        times.append(f"{t // 60:02d}:{t % 60:02d}")
-        t += headway
 
-    if not times:
-        return 0
+def _departure_key(dep):
+    return (dep["dt"], dep["direction"], dep["trip_id"] or 0)
 
-    existing = (
-        ChuyenXe.query
-        .filter(ChuyenXe.tuyen_id == tuyen.maTuyen, ChuyenXe.ngayKhoiHanh == date_str)
-        .with_entities(ChuyenXe.gioKhoiHanh, ChuyenXe.huong)
-        .all()
-    )
-    existing_set = {(normalize_direction(h), g) for (g, h) in existing if g}
 
-    new_rows = []
-    for d in dirs:
-        for gio in times:
-            key = (d, gio)
-            if key in existing_set:
-                continue
-            new_rows.append(
-                ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=date_str, gioKhoiHanh=gio, huong=d)
-            )
+def encode_departure_cursor(key):
+    raw = json.dumps([key[0].isoformat(timespec="seconds"), key[1], key[2]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
 
-    if not new_rows:
-        return 0
 
-    db.session.add_all(new_rows)
+def decode_departure_cursor(cursor):
+    """Giải mã con trỏ; ValueError nếu không hợp lệ."""
     try:
-        db.session.commit()
+        padded = cursor + "=" * (-len(cursor) % 4)
+        dt_raw, d, trip_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return (datetime.fromisoformat(dt_raw), normalize_direction(d), int(trip_id))
     except Exception:
-        db.session.rollback()
-        # Nếu đụng unique index do race condition, bỏ qua.
-        return 0
-
-    return len(new_rows)
+        raise ValueError("cursor không hợp lệ")
+
+
+def departure_detail_url(dep):
+    if dep.get("trip_id"):
+        return url_for("trip_detail", trip_id=dep["trip_id"])
+    return url_for(
+        "departure_detail",
+        tuyen_id=dep["route_id"],
+        date_str=dep["date"],
+        dir_=dep["direction"],
+        hhmm=dep["time"].replace(":", ""),
+    )
 
 
 def parse_route_price(tuyen, fallback=50000):
@@ -540,25 +1071,13 @@ def _query_stops_by_direction(tuyen, dir_):
     if dir_clean not in ("DI", "VE"):
         dir_clean = "DI"
 
-    q = TramDung.query.filter(TramDung.tuyen_id == tuyen.maTuyen)
-
-    # Backward compatible:
-    # - DI: lấy huong=DI hoặc NULL (phòng trường hợp dữ liệu cũ chưa set huong)
-    # - VE: lấy huong=VE
-    if dir_clean == "DI":
-        q = q.filter(or_(TramDung.huong == "DI", TramDung.huong.is_(None)))
-    else:
-        q = q.filter(TramDung.huong == "VE")
-
+    # huongChuan: NULL/dữ liệu cũ đã được chuẩn hoá về DI -> 1 điều kiện bằng, dùng được index
+    q = TramDung.query.filter(TramDung.tuyen_id == tuyen.maTuyen, TramDung.huongChuan == dir_clean)
     return q.order_by(TramDung.thuTuTrenTuyen.asc(), TramDung.maTram.asc())
 
 
-def stop_stats_for_direction(tuyen, dir_):
-    stops = _query_stops_by_direction(tuyen, dir_).all()
-    total = len(stops)
-    with_geo = sum(1 for s in stops if s.lat is not None and s.lng is not None)
+def _direction_stats(dir_, total, with_geo):
     percent = round((with_geo * 100.0) / total, 1) if total else 0.0
-
     return {
         "direction": dir_,
         "stops": total,
@@ -568,8 +1087,39 @@ def stop_stats_for_direction(tuyen, dir_):
     }
 
 
-def build_route_summary(tuyen):
-    dir_stats = {d: stop_stats_for_direction(tuyen, d) for d in ("DI", "VE")}
+def route_stop_stats(route_ids=None):
+    """
+    Thống kê trạm theo (tuyến, hướng) bằng 1 truy vấn GROUP BY (không nạp TramDung thành ORM object).
+    Trả về {tuyen_id: {"DI": stats, "VE": stats}}; tuyến trong `route_ids` chưa có trạm vẫn có stats 0.
+    """
+    with_geo = func.sum(case((TramDung.lat.isnot(None) & TramDung.lng.isnot(None), 1), else_=0))
+    q = db.session.query(TramDung.tuyen_id, TramDung.huongChuan, func.count(TramDung.maTram), with_geo)
+    if route_ids is not None:
+        q = q.filter(TramDung.tuyen_id.in_(list(route_ids)))
+    counts = {}
+    for tuyen_id, dir_, total, geo in q.group_by(TramDung.tuyen_id, TramDung.huongChuan).all():
+        counts[(tuyen_id, dir_ or "DI")] = (int(total or 0), int(geo or 0))
+
+    ids = set(route_ids) if route_ids is not None else {k[0] for k in counts}
+    return {
+        rid: {d: _direction_stats(d, *counts.get((rid, d), (0, 0))) for d in ("DI", "VE")}
+        for rid in ids
+    }
+
+
+def stop_stats_for_direction(tuyen, dir_, stops=None):
+    if stops is None:
+        return route_stop_stats([tuyen.maTuyen])[tuyen.maTuyen][normalize_direction(dir_)]
+    with_geo = sum(1 for s in stops if s.lat is not None and s.lng is not None)
+    return _direction_stats(dir_, len(stops), with_geo)
+
+
+def build_route_summary(tuyen, stops_by_dir=None, dir_stats=None):
+    if dir_stats is None:
+        if stops_by_dir is not None:
+            dir_stats = {d: stop_stats_for_direction(tuyen, d, stops=stops_by_dir.get(d) or []) for d in ("DI", "VE")}
+        else:
+            dir_stats = route_stop_stats([tuyen.maTuyen])[tuyen.maTuyen]
     total_stops = sum(s["stops"] for s in dir_stats.values())
     total_geo = sum(s["with_geo"] for s in dir_stats.values())
     percent = round((total_geo * 100.0) / total_stops, 1) if total_stops else 0.0
@@ -598,6 +1148,13 @@ def build_route_summary(tuyen):
     }
 
 
+def build_all_route_summaries():
+    """Tóm tắt mọi tuyến: 1 truy vấn tuyến + 1 truy vấn GROUP BY trạm."""
+    routes = TuyenXe.query.order_by(TuyenXe.maTuyen.asc()).all()
+    stats = route_stop_stats([r.maTuyen for r in routes])
+    return [build_route_summary(r, dir_stats=stats[r.maTuyen]) for r in routes]
+
+
 def _ceil_div_int(n, d):
     if d <= 0:
         return 0
@@ -618,20 +1175,21 @@ def _stops_signature(stops):
     return hashlib.sha1(raw).hexdigest()
 
 
+def haversine_m(lat1, lon1, lat2, lon2):
+    r = 6371000.0
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dl / 2) ** 2
+    return 2 * r * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
 def _compute_stop_offsets_fallback(coord_stops):
     """
     Fallback tính offset theo khoảng cách Haversine + tốc độ trung bình.
     coord_stops: list TramDung có lat/lng theo thứ tự.
     """
-    def haversine_m(lat1, lon1, lat2, lon2):
-        r = 6371000.0
-        phi1 = math.radians(lat1)
-        phi2 = math.radians(lat2)
-        dphi = math.radians(lat2 - lat1)
-        dl = math.radians(lon2 - lon1)
-        a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dl / 2) ** 2
-        return 2 * r * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
     speed_mps = max(3.0, float(BUS_FALLBACK_SPEED_KMH) * 1000.0 / 3600.0)
     offsets = {coord_stops[0].maTram: 0}
     dist_acc = {coord_stops[0].maTram: 0.0}
@@ -651,135 +1209,722 @@ def _compute_stop_offsets_fallback(coord_stops):
     return offsets, dist_acc
 
 
-def get_stop_offsets(tuyen, dir_):
+class _CircuitBreaker:
     """
-    Tính thời gian dự kiến dựa trên khoảng cách địa lý (Haversine).
-    Ép buộc dùng chế độ fallback để đảm bảo luôn có dữ liệu mà không cần gọi API OSRM.
+    Circuit breaker đơn giản cho OSRM: lỗi liên tiếp >= `max_failures` thì "mở mạch"
+    trong `cooldown_s` giây (không gọi upstream nữa), hết cooldown cho đúng 1 lời gọi thử (half-open):
+    các lời gọi khác vẫn bị chặn tới khi lần thử báo kết quả (hoặc quá `cooldown_s` mà chưa báo).
     """
-    dir_clean = normalize_direction(dir_)
+
+    def __init__(self, max_failures=3, cooldown_s=120.0):
+        self.max_failures = max(1, int(max_failures))
+        self.cooldown_s = max(1.0, float(cooldown_s))
+        self._failures = 0
+        self._opened_at = None
+        self._probe_at = None  # lần thử half-open đang chạy (thời điểm cho qua)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.time()
+            if self._probe_at is not None and (now - self._probe_at) < self.cooldown_s:
+                return False  # đã có 1 lần thử đang chạy
+            if (now - self._opened_at) >= self.cooldown_s:
+                self._probe_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probe_at is not None or self._failures >= self.max_failures:
+                self._opened_at = time.time()  # lần thử half-open lỗi -> mở lại ngay
+                self._probe_at = None
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+_OSRM_BREAKER = _CircuitBreaker(OSRM_BREAKER_FAILURES, OSRM_BREAKER_COOLDOWN_SEC)
+_OSRM_SESSIONS = {}  # (pid, interactive) -> requests.Session
+_OSRM_SESSION_LOCK = threading.Lock()
+_OSRM_CHUNK_POOL = None  # (pid, ThreadPoolExecutor) dùng chung cho mọi lần gọi chia cửa sổ
+
+
+def _osrm_session(interactive=False):
+    """
+    Session HTTP dùng chung (keep-alive + connection pool) cho mọi lần gọi OSRM.
+    Tạo lười theo PID để mỗi gunicorn worker có pool riêng (không chia socket qua fork).
+    interactive=True (request path): chỉ thử lại lỗi kết nối, không thử lại khi đã gửi request (đọc/5xx)
+    -> người dùng không phải chờ nhiều lần OSRM_TIMEOUT; worker nền vẫn thử lại đủ OSRM_RETRIES.
+    """
+    pid = os.getpid()
+    key = (pid, bool(interactive))
+    sess = _OSRM_SESSIONS.get(key)
+    if sess is not None:
+        return sess
+
+    with _OSRM_SESSION_LOCK:
+        if key not in _OSRM_SESSIONS:
+            for stale in [k for k in _OSRM_SESSIONS if k[0] != pid]:
+                _OSRM_SESSIONS.pop(stale, None)  # session kế thừa từ process cha (trước fork)
+            retries = max(0, OSRM_RETRIES)
+            retry = Retry(
+                total=retries,
+                connect=retries,
+                read=0 if interactive else retries,
+                status=0 if interactive else retries,
+                backoff_factor=0.2,
+                backoff_jitter=0.3,
+                status_forcelist=(429, 502, 503, 504),
+                allowed_methods=frozenset(["GET"]),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=max(1, OSRM_POOL_SIZE),
+                pool_maxsize=max(1, OSRM_POOL_SIZE),
+                max_retries=retry,
+            )
+            sess = requests.Session()
+            sess.headers.update({"User-Agent": "smartbus-demo", "Connection": "keep-alive"})
+            sess.mount("http://", adapter)
+            sess.mount("https://", adapter)
+            _OSRM_SESSIONS[key] = sess
+    return _OSRM_SESSIONS[key]
+
+
+def _osrm_chunk_pool():
+    """Thread pool gọi song song các cửa sổ OSRM, tạo lười theo PID (thread không sống qua fork của gunicorn)."""
+    global _OSRM_CHUNK_POOL
+    pid = os.getpid()
+    current = _OSRM_CHUNK_POOL
+    if current is not None and current[0] == pid:
+        return current[1]
+    with _OSRM_SESSION_LOCK:
+        if _OSRM_CHUNK_POOL is None or _OSRM_CHUNK_POOL[0] != pid:
+            pool = ThreadPoolExecutor(max_workers=max(1, OSRM_CHUNK_WORKERS), thread_name_prefix="osrm-chunk")
+            _OSRM_CHUNK_POOL = (pid, pool)
+        return _OSRM_CHUNK_POOL[1]
+
+
+def _osrm_get(url, params=None, deadline_sec=None):
+    if deadline_sec is None:
+        return _osrm_session().get(url, params=params, timeout=(OSRM_CONNECT_TIMEOUT, OSRM_TIMEOUT))
+    timeout = (min(OSRM_CONNECT_TIMEOUT, deadline_sec), min(OSRM_TIMEOUT, deadline_sec))
+    return _osrm_session(interactive=True).get(url, params=params, timeout=timeout)
+
+
+
+class OsrmError(RuntimeError):
+    """Lỗi gọi OSRM. `status` là HTTP status nên trả về cho client (502/503)."""
+
+    def __init__(self, message, status=502, raw=None):
+        super().__init__(message)
+        self.status = status
+        self.raw = raw
+
+
+def _osrm_request_route(points, params, deadline_sec=None):
+    """
+    1 lần gọi OSRM /route cho <= OSRM_MAX_COORDS điểm (points: list (lng, lat)).
+    Trả về routes[0]; lỗi mạng/timeout đọc, 5xx và 429 được tính vào circuit breaker.
+    """
+    if not _OSRM_BREAKER.allow():
+        raise OsrmError("OSRM tạm ngưng do lỗi liên tiếp, thử lại sau.", status=503)
+
+    coord_str = ";".join(f"{lng},{lat}" for (lng, lat) in points)
+    url = f"{OSRM_BASE_URL}/route/v1/{OSRM_PROFILE}/{coord_str}"
+
+    try:
+        r = _osrm_get(url, params=params, deadline_sec=deadline_sec)
+        j = r.json() if r.content else {}
+    except Exception as e:
+        _OSRM_BREAKER.record_failure()
+        raise OsrmError(f"Gọi OSRM thất bại: {e}")
+
+    if r.status_code >= 500 or r.status_code == 429:
+        # 429: server công cộng đang giới hạn tần suất -> ngắt mạch thay vì gọi dồn thêm
+        _OSRM_BREAKER.record_failure()
+        raise OsrmError("OSRM không trả route", raw=j)
+    _OSRM_BREAKER.record_success()  # upstream trả lời (kể cả 4xx/NoRoute) -> khép mạch, kết thúc lần thử
+    if r.status_code != 200 or j.get("code") != "Ok" or not j.get("routes"):
+        raise OsrmError("OSRM không trả route", raw=j)
+
+    route = j["routes"][0]
+    if len(route.get("legs") or []) != len(points) - 1:
+        raise OsrmError("OSRM legs không khớp số điểm")
+    return route
+
+
+def _osrm_windows(n, size):
+    """
+    Chia n điểm thành các cửa sổ [start, end) dài tối đa `size`, chồng nhau 1 điểm
+    (điểm cuối cửa sổ trước = điểm đầu cửa sổ sau) để legs nối liền không trùng.
+    """
+    size = max(2, int(size))
+    if n <= size:
+        return [(0, n)]
+    windows = []
+    start = 0
+    while start < n - 1:
+        end = min(n, start + size)
+        windows.append((start, end))
+        start = end - 1
+    return windows
+
+
+def osrm_route_chunked(points, geometry=False, deadline_sec=None):
+    """
+    Gọi OSRM cho chuỗi điểm dài: chia cửa sổ theo OSRM_MAX_COORDS, gọi song song
+    (thread pool dùng chung của process) rồi ghép lại thành 1 route.
+    points: list (lng, lat). Trả về {distance_m, duration_s, legs: [(duration_s, distance_m)], geometry}.
+    deadline_sec: tổng thời gian chờ tối đa (request path, không thử lại lần đọc); None = worker nền (có retry).
+    """
+    windows = _osrm_windows(len(points), OSRM_MAX_COORDS)
+    if len(windows) > max(1, OSRM_MAX_CHUNKS):
+        raise OsrmError(
+            f"Quá nhiều điểm ({len(points)}). Giới hạn: {OSRM_MAX_COORDS * OSRM_MAX_CHUNKS}",
+            status=400,
+        )
+
+    params = {"overview": "full", "geometries": "geojson", "steps": "false"} if geometry \
+        else {"overview": "false", "steps": "false"}
+
+    if len(windows) == 1 and deadline_sec is None:
+        routes = [_osrm_request_route(points, params)]
+    else:
+        pool = _osrm_chunk_pool()
+        futures = [pool.submit(_osrm_request_route, points[a:b], params, deadline_sec) for (a, b) in windows]
+        try:
+            if deadline_sec is None:
+                routes = [f.result() for f in futures]
+            else:
+                end = time.monotonic() + deadline_sec
+                routes = [f.result(timeout=max(0.0, end - time.monotonic())) for f in futures]
+        except FutureTimeoutError:
+            raise OsrmError("OSRM phản hồi quá chậm, thử lại sau.", status=504)
+        finally:
+            # lỗi/hết hạn: bỏ các cửa sổ chưa chạy; cửa sổ đang chạy tự dừng theo timeout của từng lần gọi
+            for f in futures:
+                f.cancel()
+
+    legs = []
+    line = []
+    for route in routes:
+        legs.extend(
+            (float(leg.get("duration") or 0.0), float(leg.get("distance") or 0.0))
+            for leg in (route.get("legs") or [])
+        )
+        if geometry:
+            coords = (route.get("geometry") or {}).get("coordinates") or []
+            # bỏ điểm đầu của đoạn sau (trùng điểm cuối đoạn trước)
+            line.extend(coords[1:] if line else coords)
+
+    return {
+        "distance_m": sum(float(r.get("distance") or 0.0) for r in routes),
+        "duration_s": sum(float(r.get("duration") or 0.0) for r in routes),
+        "legs": legs,
+        "geometry": {"type": "LineString", "coordinates": line} if geometry else None,
+    }
+
+
+def _fetch_osrm_legs(coord_stops):
+    """Legs OSRM giữa các trạm liên tiếp -> list (duration_s, distance_m)."""
+    points = [(float(s.lng), float(s.lat)) for s in coord_stops]
+    return osrm_route_chunked(points)["legs"]
+
+
+def _offsets_from_legs(coord_stops, legs):
+    offsets = {coord_stops[0].maTram: 0.0}
+    dist_acc = {coord_stops[0].maTram: 0.0}
+    cum_s = 0.0
+    cum_m = 0.0
+    for i, (dur, dist) in enumerate(legs):
+        cum_s += dur * float(BUS_OSRM_DURATION_FACTOR) + float(BUS_STOP_DWELL_SEC)
+        cum_m += dist
+        offsets[coord_stops[i + 1].maTram] = cum_s
+        dist_acc[coord_stops[i + 1].maTram] = cum_m
+    return offsets, dist_acc
+
+
+def _offset_stops(tuyen, dir_clean):
+    """Trạm 1 hướng theo thứ tự + các trạm có tọa độ (đầu vào tính offset)."""
     stops = _query_stops_by_direction(tuyen, dir_clean).all()
     stops.sort(key=lambda s: (s.thuTuTrenTuyen or 0, s.maTram or 0))
+    return stops, [s for s in stops if s.lat is not None and s.lng is not None]
+
 
-    coord_stops = [s for s in stops if s.lat is not None and s.lng is not None]
+def _compute_stop_offsets(tuyen, dir_, allow_osrm=False, offset_stops=None):
+    """
+    Tính offset trạm cho 1 hướng.
+    - Nếu đã có legs OSRM (cache theo `_stops_signature`) -> dùng luôn.
+    - `allow_osrm=True` (chỉ worker nền) -> được phép gọi OSRM khi cache chưa có.
+    - Còn lại: fallback Haversine + tốc độ trung bình.
+    `offset_stops`: kết quả `_offset_stops` nếu đã đọc sẵn. Chỉ dùng khi rebuild bảng `stop_offset` (xem `rebuild_stop_offsets`).
+    """
+    dir_clean = normalize_direction(dir_)
+    stops, coord_stops = offset_stops or _offset_stops(tuyen, dir_clean)
     if len(coord_stops) < 2:
         return {"ok": False, "error": "Tuyến chưa đủ 2 trạm có tọa độ.", "items": []}
 
-    # --- SỬA ĐỔI: Luôn dùng tính toán nội bộ (Fallback) ---
-    # Tốc độ giả định: 22km/h (Bạn có thể sửa số này ở dòng cấu hình BUS_FALLBACK_SPEED_KMH)
-    offsets, dist_acc = _compute_stop_offsets_fallback(coord_stops)
-    
-    value = {
-        "ok": True, 
-        "source": "fallback (simulation)", 
-        "offsets": offsets, 
-        "dist_m": dist_acc, 
-        "items": stops
-    }
-    return value
-
     sig = _stops_signature(coord_stops)
     cache_key = (int(tuyen.maTuyen), dir_clean, sig)
-    now_ts = time.time()
     hit = _STOP_OFFSET_CACHE.get(cache_key)
-    if hit and (now_ts - hit["ts"]) < max(30, int(STOP_OFFSET_CACHE_TTL_SEC)):
-        return hit["value"]
+    legs = hit["legs"] if hit else None
+    warn = None
 
-    # Nếu quá nhiều điểm, fallback để tránh 413/timeout
-    if len(coord_stops) > int(OSRM_MAX_COORDS):
+    # Tuyến dài được chia cửa sổ trong `osrm_route_chunked`
+    if legs is None and allow_osrm:
+        try:
+            legs = _fetch_osrm_legs(coord_stops)
+            _STOP_OFFSET_CACHE[cache_key] = {"ts": time.time(), "legs": legs}
+        except Exception as e:
+            warn = str(e)
+
+    if legs is not None:
+        offsets, dist_acc = _offsets_from_legs(coord_stops, legs)
+        value = {"ok": True, "source": "osrm", "offsets": offsets, "dist_m": dist_acc, "items": stops, "sig": sig}
+    else:
         offsets, dist_acc = _compute_stop_offsets_fallback(coord_stops)
-        value = {"ok": True, "source": "fallback", "offsets": offsets, "dist_m": dist_acc, "items": stops}
-        _STOP_OFFSET_CACHE[cache_key] = {"ts": now_ts, "value": value}
-        return value
+        value = {"ok": True, "source": "fallback", "offsets": offsets, "dist_m": dist_acc, "items": stops, "sig": sig}
+    if warn:
+        value["warn"] = warn
+    return value
 
-    coords = ";".join(f"{float(s.lng)},{float(s.lat)}" for s in coord_stops)
-    url = f"{OSRM_BASE_URL}/route/v1/{OSRM_PROFILE}/{coords}"
-    params = {"overview": "false", "steps": "false"}
 
-    try:
-        r = requests.get(url, params=params, timeout=OSRM_TIMEOUT)
-        j = r.json() if r.content else {}
-        if r.status_code != 200 or j.get("code") != "Ok" or not j.get("routes"):
-            raise RuntimeError("OSRM không trả route")
-
-        route = j["routes"][0]
-        legs = route.get("legs") or []
-        if len(legs) != len(coord_stops) - 1:
-            raise RuntimeError("OSRM legs không khớp số điểm")
-
-        offsets = {coord_stops[0].maTram: 0.0}
-        dist_acc = {coord_stops[0].maTram: 0.0}
-        cum_s = 0.0
-        cum_m = 0.0
-        for i, leg in enumerate(legs):
-            dur = float(leg.get("duration") or 0.0) * float(BUS_OSRM_DURATION_FACTOR)
-            dist = float(leg.get("distance") or 0.0)
-            cum_s += dur + float(BUS_STOP_DWELL_SEC)
-            cum_m += dist
-            offsets[coord_stops[i + 1].maTram] = cum_s
-            dist_acc[coord_stops[i + 1].maTram] = cum_m
-
-        value = {"ok": True, "source": "osrm", "offsets": offsets, "dist_m": dist_acc, "items": stops}
-        _STOP_OFFSET_CACHE[cache_key] = {"ts": now_ts, "value": value}
-        return value
-    except Exception as e:
-        offsets, dist_acc = _compute_stop_offsets_fallback(coord_stops)
-        value = {"ok": True, "source": "fallback", "offsets": offsets, "dist_m": dist_acc, "items": stops, "warn": str(e)}
-        _STOP_OFFSET_CACHE[cache_key] = {"ts": now_ts, "value": value}
-        return value
+def rebuild_stop_offsets(tuyen, dirs=("DI", "VE"), commit=True, allow_osrm=False, force=False, schedule_osrm=True):
+    """
+    Tính lại và lưu offset trạm của tuyến vào bảng `stop_offset`.
+    Gọi khi admin thêm/sửa/xóa trạm (chỉ hướng vừa sửa) hoặc khi seed trạm từ CSV.
+    Hướng đã có offset OSRM và `_stops_signature` không đổi -> giữ nguyên (worker khác đã tính), trừ khi `force`.
+    Nếu kết quả là fallback, tuyến được xếp hàng cho worker OSRM nền (`schedule_osrm=False` cho CLI/script:
+    process sắp thoát, thread daemon bị kill giữa chừng).
+    Trả về số dòng đã ghi.
+    """
+    if not tuyen:
+        return 0
 
+    # hướng -> signature trạm của offset OSRM đang lưu (hướng lẫn fallback/thiếu signature thì không giữ)
+    osrm_sig = {}
+    if not force:
+        stored = {}
+        for huong, source, sig in (
+            db.session.query(StopOffset.huong, StopOffset.source, StopOffset.stops_sig)
+            .filter(StopOffset.tuyen_id == tuyen.maTuyen)
+            .distinct()
+        ):
+            stored.setdefault(huong, set()).add((source, sig))
+        for huong, pairs in stored.items():
+            source, sig = next(iter(pairs)) if len(pairs) == 1 else (None, None)
+            if source == "osrm" and sig:
+                osrm_sig[huong] = sig
+
+    written = 0
+    needs_osrm = False
+    stops_changed = False
+    now_utc = datetime.utcnow()
+    for d in dirs:
+        dir_clean = normalize_direction(d)
+        stops, coord_stops = _offset_stops(tuyen, dir_clean)
+        if len(coord_stops) >= 2 and osrm_sig.get(dir_clean) == _stops_signature(coord_stops):
+            continue  # trạm không đổi, offset OSRM còn đúng
+
+        StopOffset.query.filter(
+            StopOffset.tuyen_id == tuyen.maTuyen,
+            StopOffset.huong == dir_clean,
+        ).delete(synchronize_session=False)
+        stops_changed = True
+
+        data = _compute_stop_offsets(tuyen, dir_clean, allow_osrm=allow_osrm, offset_stops=(stops, coord_stops))
+        if not data.get("ok"):
+            continue
+        if data.get("source") != "osrm":
+            needs_osrm = True
+
+        dist_m = data.get("dist_m") or {}
+        rows = [
+            StopOffset(
+                tuyen_id=tuyen.maTuyen,
+                huong=dir_clean,
+                tram_id=tram_id,
+                offset_s=float(off_s),
+                dist_m=float(dist_m.get(tram_id) or 0.0),
+                source=data.get("source"),
+                stops_sig=data.get("sig"),
+                computed_at=now_utc,
+            )
+            for tram_id, off_s in (data.get("offsets") or {}).items()
+        ]
+        db.session.add_all(rows)
+        written += len(rows)
 
-def compute_next_stop_etas(tuyen, dir_, at=None):
-    at = at or datetime.now()
-    window = _parse_operating_window_minutes(tuyen.thoiGianHoatDong)
-    if not window:
-        return {"ok": False, "error": "Tuyến chưa có khung giờ hoạt động (thoiGianHoatDong).", "items": []}
+    if commit:
+        db.session.commit()
+    if needs_osrm and not allow_osrm and schedule_osrm:
+        schedule_osrm_offsets(tuyen.maTuyen, retry_now=stops_changed)
+    return written
+
+
+# ---- Revision tuyến: ETag cho API đọc dữ liệu tuyến ----
+# Mỗi process giữ {maTuyen: phienBan}, nạp 1 truy vấn cho mọi tuyến, làm mới sau ROUTE_REVISION_TTL_SEC
+# -> request có If-None-Match khớp trả 304 mà không chạy truy vấn nào.
+
+_ROUTE_REVISIONS = {}
+_ROUTE_REVISIONS_LOADED_AT = 0.0
+_ROUTE_REVISIONS_LOCK = threading.Lock()
+
+
+def bump_route_revision(tuyen_id):
+    """Tăng revision tuyến trong transaction hiện tại (gọi khi admin/seed đổi trạm hoặc thông số tuyến)."""
+    db.session.execute(
+        text('UPDATE tuyen_xe SET "phienBan" = COALESCE("phienBan", 0) + 1 WHERE "maTuyen" = :id'),
+        {"id": tuyen_id},
+    )
+    db.session.info.setdefault("route_revisions", set()).add(tuyen_id)
+    g.get("route_contexts", {}).pop(tuyen_id, None)  # trạm/thông số đổi -> dựng lại RouteContext
 
-    start_min, end_min = window
-    window_minutes = end_min - start_min
 
-    # nếu chỉ có 1 hướng dữ liệu, vẫn hiểu tuyến 2 chiều để suy ra headway từ "số chuyến/ngày"
-    dirs = []
-    for d in ("DI", "VE"):
-        st = stop_stats_for_direction(tuyen, d)
-        if st.get("stops", 0) > 0:
-            dirs.append(d)
-    dirs_count_for_schedule = 2 if len(dirs) == 1 else max(1, len(dirs))
+@event.listens_for(db.session, "after_commit")
+def _expire_route_revisions(sess):
+    global _ROUTE_REVISIONS_LOADED_AT
+    changed = sess.info.pop("route_revisions", None)
+    if changed:
+        with _ROUTE_REVISIONS_LOCK:
+            _ROUTE_REVISIONS_LOADED_AT = 0.0  # lần đọc sau nạp lại revision mới nhất
 
-    headway_min = _compute_headway_minutes(tuyen, window_minutes, dirs_count=dirs_count_for_schedule)
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_route_revisions(sess):
+    sess.info.pop("route_revisions", None)
+
+
+def _reload_route_revisions():
+    global _ROUTE_REVISIONS, _ROUTE_REVISIONS_LOADED_AT
+    revisions = {
+        rid: (rev or 0)
+        for rid, rev in db.session.query(TuyenXe.maTuyen, TuyenXe.phienBan).all()
+    }
+    with _ROUTE_REVISIONS_LOCK:
+        _ROUTE_REVISIONS = revisions
+        _ROUTE_REVISIONS_LOADED_AT = time.time()
+    return revisions
+
+
+def route_revision(tuyen_id):
+    """Revision hiện tại của tuyến (None nếu tuyến không tồn tại)."""
+    fresh = (time.time() - _ROUTE_REVISIONS_LOADED_AT) < ROUTE_REVISION_TTL_SEC
+    if fresh and tuyen_id in _ROUTE_REVISIONS:
+        return _ROUTE_REVISIONS[tuyen_id]
+    return _reload_route_revisions().get(tuyen_id)
+
+
+def network_revision():
+    """Khoá phiên bản toàn mạng: đổi khi 1 tuyến đổi revision, hoặc thêm/xóa tuyến."""
+    revisions = _ROUTE_REVISIONS
+    fresh = (time.time() - _ROUTE_REVISIONS_LOADED_AT) < ROUTE_REVISION_TTL_SEC
+    if not fresh or not revisions:
+        revisions = _reload_route_revisions()
+    raw = ",".join(f"{rid}:{rev}" for rid, rev in sorted(revisions.items()))
+    return hashlib.sha1(raw.encode("ascii")).hexdigest()[:16]
+
+
+def route_conditional_response(tuyen_id, variant, build):
+    """
+    GET có điều kiện theo revision tuyến: ETag mạnh "<tuyến>-<revision>-<variant>".
+    If-None-Match khớp -> 304 rỗng trước khi chạy `build()`; ngược lại gắn ETag vào response 200.
+    """
+    rev = route_revision(tuyen_id)
+    if rev is None:
+        return build()  # tuyến không tồn tại -> để handler trả 404
+
+    etag = f"r{tuyen_id}-{rev}-{variant}"
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.make_response(build())
+        if resp.status_code != 200:
+            return resp
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"  # luôn hỏi lại server, nhưng thường chỉ nhận 304
+    return resp
+
+
+# ---- Worker nền: lấy legs OSRM ngoài request path ----
+_OSRM_QUEUE = queue.Queue()
+_OSRM_PENDING = set()
+_OSRM_LAST_ATTEMPT = {}
+_OSRM_WORKER = None
+_OSRM_WORKER_LOCK = threading.Lock()
+
+
+def _osrm_offsets_worker():
+    while True:
+        tuyen_id = _OSRM_QUEUE.get()
+        try:
+            with app.app_context():
+                tuyen = db.session.get(TuyenXe, tuyen_id)
+                if tuyen:
+                    written = rebuild_stop_offsets(tuyen, commit=False, allow_osrm=True)
+                    got_osrm = db.session.query(StopOffset.id).filter(
+                        StopOffset.tuyen_id == tuyen.maTuyen, StopOffset.source == "osrm",
+                    ).first()
+                    if written and got_osrm:
+                        bump_route_revision(tuyen.maTuyen)  # offset OSRM thay fallback
+                    db.session.commit()
+        except Exception as e:
+            print("osrm offsets worker warning:", e)
+        finally:
+            with _OSRM_WORKER_LOCK:
+                _OSRM_PENDING.discard(tuyen_id)
+            _OSRM_QUEUE.task_done()
+
+
+def schedule_osrm_offsets(tuyen_id, retry_now=False):
+    """
+    Xếp hàng tuyến cho worker nền tính offset bằng OSRM (không chặn request).
+    Bỏ qua nếu tuyến đang chờ, vừa thử gần đây (trừ `retry_now`: trạm vừa đổi), hoặc circuit breaker đang mở.
+    """
+    if not OSRM_BACKGROUND_OFFSETS or _OSRM_BREAKER.is_open:
+        return False
+
+    global _OSRM_WORKER
+    now_ts = time.time()
+    with _OSRM_WORKER_LOCK:
+        if tuyen_id in _OSRM_PENDING:
+            return False
+        last = None if retry_now else _OSRM_LAST_ATTEMPT.get(tuyen_id)
+        if last and (now_ts - last) < max(30, int(STOP_OFFSET_CACHE_TTL_SEC)):
+            return False
+        _OSRM_PENDING.add(tuyen_id)
+        _OSRM_LAST_ATTEMPT[tuyen_id] = now_ts
+
+        # Khởi động lười: mỗi process (gunicorn worker) có 1 thread riêng, tạo sau khi fork.
+        if _OSRM_WORKER is None or not _OSRM_WORKER.is_alive():
+            _OSRM_WORKER = threading.Thread(target=_osrm_offsets_worker, name="osrm-offsets", daemon=True)
+            _OSRM_WORKER.start()
+
+    _OSRM_QUEUE.put(tuyen_id)
+    return True
+
+
+def load_route_stops_with_offsets(tuyen):
+    """
+    1 truy vấn: mọi trạm của tuyến (cả 2 hướng) kèm offset đã lưu.
+    Trả về ({hướng: [TramDung]}, {hướng: offsets_data như _compute_stop_offsets hoặc None nếu chưa có offset}).
+    """
+    rows = (
+        TramDung.query
+        .filter(TramDung.tuyen_id == tuyen.maTuyen)
+        .outerjoin(
+            StopOffset,
+            (StopOffset.tuyen_id == TramDung.tuyen_id)
+            & (StopOffset.huong == TramDung.huongChuan)
+            & (StopOffset.tram_id == TramDung.maTram),
+        )
+        .add_entity(StopOffset)
+        .order_by(TramDung.huongChuan.asc(), TramDung.thuTuTrenTuyen.asc(), TramDung.maTram.asc())
+        .all()
+    )
+    stops_by_dir = {"DI": [], "VE": []}
+    offset_rows = {"DI": [], "VE": []}
+    for stop, off in rows:
+        d = stop.huongChuan or normalize_direction(stop.huong)
+        stops_by_dir[d].append(stop)
+        offset_rows[d].append((stop, off))
+
+    offsets_by_dir = {}
+    for d, pairs in offset_rows.items():
+        coord_count = sum(1 for (s, _) in pairs if s.lat is not None and s.lng is not None)
+        if coord_count < 2:
+            offsets_by_dir[d] = {"ok": False, "error": "Tuyến chưa đủ 2 trạm có tọa độ.", "items": []}
+        elif not any(o is not None for (_, o) in pairs):
+            offsets_by_dir[d] = None  # chưa materialize -> RouteContext.offsets tính trong bộ nhớ
+        else:
+            offsets_by_dir[d] = {
+                "ok": True,
+                "source": next((o.source for (_, o) in pairs if o is not None), None),
+                "offsets": {s.maTram: o.offset_s for (s, o) in pairs if o is not None},
+                "dist_m": {s.maTram: o.dist_m for (s, o) in pairs if o is not None},
+                "items": [s for (s, _) in pairs],
+            }
+    return stops_by_dir, offsets_by_dir
+
+
+# ---- Ngữ cảnh tuyến trong 1 request ----
+# Trạm 2 hướng + offset (1 truy vấn), khung giờ, headway, giờ xuất bến: tính 1 lần rồi dùng chung cho
+# offset / lịch xuất bến / ETA / bảng giờ trạm, thay vì mỗi helper tự query + parse lại.
+
+class RouteContext:
+    def __init__(self, tuyen):
+        self.tuyen = tuyen
+        self.stops_by_dir, self._offsets = load_route_stops_with_offsets(tuyen)
+        self.dirs_with_stops = [d for d in ("DI", "VE") if self.stops_by_dir[d]]
+        self.window = _parse_operating_window_minutes(tuyen.thoiGianHoatDong)
+
+        # nếu chỉ có 1 hướng dữ liệu, vẫn hiểu tuyến 2 chiều để suy ra headway từ "số chuyến/ngày"
+        dirs_count = 2 if len(self.dirs_with_stops) == 1 else max(1, len(self.dirs_with_stops))
+        self.headway_min = (
+            _compute_headway_minutes(tuyen, self.window[1] - self.window[0], dirs_count=dirs_count)
+            if self.window else None
+        )
+        self._departure_minutes = None
+        self._departures = {}
+        self._osrm_requested = False
+
+    def stops(self, dir_):
+        """Trạm của 1 hướng theo thứ tự trên tuyến."""
+        return self.stops_by_dir[normalize_direction(dir_)]
+
+    def offsets(self, dir_):
+        """
+        Offset trạm 1 hướng (dạng dict như `_compute_stop_offsets`).
+        Chưa có dòng `stop_offset` (DB cũ / chưa rebuild) -> chỉ tính trong bộ nhớ, không ghi DB trên request đọc
+        (lưu ở bootstrap, seed trạm, admin sửa trạm và worker OSRM nền).
+        Nguồn vẫn là fallback -> nhờ worker nền thử OSRM (1 lần/request).
+        """
+        d = normalize_direction(dir_)
+        data = self._offsets.get(d)
+        if data is None:
+            data = self._offsets[d] = _compute_stop_offsets(self.tuyen, d)
+        if data.get("ok") and data.get("source") != "osrm" and not self._osrm_requested:
+            self._osrm_requested = True
+            schedule_osrm_offsets(self.tuyen.maTuyen)
+        return data
+
+    @property
+    def departure_minutes(self):
+        """Giờ xuất bến (phút trong ngày) theo khung giờ + headway; [] nếu thiếu dữ liệu."""
+        if self._departure_minutes is None:
+            if self.window and self.headway_min and self.dirs_with_stops:
+                start_min, end_min = self.window
+                self._departure_minutes = list(range(start_min, end_min + 1, self.headway_min))
+            else:
+                self._departure_minutes = []
+        return self._departure_minutes
+
+    def departures(self, day, dir_):
+        """Chuyến xuất bến cả ngày của 1 hướng (lịch tần suất + ngoại lệ ChuyenXe); 1 lần đọc/ngày cho 2 hướng."""
+        if day not in self._departures:
+            self._departures[day] = timetable_departures(self.tuyen, day, ctx=self)
+        d = normalize_direction(dir_)
+        return [dep for dep in self._departures[day] if dep["direction"] == d]
+
+
+def route_context(tuyen):
+    """RouteContext của tuyến, tạo 1 lần cho mỗi request (memo trên `g`, bỏ khi revision tuyến đổi)."""
+    cache = g.setdefault("route_contexts", {})
+    ctx = cache.get(tuyen.maTuyen)
+    if ctx is None:
+        ctx = cache[tuyen.maTuyen] = RouteContext(tuyen)
+    return ctx
+
+
+@app.cli.command("osrm-offsets")
+def osrm_offsets_command():
+    """Tính lại offset trạm bằng OSRM cho mọi tuyến (chạy tay hoặc cron)."""
+    for tuyen in TuyenXe.query.order_by(TuyenXe.maTuyen).all():
+        n = rebuild_stop_offsets(tuyen, allow_osrm=True, force=True, schedule_osrm=False)
+        print(f"[OK] route={tuyen.maHienThi} rows={n}")
+
+
+# ---- ETA nhiều chuyến: ma trận (chuyến xuất bến × trạm) ----
+# Giờ tới trạm = giờ xuất bến + offset trạm -> cả ma trận là 1 phép cộng ngoài (outer add) của 2 dãy giây.
+# Tính bằng vector numpy; môi trường thiếu numpy thì lùi về Python thuần (cùng kết quả).
+
+ETA_MAX_ARRIVALS = 5
+_HHMM_BY_MINUTE = [f"{(m // 60) % 24:02d}:{m % 60:02d}" for m in range(48 * 60)]
+
+
+def arrival_matrix(dep_s, off_s):
+    """Giờ tới trạm (giây trong ngày): hàng i = chuyến dep_s[i], cột j = trạm off_s[j]."""
+    if np is not None:
+        return np.add.outer(np.asarray(dep_s, dtype=float), np.asarray(off_s, dtype=float))
+    return [[d + o for o in off_s] for d in dep_s]
+
+
+def next_arrival_indices(dep_s, off_s, at_s, n):
+    """
+    Với mỗi trạm j: chỉ số `n` chuyến đầu tiên có dep_s[i] + off_s[j] >= at_s (dep_s sắp tăng dần).
+    Trả về list (trạm × n) chỉ số chuyến; -1 nếu hết chuyến trong ngày.
+    """
+    count = len(dep_s)
+    if np is not None:
+        first = np.searchsorted(np.asarray(dep_s, dtype=float), at_s - np.asarray(off_s, dtype=float), side="left")
+        idx = first[:, None] + np.arange(n)
+        return np.where(idx < count, idx, -1).tolist()
+    out = []
+    for o in off_s:
+        k = bisect_left(dep_s, at_s - o)
+        out.append([i if i < count else -1 for i in range(k, k + n)])
+    return out
+
+
+def _departure_seconds(deps, day_start):
+    return [(dep["dt"] - day_start).total_seconds() for dep in deps]
+
+
+def compute_next_stop_etas(ctx, dir_, at=None, n=1):
+    """
+    ETA tại mọi trạm của 1 hướng: `n` chuyến sắp tới (1..ETA_MAX_ARRIVALS) tính từ `at`.
+    Chuyến trong ngày lấy từ lịch xuất bến (đã áp ngoại lệ THEM/HUY/DOI_GIO); n > 1 -> mỗi trạm có thêm `arrivals`.
+    """
+    tuyen = ctx.tuyen
+    at = at or datetime.now()
+    n = max(1, min(int(n or 1), ETA_MAX_ARRIVALS))
+    if not ctx.window:
+        return {"ok": False, "error": "Tuyến chưa có khung giờ hoạt động (thoiGianHoatDong).", "items": []}
+
+    headway_min = ctx.headway_min
     if not headway_min:
         return {"ok": False, "error": "Tuyến chưa có tần suất hoặc số chuyến/ngày hợp lệ.", "items": []}
 
-    offsets_data = get_stop_offsets(tuyen, dir_)
+    offsets_data = ctx.offsets(dir_)
     if not offsets_data.get("ok"):
         return {"ok": False, "error": offsets_data.get("error") or "Không tính được offset trạm.", "items": []}
 
     base = datetime.combine(at.date(), datetime.min.time())
-    at_s = int((at - base).total_seconds())
-
-    start_s = int(start_min * 60)
-    end_s = int(end_min * 60)
-    headway_s = int(headway_min * 60)
+    at_s = (at - base).total_seconds()
+    deps = ctx.departures(at.date(), dir_)
+    dep_s = _departure_seconds(deps, base)
+
+    stops = offsets_data.get("items") or []
+    offsets = offsets_data.get("offsets") or {}
+    timed = [s for s in stops if offsets.get(s.maTram) is not None]
+    next_idx = dict(zip(
+        (s.maTram for s in timed),
+        next_arrival_indices(dep_s, [float(offsets[s.maTram]) for s in timed], at_s, n),
+    ))
 
     out_items = []
-    for s in offsets_data.get("items") or []:
-        offset_s = offsets_data["offsets"].get(s.maTram)
+    for s in stops:
+        offset_s = offsets.get(s.maTram)
         dist_m = offsets_data.get("dist_m", {}).get(s.maTram)
 
-        eta_iso = None
-        eta_hhmm = None
-        eta_in_min = None
-
-        if offset_s is not None:
-            target_depart_s = max(start_s, at_s - int(round(float(offset_s))))
-            k = _ceil_div_int(max(0, target_depart_s - start_s), headway_s)
-            depart_s = start_s + k * headway_s
-            if depart_s <= end_s:
-                eta_dt = base + timedelta(seconds=(depart_s + float(offset_s)))
-                eta_iso = eta_dt.isoformat(timespec="seconds")
-                eta_hhmm = eta_dt.strftime("%H:%M")
-                eta_in_min = int(round((eta_dt - at).total_seconds() / 60.0))
-
-        out_items.append({
+        arrivals = []
+        for i in next_idx.get(s.maTram, ()):
+            if i < 0:
+                break
+            eta_dt = base + timedelta(seconds=dep_s[i] + float(offset_s))
+            arrivals.append({
+                "trip_id": deps[i]["trip_id"],
+                "depart_time": deps[i]["time"],
+                "eta_iso": eta_dt.isoformat(timespec="seconds"),
+                "eta_time": eta_dt.strftime("%H:%M"),
+                "eta_in_min": int(round((eta_dt - at).total_seconds() / 60.0)),
+            })
+        first = arrivals[0] if arrivals else {}
+
+        item = {
             "stop_id": s.maTram,
             "order": s.thuTuTrenTuyen,
             "name": s.tenTram,
@@ -788,10 +1933,13 @@ def compute_next_stop_etas(tuyen, dir_, at=None):
             "lng": float(s.lng) if s.lng is not None else None,
             "offset_s": float(offset_s) if offset_s is not None else None,
             "distance_m": float(dist_m) if dist_m is not None else None,
-            "eta_iso": eta_iso,
-            "eta_time": eta_hhmm,
-            "eta_in_min": eta_in_min,
-        })
+            "eta_iso": first.get("eta_iso"),
+            "eta_time": first.get("eta_time"),
+            "eta_in_min": first.get("eta_in_min"),
+        }
+        if n > 1:
+            item["arrivals"] = arrivals
+        out_items.append(item)
 
     return {
         "ok": True,
@@ -806,21 +1954,411 @@ def compute_next_stop_etas(tuyen, dir_, at=None):
     }
 
 
-@app.context_processor
-def inject_user():
-    def static_url(filename: str):
-        safe_name = filename.lstrip("/\\")
-        file_path = os.path.join(app.root_path, "static", safe_name)
+def build_stop_timetable(ctx, dir_, day):
+    """Bảng giờ in cả ngày: mọi giờ tới (HH:MM) của mọi chuyến tại từng trạm của 1 hướng."""
+    tuyen = ctx.tuyen
+    offsets_data = ctx.offsets(dir_)
+    if not offsets_data.get("ok"):
+        return {"ok": False, "error": offsets_data.get("error") or "Không tính được offset trạm.", "items": []}
+
+    base = datetime.combine(day, datetime.min.time())
+    deps = ctx.departures(day, dir_)
+    stops = offsets_data.get("items") or []
+    offsets = offsets_data.get("offsets") or {}
+    timed = [s for s in stops if offsets.get(s.maTram) is not None]
+
+    # ma trận (chuyến × trạm) -> phút trong ngày, chuyển vị thành từng cột trạm
+    matrix = arrival_matrix(_departure_seconds(deps, base), [float(offsets[s.maTram]) for s in timed])
+    if np is not None:
+        columns = (matrix // 60).astype(int).T.tolist()
+    else:
+        columns = [[int(row[j] // 60) for row in matrix] for j in range(len(timed))]
+    times = {s.maTram: [_HHMM_BY_MINUTE[m] for m in col] for s, col in zip(timed, columns)}
+
+    return {
+        "ok": True,
+        "route_id": tuyen.maTuyen,
+        "route_code": tuyen.maHienThi,
+        "direction": normalize_direction(dir_),
+        "date": day.isoformat(),
+        "operating_hours": tuyen.thoiGianHoatDong,
+        "offset_source": offsets_data.get("source"),
+        "departures": [dep["time"] for dep in deps],
+        "items": [
+            {
+                "stop_id": s.maTram,
+                "order": s.thuTuTrenTuyen,
+                "name": s.tenTram,
+                "times": times.get(s.maTram, []),
+            }
+            for s in stops
+        ],
+    }
+
+
+# ==================== STATIC ASSET (hash nội dung + nén sẵn) ====================
+# `flask --app app build-assets` sinh static/dist/: file tên kèm hash nội dung, bản .gz (và .br nếu có
+# module brotli), cùng manifest.json {tên gốc -> tên có hash}. Trang dùng static_url() -> /assets/<tên hash>
+# với Cache-Control immutable. Chưa build (dev) -> /static/<tên>?v=<mtime> (mtime đọc 1 lần/process).
+
+ASSET_DIST_DIR = os.path.join(BASE_DIR, "static", "dist")
+ASSET_MANIFEST_PATH = os.path.join(ASSET_DIST_DIR, "manifest.json")
+ASSET_COMPRESSIBLE_EXT = {".css", ".js", ".svg", ".json", ".txt", ".html", ".map"}
+
+_ASSET_MANIFEST = None
+_ASSET_MTIME_CACHE = {}  # file static -> (thời điểm stat, mtime)
+
+
+def load_asset_manifest():
+    global _ASSET_MANIFEST
+    if _ASSET_MANIFEST is None:
+        try:
+            with open(ASSET_MANIFEST_PATH, encoding="utf-8") as f:
+                _ASSET_MANIFEST = json.load(f)
+        except (OSError, ValueError):
+            _ASSET_MANIFEST = {}
+    return _ASSET_MANIFEST
+
+
+def static_url(filename: str):
+    safe_name = filename.lstrip("/\\")
+    hashed = load_asset_manifest().get(safe_name)
+    if hashed:
+        return url_for("hashed_asset", filename=hashed)
+
+    # chưa build: ?v=mtime; stat lại sau STATIC_MTIME_TTL_SEC (debug: mỗi lần) để sửa file là đổi URL
+    now = time.time()
+    hit = None if app.debug else _ASSET_MTIME_CACHE.get(safe_name)
+    if hit and (now - hit[0]) < STATIC_MTIME_TTL_SEC:
+        version = hit[1]
+    else:
         try:
-            version = int(os.path.getmtime(file_path))
+            version = int(os.path.getmtime(os.path.join(app.root_path, "static", safe_name)))
         except OSError:
-            version = int(time.time())
+            version = 0  # file thiếu: giữ URL ổn định (không phá cache trình duyệt mỗi request)
+        _ASSET_MTIME_CACHE[safe_name] = (now, version)
+    if not version:
+        return url_for("static", filename=safe_name)
+    return url_for("static", filename=safe_name, v=version)
+
+
+def build_asset_bundle(static_dir=None, dist_dir=ASSET_DIST_DIR):
+    """Sinh static/dist/ (file có hash + .gz/.br) và manifest.json. Trả về manifest."""
+    static_dir = static_dir or os.path.join(BASE_DIR, "static")
+    try:
+        import brotli  # tuỳ chọn
+    except ImportError:
+        brotli = None
+
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root).startswith(os.path.abspath(dist_dir)):
+            continue
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != os.path.abspath(dist_dir)]
+        for name in sorted(files):
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, static_dir).replace(os.sep, "/")
+            with open(src, "rb") as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            stem, ext = os.path.splitext(rel)
+            hashed = f"{stem}.{digest}{ext}"
+            out = os.path.join(dist_dir, hashed)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, "wb") as f:
+                f.write(data)
+            if ext.lower() in ASSET_COMPRESSIBLE_EXT:
+                with open(out + ".gz", "wb") as f:
+                    f.write(gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(out + ".br", "wb") as f:
+                        f.write(brotli.compress(data))
+            manifest[rel] = hashed
+
+    with open(os.path.join(dist_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Sinh static/dist (hash nội dung, .gz/.br) + manifest.json; chạy ở bước build khi deploy."""
+    manifest = build_asset_bundle()
+    print(f"[OK] assets={len(manifest)} -> {ASSET_DIST_DIR}")
+
+
+@app.route("/assets/<path:filename>")
+def hashed_asset(filename):
+    # Tên file có hash nội dung -> không bao giờ đổi nội dung: cache vĩnh viễn
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encodings = request.accept_encodings
+    resp = None
+    for enc, suffix in (("br", ".br"), ("gzip", ".gz")):
+        compressed = safe_join(ASSET_DIST_DIR, filename + suffix)
+        if encodings[enc] and compressed and os.path.isfile(compressed):
+            resp = send_from_directory(ASSET_DIST_DIR, filename + suffix, mimetype=mimetype)
+            resp.headers["Content-Encoding"] = enc
+            break
+    if resp is None:
+        resp = send_from_directory(ASSET_DIST_DIR, filename, mimetype=mimetype)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
 
-        return url_for("static", filename=safe_name, v=version)
 
+@app.context_processor
+def inject_user():
     return dict(user=current_user(), static_url=static_url)
 
 
+# ==================== SOÁT THẺ (INDEX TRONG BỘ NHỚ) ====================
+# Soát thẻ lúc lên xe không đọc bảng thẻ: mỗi process giữ dict {mã thẻ chuẩn hoá -> CardEntry}.
+# - Thay đổi thẻ trong process này (admin_cards, đăng ký) được áp dụng ngay sau commit (mapper/session event).
+# - Thay đổi từ worker khác: trước khi soát (tối đa 1 lần / CARD_INDEX_SYNC_SEC giây) đọc bộ đếm
+#   card_version_counter; tăng -> chỉ đọc thẻ/bia mộ có phienBan mới hơn và áp vào index (không nạp lại toàn bộ).
+
+CardEntry = namedtuple("CardEntry", "card_id customer_id code status paid start_ord end_ord version")
+
+
+def normalize_card_code(raw):
+    # Máy soát vé có thể gửi mã dạng số ({"code": 12345}) -> ép về chuỗi thay vì lỗi 500 cả lô
+    return ("" if raw is None else str(raw)).strip().upper()
+
+
+def _date_ordinal(raw):
+    try:
+        return datetime.strptime(str(raw), "%Y-%m-%d").date().toordinal()
+    except Exception:
+        return None
+
+
+def _card_entry(card_id, customer_id, code, status, payment_status, start, end, version):
+    return CardEntry(
+        card_id=card_id,
+        customer_id=customer_id,
+        code=code,
+        status=(status or "").upper(),
+        paid=(payment_status or "").upper() == "DA_THANH_TOAN",
+        start_ord=_date_ordinal(start),
+        end_ord=_date_ordinal(end),
+        version=version or 0,
+    )
+
+
+def card_entry_verdict(entry, day):
+    """(valid, start, end) của thẻ tại ngày `day`; thiếu ngày bắt đầu/hết hạn -> coi như `day` (như trước)."""
+    today_ord = day.toordinal()
+    start_ord = entry.start_ord if entry.start_ord is not None else today_ord
+    end_ord = entry.end_ord if entry.end_ord is not None else today_ord
+    valid = entry.status == "KICH_HOAT" and entry.paid and start_ord <= today_ord <= end_ord
+    return valid, start_ord, end_ord
+
+
+_CARD_ROW_COLUMNS = (
+    TheTu.maThe, TheTu.khach_hang_id, TheTu.maSoThe, TheTu.trangThai,
+    TheTu.payment_status, TheTu.ngayBatDau, TheTu.ngayHetHan, TheTu.phienBan,
+)
+
+
+class _CardIndex:
+    def __init__(self, sync_sec):
+        self.sync_sec = sync_sec
+        self._lock = threading.Lock()       # _by_code/_code_by_card (ghi); đọc không cần khoá vì dict được thay nguyên
+        self._sync_lock = threading.Lock()  # chỉ 1 luồng nạp/đồng bộ với DB
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._by_code = {}
+            self._code_by_card = {}  # card_id -> mã chuẩn hoá (đổi mã thẻ -> gỡ mã cũ)
+            self._version = None     # phiên bản thẻ đã áp dụng (None = chưa nạp)
+            self._synced_at = 0.0
+
+    @staticmethod
+    def _apply_changes(by_code, code_by_card, changes):
+        # changes: [(version, entry | None, code)] theo thứ tự version; entry None = thẻ đã xoá (bia mộ)
+        for version, entry, code in changes:
+            current = by_code.get(code)
+            if current is not None and current.version > version:
+                continue  # đã có bản mới hơn (áp từ commit cục bộ trong lúc đang đọc delta)
+            if entry is None:
+                if current is not None:
+                    del by_code[code]
+                    code_by_card.pop(current.card_id, None)
+                continue
+            old_code = code_by_card.get(entry.card_id)
+            if old_code and old_code != code:
+                old = by_code.get(old_code)
+                if old is not None and old.card_id == entry.card_id and old.version <= version:
+                    del by_code[old_code]
+            if code:
+                by_code[code] = entry
+                code_by_card[entry.card_id] = code
+            else:
+                code_by_card.pop(entry.card_id, None)
+
+    def _commit_changes(self, changes, version=None):
+        with self._lock:
+            if self._version is None:
+                return  # chưa nạp lần đầu: lần nạp đó (hoặc lần đồng bộ kế tiếp) sẽ thấy thay đổi
+            by_code = dict(self._by_code)
+            code_by_card = dict(self._code_by_card)
+            self._apply_changes(by_code, code_by_card, sorted(changes, key=lambda c: c[0]))
+            # thay nguyên dict (atomic): luồng soát thẻ không bao giờ thấy index dở dang
+            self._by_code, self._code_by_card = by_code, code_by_card
+            if version is not None:
+                self._version = max(self._version, version)
+
+    def _load(self):
+        # đọc bộ đếm trước: thay đổi commit sau đó có version lớn hơn -> lần đồng bộ kế tiếp sẽ đọc lại
+        version = current_card_version()
+        by_code, code_by_card = {}, {}
+        for card_id, customer_id, raw_code, status, pay, start, end, ver in db.session.query(*_CARD_ROW_COLUMNS):
+            code = normalize_card_code(raw_code)
+            if code:
+                by_code[code] = _card_entry(card_id, customer_id, raw_code, status, pay, start, end, ver)
+                code_by_card[card_id] = code
+        with self._lock:
+            self._by_code, self._code_by_card = by_code, code_by_card
+            self._version = version
+            self._synced_at = time.time()
+
+    def _sync(self):
+        since = self._version
+        version = current_card_version()
+        if version <= since:
+            return
+        changes = [
+            (ver or 0, _card_entry(card_id, customer_id, raw_code, status, pay, start, end, ver),
+             normalize_card_code(raw_code))
+            for card_id, customer_id, raw_code, status, pay, start, end, ver
+            in db.session.query(*_CARD_ROW_COLUMNS).filter(TheTu.phienBan > since)
+        ]
+        changes += [
+            (ver, None, normalize_card_code(raw_code))
+            for raw_code, ver in db.session.query(TheTuDaXoa.maSoThe, TheTuDaXoa.phienBan)
+            .filter(TheTuDaXoa.phienBan > since)
+        ]
+        self._commit_changes(changes, version=version)
+
+    def ensure_fresh(self):
+        if self._version is not None and (time.time() - self._synced_at) < self.sync_sec:
+            return
+        with self._sync_lock:
+            if self._version is None:
+                self._load()
+                return
+            started = time.time()
+            if (started - self._synced_at) < self.sync_sec:
+                return  # luồng khác vừa đồng bộ xong
+            try:
+                self._sync()
+            except Exception as e:
+                # DB lỗi tạm thời: vẫn soát bằng index hiện có, thử lại ở lần sau
+                print("card index sync warning:", e)
+            self._synced_at = started
+
+    def get(self, code):
+        self.ensure_fresh()
+        return self._by_code.get(normalize_card_code(code))
+
+    def get_many(self, codes):
+        self.ensure_fresh()
+        by_code = self._by_code
+        return {c: by_code.get(c) for c in codes}
+
+    def apply(self, upserts, removals):
+        """Thay đổi đã commit trong process này: upserts [CardEntry], removals [(mã, version bia mộ)]."""
+        changes = [(e.version, e, normalize_card_code(e.code)) for e in upserts]
+        changes += [(version, None, code) for code, version in removals]
+        self._commit_changes(changes)
+
+
+CARD_INDEX = _CardIndex(CARD_INDEX_SYNC_SEC)
+
+
+def _max_card_version(connection):
+    row = connection.execute(text(
+        'SELECT COALESCE((SELECT MAX("phienBan") FROM the_tu), 0),'
+        ' COALESCE((SELECT MAX("phienBan") FROM the_tu_da_xoa), 0)'
+    )).first()
+    return max(row[0], row[1])
+
+
+def _next_card_version(connection):
+    # Cùng transaction với thay đổi. UPDATE giữ khoá dòng bộ đếm tới khi commit -> transaction ghi thẻ
+    # sau phải chờ, nên version cấp ra commit đúng thứ tự: delta `phienBan > since` không bỏ sót thay đổi
+    bumped = connection.execute(text("UPDATE card_version_counter SET value = value + 1 WHERE id = 1"))
+    if bumped.rowcount == 0:
+        # DB chưa có dòng bộ đếm (create_all mà chưa migrate): khởi tạo từ MAX hiện có
+        connection.execute(
+            text("INSERT INTO card_version_counter (id, value) VALUES (1, :v)"),
+            {"v": _max_card_version(connection) + 1},
+        )
+    return connection.execute(text("SELECT value FROM card_version_counter WHERE id = 1")).scalar()
+
+
+@event.listens_for(TheTu, "before_insert")
+@event.listens_for(TheTu, "before_update")
+def _bump_card_version(mapper, connection, target):
+    target.phienBan = _next_card_version(connection)
+
+
+@event.listens_for(TheTu, "before_update")
+def _record_renamed_card_tombstone(mapper, connection, target):
+    # đổi mã thẻ: delta phải gỡ mã cũ khỏi máy soát vé (dòng thẻ chỉ còn mã mới)
+    hist = sa_inspect(target).attrs.maSoThe.history
+    old_code = normalize_card_code(hist.deleted[0]) if hist.deleted else ""
+    if old_code and old_code != normalize_card_code(target.maSoThe):
+        connection.execute(TheTuDaXoa.__table__.insert().values(
+            maSoThe=hist.deleted[0],
+            phienBan=_next_card_version(connection),
+            thoiGianXoa=datetime.utcnow().isoformat(timespec="seconds"),
+        ))
+
+
+@event.listens_for(TheTu, "after_delete")
+def _record_card_tombstone(mapper, connection, target):
+    version = _next_card_version(connection)
+    connection.execute(TheTuDaXoa.__table__.insert().values(
+        maSoThe=target.maSoThe,
+        phienBan=version,
+        thoiGianXoa=datetime.utcnow().isoformat(timespec="seconds"),
+    ))
+    sess = sa_object_session(target)
+    if sess is not None:
+        sess.info.setdefault("card_removals", []).append((normalize_card_code(target.maSoThe), version))
+
+
+@event.listens_for(TheTu, "after_insert")
+@event.listens_for(TheTu, "after_update")
+def _track_card_upsert(mapper, connection, target):
+    sess = sa_object_session(target)
+    if sess is None:
+        return
+    entry = _card_entry(
+        target.maThe, target.khach_hang_id, target.maSoThe, target.trangThai,
+        target.payment_status, target.ngayBatDau, target.ngayHetHan, target.phienBan,
+    )
+    sess.info.setdefault("card_upserts", []).append(entry)
+
+
+@event.listens_for(db.session, "after_commit")
+def _apply_card_changes(sess):
+    upserts = sess.info.pop("card_upserts", None)
+    removals = sess.info.pop("card_removals", None)
+    if upserts or removals:
+        CARD_INDEX.apply(upserts or [], removals or [])
+
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_card_changes(sess):
+    sess.info.pop("card_upserts", None)
+    sess.info.pop("card_removals", None)
+
+
 # ==================== TRANG CHÍNH ====================
 
 @app.route("/")
@@ -940,49 +2478,24 @@ def routes():
     # /routes là dashboard thao tác
     danh_sach_tuyen = TuyenXe.query.order_by(TuyenXe.maTuyen).all()
     initial_route_id = danh_sach_tuyen[0].maTuyen if danh_sach_tuyen else None
+    stats = route_stop_stats([r.maTuyen for r in danh_sach_tuyen])
+    route_status = {
+        r.maTuyen: build_route_summary(r, dir_stats=stats[r.maTuyen])["data_status"]
+        for r in danh_sach_tuyen
+    }
     return render_template(
         "routes.html",
         routes=danh_sach_tuyen,
         initial_route_id=initial_route_id,
+        route_status=route_status,
     )
 
 @app.route("/routes/<int:tuyen_id>")
 def route_detail(tuyen_id):
     tuyen = TuyenXe.query.get_or_404(tuyen_id)
 
-    now = datetime.now()
-    ensure_upcoming_trips(tuyen, now=now)
-
-    today = now.strftime("%Y-%m-%d")
-    now_min = now.hour * 60 + now.minute
-
-    def _to_min(hhmm):
-        m = re.match(r"^\s*(\d{1,2})\s*:\s*(\d{2})\s*$", str(hhmm or ""))
-        if not m:
-            return None
-        h = int(m.group(1))
-        mi = int(m.group(2))
-        if h < 0 or h > 23 or mi < 0 or mi > 59:
-            return None
-        return h * 60 + mi
-
-    all_today = (
-        ChuyenXe.query
-        .filter(ChuyenXe.tuyen_id == tuyen_id, ChuyenXe.ngayKhoiHanh == today)
-        .order_by(ChuyenXe.gioKhoiHanh.asc(), ChuyenXe.huong.asc(), ChuyenXe.maChuyen.asc())
-        .all()
-    )
-
     # chỉ lấy chuyến sắp tới (giữ gọn UI) – bus đô thị thường hiển thị upcoming departures
-    trips = []
-    for t in all_today:
-        t_min = _to_min(t.gioKhoiHanh)
-        if t_min is None:
-            continue
-        if t_min >= now_min - 5:
-            trips.append(t)
-        if len(trips) >= 12:
-            break
+    trips = upcoming_departures(tuyen, now=datetime.now(), grace_min=5, limit=12)
 
     return render_template(
         "route_detail.html",
@@ -991,11 +2504,8 @@ def route_detail(tuyen_id):
     )
 
 
-@app.route("/trips/<int:trip_id>")
-def trip_detail(trip_id):
+def _render_trip_detail(trip, tuyen):
     user = current_user()
-    trip = ChuyenXe.query.get_or_404(trip_id)
-    tuyen = trip.tuyen  # quan hệ backref từ TuyenXe -> ChuyenXe
 
     # nếu URL có ?mode=admin thì hiểu là xem từ trang admin
     is_admin_mode = request.args.get("mode") == "admin"
@@ -1005,7 +2515,8 @@ def trip_detail(trip_id):
     direction = normalize_direction(getattr(trip, "huong", None))
 
     # lấy trạm theo hướng để hiển thị lộ trình + map (bus đô thị: tách DI/VE)
-    danh_sach_tram = _query_stops_by_direction(tuyen, direction).all()
+    ctx = route_context(tuyen)
+    danh_sach_tram = ctx.stops(direction)
     stops_geo = build_stops_geo(danh_sach_tram, route_code=tuyen.maHienThi)
 
     trip_dt = None
@@ -1019,7 +2530,7 @@ def trip_detail(trip_id):
     offset_source = None
     if trip_dt and danh_sach_tram:
         try:
-            offsets_data = get_stop_offsets(tuyen, direction)
+            offsets_data = ctx.offsets(direction)
             if offsets_data.get("ok"):
                 offsets = offsets_data.get("offsets") or {}
                 dist_m = offsets_data.get("dist_m") or {}
@@ -1058,39 +2569,87 @@ def trip_detail(trip_id):
     )
 
 
-@app.route("/stops/<int:stop_id>")
-def stop_detail(stop_id):
+@app.route("/trips/<int:trip_id>")
+def trip_detail(trip_id):
+    trip = ChuyenXe.query.get_or_404(trip_id)
+    tuyen = trip.tuyen  # quan hệ backref từ TuyenXe -> ChuyenXe
+    return _render_trip_detail(trip, tuyen)
+
+
+@app.route("/routes/<int:tuyen_id>/departures/<date_str>/<dir_>/<hhmm>")
+def departure_detail(tuyen_id, date_str, dir_, hhmm):
+    """Chi tiết chuyến tính từ lịch tần suất (không có dòng ChuyenXe)."""
+    tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    try:
+        day = datetime.strptime(date_str, "%Y-%m-%d").date()
+    except ValueError:
+        abort(404)
+    if not re.match(r"^\d{4}$", hhmm or ""):
+        abort(404)
+    time_str = f"{hhmm[:2]}:{hhmm[2:]}"
+    direction = normalize_direction(dir_)
+
+    at = _parse_departure_at(date_str, time_str)
+    if at is None:
+        abort(404)
+    for dep in timetable_departures(tuyen, day, dirs=(direction,), from_dt=at, to_dt=at):
+        if dep["time"] != time_str:
+            continue
+        if dep["trip_id"]:
+            return redirect(url_for("trip_detail", trip_id=dep["trip_id"], **request.args))
+        trip = VirtualTrip(None, tuyen.maTuyen, date_str, time_str, direction)
+        return _render_trip_detail(trip, tuyen)
+    abort(404)
+
+
+def stop_departure_board(stop, now, limit=20, ctx=None):
     """
-    Chi tiết trạm (public):
-    - Hiển thị thông tin trạm (thuộc tuyến + hướng DI/VE)
-    - Liệt kê các chuyến sắp tới sẽ đi qua trạm (ETA ước tính theo offset trạm)
+    Các chuyến sắp tới đi qua trạm (ETA = giờ xuất bến + offset trạm).
+    Trả về (items, offset_s); offset_s None nếu chưa tính được offset cho trạm.
     """
-    stop = TramDung.query.get_or_404(stop_id)
     tuyen = stop.tuyen
+    ctx = ctx or route_context(tuyen)
     direction = normalize_direction(getattr(stop, "huong", None))
 
-    now = datetime.now()
-
-    # backfill để không bỏ sót chuyến đã xuất bến nhưng chưa tới trạm
-    offsets_data = get_stop_offsets(tuyen, direction)
+    # lọc theo ETA tại trạm để không bỏ sót chuyến đã xuất bến nhưng chưa tới trạm
+    offsets_data = ctx.offsets(direction)
     offset_s = None
     if offsets_data.get("ok"):
         offset_s = offsets_data.get("offsets", {}).get(stop.maTram)
 
-    backfill_min = 30
-    try:
-        if offset_s is not None:
-            backfill_min = max(30, min(180, int(math.ceil(float(offset_s) / 60.0)) + 5))
-    except Exception:
-        backfill_min = 30
-
-    ensure_upcoming_trips(
-        tuyen,
-        now=(now - timedelta(minutes=backfill_min)),
-        horizon_min=(backfill_min + BUS_SCHEDULE_HORIZON_MIN),
+    items = []
+    # Nếu không có offset, fallback lọc theo giờ xuất bến (ít ý nghĩa với trạm giữa tuyến)
+    deps = upcoming_departures(
+        tuyen, now=now, dirs=(direction,), offset_s=offset_s or 0.0, grace_min=1, limit=limit, ctx=ctx,
     )
+    for dep in deps:
+        ref_dt = dep["dt"] + timedelta(seconds=float(offset_s or 0.0))
+        eta_in_min = int(round((ref_dt - now).total_seconds() / 60.0))
+        eta_in_min = max(0, eta_in_min)
+
+        items.append({
+            "trip_id": dep["trip_id"],
+            "date": dep["date"],
+            "depart_time": dep["time"],
+            "direction": direction,
+            "eta_time": ref_dt.strftime("%H:%M"),
+            "eta_iso": ref_dt.isoformat(timespec="seconds"),
+            "eta_in_min": eta_in_min,
+            "detail_url": departure_detail_url(dep),
+        })
+    return items, offset_s
 
-    today = now.strftime("%Y-%m-%d")
+
+@app.route("/stops/<int:stop_id>")
+def stop_detail(stop_id):
+    """
+    Chi tiết trạm (public):
+    - Hiển thị thông tin trạm (thuộc tuyến + hướng DI/VE)
+    - Liệt kê các chuyến sắp tới sẽ đi qua trạm (ETA ước tính theo offset trạm)
+    """
+    stop = TramDung.query.get_or_404(stop_id)
+    tuyen = stop.tuyen
+    direction = normalize_direction(getattr(stop, "huong", None))
 
     try:
         limit = int(request.args.get("limit") or 20)
@@ -1098,84 +2657,506 @@ def stop_detail(stop_id):
         limit = 20
     limit = max(5, min(limit, 60))
 
-    upcoming = []
-    trips = (
-        ChuyenXe.query
-        .filter(
-            ChuyenXe.tuyen_id == tuyen.maTuyen,
-            ChuyenXe.ngayKhoiHanh == today,
-            ChuyenXe.huong == direction,
-        )
-        .order_by(ChuyenXe.gioKhoiHanh.asc(), ChuyenXe.maChuyen.asc())
-        .all()
+    ctx = route_context(tuyen)
+    offsets_data = ctx.offsets(direction)
+    offset_s = offsets_data.get("offsets", {}).get(stop.maTram) if offsets_data.get("ok") else None
+    now = datetime.now()
+
+    # trạm vật lý có nhiều tuyến/hướng dừng -> bảng giờ gộp mọi tuyến
+    physical = physical_stop_for(stop.maTram)
+    if physical and len(physical["members"]) > 1:
+        upcoming = physical_stop_board(physical, now, limit=limit)
+    else:
+        physical = None
+        upcoming, _ = stop_departure_board(stop, now, limit=limit, ctx=ctx)
+
+    stop_geo = {
+        "id": stop.maTram,
+        "name": stop.tenTram,
+        "address": stop.diaChi,
+        "lat": float(stop.lat) if stop.lat is not None else None,
+        "lng": float(stop.lng) if stop.lng is not None else None,
+        "order": stop.thuTuTrenTuyen,
+        "dir": direction,
+        "direction": direction,
+        "route_code": tuyen.maHienThi,
+    }
+
+    return render_template(
+        "stop_detail.html",
+        stop=stop,
+        tuyen=tuyen,
+        direction=direction,
+        stop_geo=stop_geo,
+        upcoming=upcoming,
+        physical=physical,
+        offset_source=offsets_data.get("source") if offsets_data.get("ok") else None,
+        offset_ok=bool(offset_s is not None),
     )
 
-    for t in trips:
-        try:
-            if not (t.ngayKhoiHanh and t.gioKhoiHanh):
+
+# ---- Trạm vật lý (cụm trạm) ----
+# Mỗi TramDung thuộc 1 tuyến + 1 hướng; 1 trạm ngoài đường có nhiều tuyến đi qua là nhiều dòng.
+# Gom các dòng gần nhau (<= STOP_CLUSTER_SAME_SPOT_M, hoặc <= STOP_CLUSTER_RADIUS_M và cùng tên) thành 1 trạm vật lý.
+# Lưới ô vuông giúp mỗi trạm chỉ so với trạm ở các ô lân cận; index cache theo network_revision().
+# Cùng index có lưới thứ 2 (ô NEARBY_GRID_CELL_M) trên tâm các trạm vật lý cho tìm trạm gần (/api/stops/nearby).
+
+_PHYSICAL_STOPS = {}
+_PHYSICAL_STOPS_LOCK = threading.Lock()
+
+PhysicalStopIndex = namedtuple("PhysicalStopIndex", "revision clusters by_stop grid grid_ids")
+
+
+class _GeoGrid:
+    """Lưới ô vuông cạnh `cell_m` mét (chiếu phẳng cục bộ) trên danh sách điểm [(lat, lng)]."""
+
+    def __init__(self, points, cell_m):
+        self.points = points
+        self.cell_m = float(cell_m)
+        lat0 = math.radians(sum(p[0] for p in points) / len(points)) if points else 0.0
+        self.kx = 111320.0 * math.cos(lat0)
+        self.ky = 110540.0
+        self.cells = {}
+        for i, (lat, lng) in enumerate(points):
+            self.cells.setdefault(self._cell(lat, lng), []).append(i)
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lng * self.kx / self.cell_m)), int(math.floor(lat * self.ky / self.cell_m)))
+
+    def within(self, lat, lng, radius_m):
+        """[(khoảng cách mét, chỉ số điểm)] trong bán kính `radius_m`, sắp theo khoảng cách."""
+        cx, cy = self._cell(lat, lng)
+        r = int(math.ceil(radius_m / self.cell_m))
+        out = []
+        for gx in range(cx - r, cx + r + 1):
+            for gy in range(cy - r, cy + r + 1):
+                for i in self.cells.get((gx, gy), ()):
+                    d = haversine_m(lat, lng, *self.points[i])
+                    if d <= radius_m:
+                        out.append((d, i))
+        out.sort()
+        return out
+
+    def _ring(self, cx, cy, ring):
+        if ring == 0:
+            yield (cx, cy)
+            return
+        for gx in range(cx - ring, cx + ring + 1):
+            yield (gx, cy - ring)
+            yield (gx, cy + ring)
+        for gy in range(cy - ring + 1, cy + ring):
+            yield (cx - ring, gy)
+            yield (cx + ring, gy)
+
+    def nearest(self, lat, lng, k, radius_m):
+        """
+        `k` điểm gần nhất trong bán kính, [(khoảng cách mét, chỉ số điểm)].
+        Quét từng vòng ô từ trong ra; điểm ở vòng r+1 cách ít nhất r ô -> dừng sớm khi đã đủ k điểm gần hơn.
+        """
+        cx, cy = self._cell(lat, lng)
+        found = []
+        for ring in range(int(math.ceil(radius_m / self.cell_m)) + 1):
+            for cell in self._ring(cx, cy, ring):
+                for i in self.cells.get(cell, ()):
+                    d = haversine_m(lat, lng, *self.points[i])
+                    if d <= radius_m:
+                        found.append((d, i))
+            found.sort()
+            if len(found) >= k and found[k - 1][0] <= ring * self.cell_m:
+                break
+        return found[:k]
+
+
+def _stop_name_tokens(name):
+    """Tên trạm -> tập từ không dấu, chữ thường ("Bến Xe Đà Nẵng" -> {ben, xe, da, nang})."""
+    raw = unicodedata.normalize("NFD", (name or "").lower().replace("đ", "d"))
+    raw = "".join(ch for ch in raw if not unicodedata.combining(ch))
+    return frozenset(re.findall(r"[a-z0-9]+", raw))
+
+
+def _stop_names_match(a, b):
+    return bool(a and b) and (a <= b or b <= a)
+
+
+def build_physical_stops(rows):
+    """
+    Gom trạm thành trạm vật lý. rows: [(stop_id, name, lat, lng, route_id, route_code, direction)].
+    Trả về (clusters {cluster_id: dict}, by_stop {stop_id: cluster_id}); cluster_id = stop_id nhỏ nhất trong cụm.
+    """
+    rows = sorted(rows, key=lambda r: r[0])
+    geo = [i for i, r in enumerate(rows) if r[2] is not None and r[3] is not None]
+    grid = _GeoGrid([(float(rows[i][2]), float(rows[i][3])) for i in geo], STOP_CLUSTER_RADIUS_M)
+    tokens = [_stop_name_tokens(rows[i][1]) for i in geo]
+
+    parent = list(range(len(geo)))
+    members_of = {i: [i] for i in range(len(geo))}  # gốc -> chỉ số điểm trong cụm
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def fits(ra, rb):
+        # giới hạn đường kính cụm: mọi cặp trạm trong cụm gộp cách nhau <= STOP_CLUSTER_RADIUS_M
+        # (không để chuỗi trạm cùng tên dọc 1 con đường nối bắc cầu thành 1 "trạm" dài vài trăm mét)
+        pts = grid.points
+        return all(
+            haversine_m(*pts[i], *pts[j]) <= STOP_CLUSTER_RADIUS_M
+            for i in members_of[ra] for j in members_of[rb]
+        )
+
+    for a, (lat, lng) in enumerate(grid.points):
+        for d, b in grid.within(lat, lng, STOP_CLUSTER_RADIUS_M):
+            if b <= a:
                 continue
-            depart_dt = datetime.strptime(f"{t.ngayKhoiHanh} {t.gioKhoiHanh}", "%Y-%m-%d %H:%M")
-        except Exception:
+            if d <= STOP_CLUSTER_SAME_SPOT_M or _stop_names_match(tokens[a], tokens[b]):
+                ra, rb = find(a), find(b)
+                if ra != rb and fits(ra, rb):
+                    root, child = min(ra, rb), max(ra, rb)
+                    parent[child] = root
+                    members_of[root] += members_of.pop(child)
+
+    groups = {}
+    for a, i in enumerate(geo):
+        groups.setdefault(find(a), []).append(rows[i])
+    geo_set = set(geo)
+    for i, r in enumerate(rows):
+        if i not in geo_set:
+            groups[("no-geo", i)] = [r]  # trạm chưa có tọa độ: tự là 1 cụm
+
+    clusters = {}
+    by_stop = {}
+    for members in groups.values():
+        cid = members[0][0]
+        names = [m[1] for m in members if m[1]]
+        coords = [(float(m[2]), float(m[3])) for m in members if m[2] is not None and m[3] is not None]
+        clusters[cid] = {
+            "id": cid,
+            "name": max(names, key=names.count) if names else None,  # tên phổ biến nhất (hòa -> trạm id nhỏ)
+            "lat": round(sum(c[0] for c in coords) / len(coords), 6) if coords else None,
+            "lng": round(sum(c[1] for c in coords) / len(coords), 6) if coords else None,
+            "stop_ids": [m[0] for m in members],
+            "routes": sorted({m[5] for m in members if m[5]}),
+            "members": [
+                {"stop_id": m[0], "name": m[1], "route_id": m[4], "route_code": m[5], "direction": m[6]}
+                for m in members
+            ],
+        }
+        for m in members:
+            by_stop[m[0]] = cid
+    return clusters, by_stop
+
+
+def physical_stop_index():
+    """PhysicalStopIndex hiện tại; dựng lại khi network_revision() đổi (thêm/sửa/xóa trạm)."""
+    revision = network_revision()
+    cached = _PHYSICAL_STOPS.get("index")
+    if cached and cached.revision == revision:
+        return cached
+    with _PHYSICAL_STOPS_LOCK:
+        cached = _PHYSICAL_STOPS.get("index")
+        if cached and cached.revision == revision:
+            return cached
+        rows = (
+            db.session.query(
+                TramDung.maTram, TramDung.tenTram, TramDung.lat, TramDung.lng,
+                TramDung.tuyen_id, TuyenXe.maHienThi, TramDung.huongChuan,
+            )
+            .outerjoin(TuyenXe, TuyenXe.maTuyen == TramDung.tuyen_id)
+            .all()
+        )
+        clusters, by_stop = build_physical_stops(rows)
+        grid_ids = [cid for cid, c in sorted(clusters.items()) if c["lat"] is not None]
+        grid = _GeoGrid([(clusters[cid]["lat"], clusters[cid]["lng"]) for cid in grid_ids], NEARBY_GRID_CELL_M)
+        cached = PhysicalStopIndex(revision, clusters, by_stop, grid, grid_ids)
+        _PHYSICAL_STOPS["index"] = cached
+        return cached
+
+
+def physical_stop_for(stop_id):
+    """Trạm vật lý chứa trạm `stop_id` (None nếu không có trạm)."""
+    index = physical_stop_index()
+    cid = index.by_stop.get(stop_id)
+    return index.clusters.get(cid) if cid is not None else None
+
+
+def physical_stop_board(cluster, now, limit=20):
+    """Bảng giờ gộp mọi tuyến/hướng đi qua trạm vật lý, sắp theo ETA."""
+    stops = TramDung.query.filter(TramDung.maTram.in_(cluster["stop_ids"])).all()
+    items = []
+    for stop in stops:
+        board, _ = stop_departure_board(stop, now, limit=limit)
+        for item in board:
+            item.update({
+                "stop_id": stop.maTram,
+                "route_id": stop.tuyen_id,
+                "route_code": stop.tuyen.maHienThi if stop.tuyen else None,
+            })
+            items.append(item)
+    items.sort(key=lambda x: (x["eta_iso"], x["route_code"] or "", x["direction"]))
+    return items[:limit]
+
+
+@app.route("/api/stops/<int:stop_id>/physical")
+def api_physical_stop(stop_id):
+    """Trạm vật lý chứa trạm `stop_id` (mọi tuyến/hướng dừng tại đó) + bảng giờ gộp. Query: limit (1-60)."""
+    cluster = physical_stop_for(stop_id)
+    if not cluster:
+        return jsonify({"ok": False, "error": "Không tìm thấy trạm."}), 404
+    limit = max(1, min(request.args.get("limit", default=20, type=int) or 20, 60))
+    now = datetime.now()
+    items = physical_stop_board(cluster, now, limit=limit)
+    return jsonify({
+        "ok": True,
+        "as_of": now.isoformat(timespec="seconds"),
+        "physical_stop": cluster,
+        "count": len(items),
+        "items": items,
+    })
+
+
+# ---- Trạm gần vị trí (index không gian) ----
+
+def next_arrivals_for_stops(stop_ids, now, n=3):
+    """
+    {stop_id: [n chuyến sắp tới]} cho nhiều trạm: gom theo (tuyến, hướng) rồi tính bằng ma trận ETA
+    (1 lần đọc lịch xuất bến/tuyến/ngày), thay vì đọc lịch riêng cho từng trạm.
+    """
+    stops = TramDung.query.filter(TramDung.maTram.in_(list(stop_ids))).all() if stop_ids else []
+    groups = {}
+    for stop in stops:
+        groups.setdefault((stop.tuyen_id, normalize_direction(stop.huong)), []).append(stop)
+
+    base = datetime.combine(now.date(), datetime.min.time())
+    at_s = (now - base).total_seconds()
+    out = {sid: [] for sid in stop_ids}
+    for (_, dir_), members in groups.items():
+        tuyen = members[0].tuyen
+        ctx = route_context(tuyen)
+        offsets_data = ctx.offsets(dir_)
+        if not offsets_data.get("ok"):
             continue
+        offsets = offsets_data.get("offsets") or {}
+        timed = [s for s in members if offsets.get(s.maTram) is not None]
+        deps = ctx.departures(now.date(), dir_)
+        dep_s = _departure_seconds(deps, base)
+        rows = next_arrival_indices(dep_s, [float(offsets[s.maTram]) for s in timed], at_s, n)
+        for stop, idx in zip(timed, rows):
+            for i in idx:
+                if i < 0:
+                    break
+                eta_dt = base + timedelta(seconds=dep_s[i] + float(offsets[stop.maTram]))
+                out[stop.maTram].append({
+                    "stop_id": stop.maTram,
+                    "route_id": tuyen.maTuyen,
+                    "route_code": tuyen.maHienThi,
+                    "direction": dir_,
+                    "trip_id": deps[i]["trip_id"],
+                    "depart_time": deps[i]["time"],
+                    "eta_time": eta_dt.strftime("%H:%M"),
+                    "eta_iso": eta_dt.isoformat(timespec="seconds"),
+                    "eta_in_min": max(0, int(round((eta_dt - now).total_seconds() / 60.0))),
+                    "detail_url": departure_detail_url(deps[i]),
+                })
+    return out
+
+
+@app.route("/api/stops/nearby")
+def api_stops_nearby():
+    """
+    Trạm (vật lý) gần vị trí, sắp theo khoảng cách, kèm chuyến sắp tới của mọi tuyến dừng tại trạm.
+    Query: lat, lng (bắt buộc), radius (mét, mặc định 500), limit (1-50, mặc định 10), n (chuyến/trạm, 1-5).
+    """
+    lat = request.args.get("lat", type=float)
+    lng = request.args.get("lng", type=float)
+    if lat is None or lng is None or not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        return jsonify({"ok": False, "error": "Cần lat/lng hợp lệ."}), 400
+    radius = max(1.0, min(request.args.get("radius", default=500.0, type=float) or 500.0, NEARBY_MAX_RADIUS_M))
+    limit = max(1, min(request.args.get("limit", default=10, type=int) or 10, 50))
+    n = max(1, min(request.args.get("n", default=3, type=int) or 3, ETA_MAX_ARRIVALS))
 
-        eta_dt = None
-        if offset_s is not None:
-            try:
-                eta_dt = depart_dt + timedelta(seconds=float(offset_s))
-            except Exception:
-                eta_dt = None
+    index = physical_stop_index()
+    hits = [(d, index.clusters[index.grid_ids[i]]) for d, i in index.grid.nearest(lat, lng, limit, radius)]
+
+    now = datetime.now()
+    arrivals = next_arrivals_for_stops([sid for _, c in hits for sid in c["stop_ids"]], now, n=n)
+    items = []
+    for d, c in hits:
+        merged = sorted(
+            (a for sid in c["stop_ids"] for a in arrivals.get(sid, [])),
+            key=lambda a: (a["eta_iso"], a["route_code"] or "", a["direction"]),
+        )
+        items.append({
+            "id": c["id"],
+            "name": c["name"],
+            "lat": c["lat"],
+            "lng": c["lng"],
+            "distance_m": round(d, 1),
+            "routes": c["routes"],
+            "members": c["members"],
+            "arrivals": merged[:n],
+        })
 
-        # Nếu không có offset, fallback lọc theo giờ xuất bến (ít ý nghĩa với trạm giữa tuyến)
-        ref_dt = eta_dt or depart_dt
-        if ref_dt < (now - timedelta(minutes=1)):
-            continue
+    return jsonify({
+        "ok": True,
+        "as_of": now.isoformat(timespec="seconds"),
+        "radius_m": radius,
+        "count": len(items),
+        "items": items,
+    })
 
-        eta_in_min = int(round((ref_dt - now).total_seconds() / 60.0))
-        eta_in_min = max(0, eta_in_min)
 
-        upcoming.append({
-            "trip_id": t.maChuyen,
-            "date": t.ngayKhoiHanh,
-            "depart_time": t.gioKhoiHanh,
+# ---- Bảng giờ trạm realtime (Server-Sent Events) ----
+# 1 thread nền/process tính bảng giờ mỗi BOARD_TICK_SEC cho các trạm đang có người xem (mỗi trạm 1 lần/tick),
+# rồi phát cùng payload cho mọi subscriber. Subscriber chỉ nhận event khi bảng giờ (đếm ngược phút) thay đổi.
+
+def compute_departure_boards(stop_ids, now, limit=BOARD_LIMIT):
+    """{stop_id: payload} cho tập trạm; trạm, offset, headway đọc 1 lần cho mỗi tuyến (RouteContext)."""
+    stops = TramDung.query.filter(TramDung.maTram.in_(stop_ids)).all()
+    boards = {}
+    for stop in stops:
+        direction = normalize_direction(stop.huong)
+        items, _ = stop_departure_board(stop, now, limit=limit)
+        boards[stop.maTram] = {
+            "stop_id": stop.maTram,
+            "stop_name": stop.tenTram,
+            "route_id": stop.tuyen_id,
+            "route_code": stop.tuyen.maHienThi,
             "direction": direction,
-            "eta_time": ref_dt.strftime("%H:%M"),
-            "eta_iso": ref_dt.isoformat(timespec="seconds"),
-            "eta_in_min": eta_in_min,
-            "detail_url": url_for("trip_detail", trip_id=t.maChuyen),
-        })
+            "items": items,
+        }
+    for sid in stop_ids:
+        boards.setdefault(sid, {"stop_id": sid, "error": "Không tìm thấy trạm.", "items": []})
+    return boards
+
+
+class _DepartureBoardHub:
+    def __init__(self, tick_sec):
+        self.tick_sec = tick_sec
+        self._cond = threading.Condition()
+        self._subs = {}    # stop_id -> số subscriber
+        self._boards = {}  # stop_id -> (version, payload)
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self, stop_ids):
+        with self._cond:
+            for sid in stop_ids:
+                self._subs[sid] = self._subs.get(sid, 0) + 1
+            # Khởi động lười: mỗi process (gunicorn worker) có 1 thread riêng, tạo sau khi fork.
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="departure-board", daemon=True)
+                self._thread.start()
+        self._wake.set()  # trạm mới -> tính ngay, không chờ tới tick sau
+
+    def unsubscribe(self, stop_ids):
+        with self._cond:
+            for sid in stop_ids:
+                left = self._subs.get(sid, 0) - 1
+                if left > 0:
+                    self._subs[sid] = left
+                else:
+                    self._subs.pop(sid, None)
+                    self._boards.pop(sid, None)
+
+    def wait_for_change(self, stop_ids, seen, timeout):
+        """
+        Chờ tới khi mọi trạm đã có bảng giờ và ít nhất 1 trạm đổi version so với `seen`.
+        Trả về {stop_id: (version, payload)} hoặc None nếu hết `timeout` (để gửi keep-alive).
+        """
+        def ready():
+            boards = self._boards
+            return all(sid in boards for sid in stop_ids) and any(
+                boards[sid][0] != seen.get(sid) for sid in stop_ids
+            )
 
-    upcoming.sort(key=lambda x: (x.get("eta_iso") or "9999", x.get("trip_id") or 0))
-    upcoming = upcoming[:limit]
+        with self._cond:
+            if not self._cond.wait_for(ready, timeout=timeout):
+                return None
+            return {sid: self._boards[sid] for sid in stop_ids}
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.tick_sec)
+            self._wake.clear()
+            with self._cond:
+                stop_ids = list(self._subs)
+            if not stop_ids:
+                continue
+            try:
+                # request context giả: url_for (detail_url) trả đường dẫn tương đối như trong request thật
+                with app.test_request_context("/"):
+                    boards = compute_departure_boards(stop_ids, datetime.now())
+            except Exception as e:
+                print("departure board warning:", e)
+                continue
+            with self._cond:
+                for sid, payload in boards.items():
+                    if sid not in self._subs:
+                        continue
+                    prev = self._boards.get(sid)
+                    if prev is None or prev[1] != payload:
+                        self._boards[sid] = ((prev[0] + 1) if prev else 1, payload)
+                self._cond.notify_all()
 
-    stop_geo = {
-        "id": stop.maTram,
-        "name": stop.tenTram,
-        "address": stop.diaChi,
-        "lat": float(stop.lat) if stop.lat is not None else None,
-        "lng": float(stop.lng) if stop.lng is not None else None,
-        "order": stop.thuTuTrenTuyen,
-        "dir": direction,
-        "direction": direction,
-        "route_code": tuyen.maHienThi,
-    }
 
-    return render_template(
-        "stop_detail.html",
-        stop=stop,
-        tuyen=tuyen,
-        direction=direction,
-        stop_geo=stop_geo,
-        upcoming=upcoming,
-        offset_source=offsets_data.get("source") if offsets_data.get("ok") else None,
-        offset_ok=bool(offset_s is not None),
-    )
+BOARD_HUB = _DepartureBoardHub(BOARD_TICK_SEC)
 
 
+def _departure_board_stream(stop_ids):
+    def generate():
+        BOARD_HUB.subscribe(stop_ids)
+        try:
+            yield "retry: 5000\n\n"
+            seen = {}
+            while True:
+                boards = BOARD_HUB.wait_for_change(stop_ids, seen, timeout=BOARD_KEEPALIVE_SEC)
+                if boards is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                seen = {sid: version for sid, (version, _) in boards.items()}
+                body = {
+                    "generated_at": datetime.now().isoformat(timespec="seconds"),
+                    "stops": [boards[sid][1] for sid in stop_ids],
+                }
+                yield "event: board\ndata: " + json.dumps(body, ensure_ascii=False, separators=(",", ":")) + "\n\n"
+        finally:
+            BOARD_HUB.unsubscribe(stop_ids)
+
+    resp = Response(generate(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # nginx: không buffer SSE
+    return resp
+
+
+@app.route("/api/stops/<int:stop_id>/board/stream")
+def api_stop_board_stream(stop_id):
+    """SSE bảng giờ 1 trạm (màn hình tại trạm). Event `board`: {generated_at, stops: [...]}."""
+    TramDung.query.get_or_404(stop_id)
+    return _departure_board_stream([stop_id])
+
+
+@app.route("/api/boards/stream")
+def api_boards_stream():
+    """SSE bảng giờ nhiều trạm: ?stops=1,2,3 (tối đa BOARD_MAX_STOPS)."""
+    raw = (request.args.get("stops") or "").replace(" ", "")
+    try:
+        stop_ids = list(dict.fromkeys(int(x) for x in raw.split(",") if x))
+    except ValueError:
+        return jsonify({"ok": False, "error": "stops phải là danh sách ID trạm, ví dụ ?stops=1,2,3"}), 400
+    if not stop_ids:
+        return jsonify({"ok": False, "error": "Thiếu tham số stops."}), 400
+    if len(stop_ids) > BOARD_MAX_STOPS:
+        return jsonify({"ok": False, "error": f"Tối đa {BOARD_MAX_STOPS} trạm / stream."}), 400
+    found = db.session.query(func.count(TramDung.maTram)).filter(TramDung.maTram.in_(stop_ids)).scalar()
+    if found != len(stop_ids):
+        return jsonify({"ok": False, "error": "Có trạm không tồn tại."}), 404
+    return _departure_board_stream(stop_ids)
+
 
 @app.route("/card-register", methods=["GET", "POST"])
 def card_register():
-    # Đảm bảo schema đã có cột loaiThe/giaTri (phòng trường hợp DB cũ)
-    ensure_schema()
     user = current_user()
     if not user:
         flash("Bạn phải đăng nhập để đăng ký thẻ.")
@@ -1262,7 +3243,6 @@ def card_register():
 
 @app.route("/cards")
 def cards():
-    ensure_schema()
     user = current_user()
     if not user:
         flash("Bạn phải đăng nhập để xem thẻ.")
@@ -1282,6 +3262,342 @@ def cards():
     return render_template("cards.html", cards=cards, user=user)
 
 
+# ==================== LẬP LỘ TRÌNH (RAPTOR) ====================
+# Mạng được chuyển 1 lần thành mảng gọn (không giữ ORM object): trạm = trạm vật lý, pattern = (tuyến, hướng)
+# với dãy chỉ số trạm + offset (giây). Mọi chuyến của 1 pattern dùng chung offset, nên chuyến sớm nhất đón được
+# ở vị trí p sau thời điểm τ là bisect(giờ xuất bến, τ - offset[p]). Lối đi bộ chuyển tuyến tính sẵn bằng lưới trạm gần.
+# Mạng cache theo network_revision(); giờ xuất bến trong ngày (lịch tần suất + ngoại lệ) cache PLANNER_TIMETABLE_TTL_SEC.
+# Vòng k của RAPTOR = đi tối đa k chuyến xe (k-1 lần chuyển tuyến).
+
+_PLANNER = {}
+_PLANNER_LOCK = threading.Lock()
+_PLANNER_MAX_DAYS = 3
+
+
+def _walk_seconds(dist_m):
+    return int(math.ceil(dist_m / max(0.1, PLANNER_WALK_SPEED_MPS)))
+
+
+class TransitNetwork:
+    def __init__(self, index):
+        self.revision = index.revision
+        self.index = index
+        self.stop_ids = list(index.grid_ids)  # chỉ số trạm i <-> trạm vật lý có tọa độ (cùng thứ tự lưới trạm gần)
+        self.stop_pos = {cid: i for i, cid in enumerate(self.stop_ids)}
+        self.patterns = []         # (route_id, route_code, hướng)
+        self.pattern_stops = []    # [chỉ số trạm theo thứ tự trên tuyến]
+        self.pattern_offsets = []  # [offset (giây) tại từng vị trí]
+        self.stop_patterns = [[] for _ in self.stop_ids]  # trạm -> [(pattern, vị trí)]
+
+        for tuyen in TuyenXe.query.order_by(TuyenXe.maTuyen.asc()).all():
+            ctx = route_context(tuyen)
+            for d in ctx.dirs_with_stops:
+                data = ctx.offsets(d)
+                if not data.get("ok"):
+                    continue
+                offsets = data.get("offsets") or {}
+                seq, offs = [], []
+                for stop in data.get("items") or []:
+                    pos = self.stop_pos.get(index.by_stop.get(stop.maTram))
+                    if offsets.get(stop.maTram) is None or pos is None or (seq and seq[-1] == pos):
+                        continue  # chưa có offset / tọa độ, hoặc trạm liền kề cùng cụm
+                    seq.append(pos)
+                    offs.append(int(round(float(offsets[stop.maTram]))))
+                if len(seq) < 2:
+                    continue
+                p = len(self.patterns)
+                self.patterns.append((tuyen.maTuyen, tuyen.maHienThi, d))
+                self.pattern_stops.append(seq)
+                self.pattern_offsets.append(offs)
+                for pos, i in enumerate(seq):
+                    self.stop_patterns[i].append((p, pos))
+
+        # lối đi bộ giữa các trạm vật lý gần nhau: trạm -> [(trạm đích, giây đi bộ)]
+        self.transfers = []
+        for i, cid in enumerate(self.stop_ids):
+            c = index.clusters[cid]
+            self.transfers.append([
+                (j, _walk_seconds(dist))
+                for dist, j in index.grid.within(c["lat"], c["lng"], PLANNER_TRANSFER_RADIUS_M)
+                if j != i
+            ])
+
+    def load_day(self, day):
+        """(giờ xuất bến giây-trong-ngày tăng dần, dict chuyến) của từng pattern trong ngày `day`."""
+        base = datetime.combine(day, datetime.min.time())
+        deps, trips = [], []
+        for route_id, _, d in self.patterns:
+            rows = route_context(db.session.get(TuyenXe, route_id)).departures(day, d)
+            deps.append([int((r["dt"] - base).total_seconds()) for r in rows])
+            trips.append(rows)
+        return deps, trips
+
+
+def planner_timetable(day):
+    """(TransitNetwork, deps, trips) cho ngày `day`; mạng dựng lại khi revision đổi, giờ xuất bến đọc lại sau TTL."""
+    index = physical_stop_index()
+    with _PLANNER_LOCK:
+        net = _PLANNER.get("net")
+        hit = _PLANNER["days"].get(day) if net is not None else None
+    # Dựng mạng / nạp giờ xuất bến ngoài khoá (có truy vấn DB): request khác vẫn dùng bản cũ trong lúc chờ
+    if net is None or net.revision != index.revision:
+        net = TransitNetwork(index)
+        hit = None
+    if hit is None or (time.time() - hit[0]) > PLANNER_TIMETABLE_TTL_SEC:
+        hit = (time.time(), *net.load_day(day))
+        with _PLANNER_LOCK:
+            cur = _PLANNER.get("net")
+            if cur is None or cur.revision != net.revision:
+                _PLANNER["net"] = net
+                _PLANNER["days"] = {}
+            if _PLANNER["net"] is net:
+                days = _PLANNER["days"]
+                days.pop(day, None)
+                days[day] = hit
+                while len(days) > _PLANNER_MAX_DAYS:  # chỉ giữ vài ngày nạp gần nhất (thường hôm nay + ngày mai)
+                    days.pop(next(iter(days)))
+    return net, hit[1], hit[2]
+
+
+def raptor_rounds(net, deps, access, egress, max_rounds):
+    """
+    RAPTOR tới sớm nhất. access: {trạm: thời điểm có mặt (giây trong ngày)}, egress: {trạm: giây đi bộ tới đích}.
+    rounds[k] = {trạm: (thời điểm, nhãn)} cho trạm được cải thiện ở vòng k; nhãn là ("access",),
+    ("bus", pattern, chuyến, vị trí lên, vị trí xuống) hoặc ("walk", trạm nguồn, giây đi bộ, nhãn bus của trạm nguồn).
+    """
+    best = [math.inf] * len(net.stop_ids)
+    best_bus = [math.inf] * len(net.stop_ids)  # tới bằng xe: nguồn cho chặng đi bộ (lối đi bộ không bắc cầu)
+    best_dest = math.inf
+    rounds = [{}]
+    for i, t in access.items():
+        best[i] = t
+        rounds[0][i] = (t, ("access",))
+        if i in egress:
+            best_dest = min(best_dest, t + egress[i])
+    marked = set(access)
+
+    for k in range(1, max_rounds + 1):
+        prev_best = list(best)
+        slack = PLANNER_MIN_TRANSFER_SEC if k > 1 else 0
+        cur = {}
+        by_bus = {}
+
+        # chỉ quét pattern đi qua trạm vừa cải thiện, từ vị trí sớm nhất của trạm đó
+        to_scan = {}
+        for i in marked:
+            for p, pos in net.stop_patterns[i]:
+                if pos < to_scan.get(p, len(net.pattern_stops[p])):
+                    to_scan[p] = pos
+
+        for p, start in to_scan.items():
+            seq, offs, dep = net.pattern_stops[p], net.pattern_offsets[p], deps[p]
+            trip, board = -1, -1
+            for pos in range(start, len(seq)):
+                i = seq[pos]
+                if trip >= 0:
+                    t_arr = dep[trip] + offs[pos]
+                    if t_arr < best_bus[i] and t_arr < best_dest:
+                        best_bus[i] = t_arr
+                        by_bus[i] = (t_arr, ("bus", p, trip, board, pos))
+                        if t_arr < best[i]:
+                            best[i] = t_arr
+                            cur[i] = by_bus[i]
+                if prev_best[i] < math.inf:
+                    t = bisect_left(dep, prev_best[i] + slack - offs[pos])
+                    if t < len(dep) and (trip < 0 or t < trip):
+                        trip, board = t, pos
+
+        # đi bộ chuyển tuyến (chỉ từ trạm vừa tới bằng xe, không nối 2 chặng đi bộ)
+        for i, label in by_bus.items():
+            for j, walk_s in net.transfers[i]:
+                t_walk = label[0] + walk_s
+                if t_walk < best[j] and t_walk < best_dest:
+                    best[j] = t_walk
+                    cur[j] = (t_walk, ("walk", i, walk_s, label))
+
+        for i, (t, _) in cur.items():
+            if i in egress:
+                best_dest = min(best_dest, t + egress[i])
+        rounds.append(cur)
+        marked = set(cur)
+        if not marked:
+            break
+    return rounds
+
+
+def _journey_legs(net, deps, rounds, k, i):
+    """Lần ngược nhãn từ trạm `i` (vòng `k`) về điểm đi -> [chặng] theo thứ tự thời gian (giây trong ngày)."""
+    legs = []
+    label = rounds[k][i]
+    while True:
+        t, par = label
+        if par[0] == "access":
+            legs.append({"mode": "access", "to": i, "arrive_s": t})
+            break
+        if par[0] == "walk":
+            _, src, walk_s, src_label = par
+            legs.append({"mode": "walk", "from": src, "to": i, "depart_s": t - walk_s, "arrive_s": t})
+            i, label = src, src_label
+            continue
+        _, p, trip, board, alight = par
+        offs = net.pattern_offsets[p]
+        legs.append({
+            "mode": "bus",
+            "pattern": p,
+            "trip": trip,
+            "from": net.pattern_stops[p][board],
+            "to": net.pattern_stops[p][alight],
+            "depart_s": deps[p][trip] + offs[board],
+            "arrive_s": deps[p][trip] + offs[alight],
+            "stops": alight - board,
+        })
+        i = net.pattern_stops[p][board]
+        # nhãn dùng để lên xe = nhãn tốt nhất của trạm lên ở các vòng trước
+        k = next(kk for kk in range(k - 1, -1, -1) if i in rounds[kk])
+        label = rounds[k][i]
+    legs.reverse()
+    return legs
+
+
+def plan_journeys(net, deps, trips, base, t0, origin, destination, max_transfers):
+    """
+    Các lộ trình Pareto (ít chuyển tuyến hơn <-> tới sớm hơn) từ `origin` tới `destination`.
+    origin/destination: {"access": {trạm: giây đi bộ}, "point": (lat, lng) hoặc None}.
+    """
+    access = {i: t0 + w for i, w in origin["access"].items()}
+    egress = destination["access"]
+    rounds = raptor_rounds(net, deps, access, egress, max_transfers + 1)
+
+    def place(i):
+        c = net.index.clusters[net.stop_ids[i]]
+        return {"stop_id": c["id"], "name": c["name"], "lat": c["lat"], "lng": c["lng"]}
+
+    def hhmm(sec):
+        return (base + timedelta(seconds=sec)).strftime("%H:%M")
+
+    journeys = []
+    best_arrival = math.inf
+    if origin["point"] and destination["point"]:
+        direct = haversine_m(*origin["point"], *destination["point"])
+        if direct <= PLANNER_ACCESS_RADIUS_M:
+            walk_s = _walk_seconds(direct)
+            best_arrival = t0 + walk_s
+            journeys.append({
+                "depart_time": hhmm(t0),
+                "arrive_time": hhmm(t0 + walk_s),
+                "duration_min": int(math.ceil(walk_s / 60.0)),
+                "transfers": 0,
+                "legs": [{"mode": "walk", "from": None, "to": None, "depart_time": hhmm(t0),
+                          "arrive_time": hhmm(t0 + walk_s), "duration_min": int(math.ceil(walk_s / 60.0))}],
+            })
+
+    for k in range(1, len(rounds)):
+        cands = [(t + egress[i], i) for i, (t, _) in rounds[k].items() if i in egress]
+        if not cands:
+            continue
+        arrive_s, i = min(cands)
+        if arrive_s >= best_arrival:
+            continue
+        best_arrival = arrive_s
+
+        legs = []
+        rides = 0
+        start_s = None  # giờ rời đi của chặng đầu (không tính thời gian đứng chờ trước đó)
+        for leg in _journey_legs(net, deps, rounds, k, i):
+            if leg["mode"] == "access":
+                walk_s = origin["access"][leg["to"]]
+                if walk_s:
+                    start_s = leg["arrive_s"] - walk_s
+                    legs.append({"mode": "walk", "from": None, "to": place(leg["to"]),
+                                 "depart_time": hhmm(leg["arrive_s"] - walk_s), "arrive_time": hhmm(leg["arrive_s"]),
+                                 "duration_min": int(math.ceil(walk_s / 60.0))})
+            elif leg["mode"] == "walk":
+                start_s = leg["depart_s"] if start_s is None else start_s
+                legs.append({"mode": "walk", "from": place(leg["from"]), "to": place(leg["to"]),
+                             "depart_time": hhmm(leg["depart_s"]), "arrive_time": hhmm(leg["arrive_s"]),
+                             "duration_min": int(math.ceil((leg["arrive_s"] - leg["depart_s"]) / 60.0))})
+            else:
+                rides += 1
+                start_s = leg["depart_s"] if start_s is None else start_s
+                route_id, route_code, d = net.patterns[leg["pattern"]]
+                trip = trips[leg["pattern"]][leg["trip"]]
+                legs.append({"mode": "bus", "route_id": route_id, "route_code": route_code, "direction": d,
+                             "trip_id": trip["trip_id"], "trip_departure": trip["time"],
+                             "detail_url": departure_detail_url(trip),
+                             "from": place(leg["from"]), "to": place(leg["to"]), "stops": leg["stops"],
+                             "depart_time": hhmm(leg["depart_s"]), "arrive_time": hhmm(leg["arrive_s"]),
+                             "duration_min": int(math.ceil((leg["arrive_s"] - leg["depart_s"]) / 60.0))})
+        if egress[i]:
+            legs.append({"mode": "walk", "from": place(i), "to": None,
+                         "depart_time": hhmm(arrive_s - egress[i]), "arrive_time": hhmm(arrive_s),
+                         "duration_min": int(math.ceil(egress[i] / 60.0))})
+
+        journeys.append({
+            "depart_time": legs[0]["depart_time"],
+            "arrive_time": hhmm(arrive_s),
+            "duration_min": int(math.ceil((arrive_s - start_s) / 60.0)),
+            "transfers": max(0, rides - 1),
+            "legs": legs,
+        })
+    return journeys
+
+
+def _planner_endpoint(net, prefix):
+    """Điểm đi/đến từ query: `<prefix>=lat,lng` hoặc `<prefix>_stop=<id trạm>`; ValueError nếu không hợp lệ."""
+    stop_id = request.args.get(f"{prefix}_stop", type=int)
+    if stop_id:
+        cluster = physical_stop_for(stop_id)
+        pos = net.stop_pos.get(cluster["id"]) if cluster else None
+        if pos is None:
+            raise ValueError(f"{prefix}_stop không tồn tại hoặc chưa có tọa độ.")
+        return {"access": {pos: 0}, "point": (cluster["lat"], cluster["lng"])}
+
+    raw = (request.args.get(prefix) or "").split(",")
+    try:
+        lat, lng = float(raw[0]), float(raw[1])
+    except (ValueError, IndexError):
+        raise ValueError(f"Cần {prefix}=lat,lng hoặc {prefix}_stop=<id trạm>.")
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        raise ValueError(f"{prefix} ngoài phạm vi tọa độ.")
+    hits = net.index.grid.within(lat, lng, PLANNER_ACCESS_RADIUS_M)
+    return {"access": {i: _walk_seconds(d) for d, i in hits}, "point": (lat, lng)}
+
+
+@app.route("/api/plan")
+def api_plan():
+    """
+    Lập lộ trình A -> B qua nhiều tuyến (RAPTOR trên lịch tần suất + offset trạm, có đi bộ chuyển tuyến).
+    Query: from=lat,lng | from_stop=<id>, to=lat,lng | to_stop=<id>, at (ISO, mặc định bây giờ), max_transfers.
+    Trả về các lộ trình không bị lấn át: ít chuyển tuyến hơn hoặc tới sớm hơn.
+    """
+    at = datetime.now()
+    at_raw = (request.args.get("at") or "").strip()
+    if at_raw:
+        try:
+            at = parse_local_iso(at_raw)
+        except ValueError:
+            return jsonify({"ok": False, "error": "at phải có dạng ISO (YYYY-MM-DDTHH:MM)."}), 400
+    max_transfers = request.args.get("max_transfers", default=PLANNER_MAX_TRANSFERS, type=int)
+    max_transfers = max(0, min(PLANNER_MAX_TRANSFERS if max_transfers is None else max_transfers, PLANNER_MAX_TRANSFERS))
+
+    net, deps, trips = planner_timetable(at.date())
+    try:
+        origin = _planner_endpoint(net, "from")
+        destination = _planner_endpoint(net, "to")
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    base = datetime.combine(at.date(), datetime.min.time())
+    t0 = int((at - base).total_seconds())
+    journeys = plan_journeys(net, deps, trips, base, t0, origin, destination, max_transfers)
+    return jsonify({
+        "ok": True,
+        "as_of": at.isoformat(timespec="seconds"),
+        "count": len(journeys),
+        "journeys": journeys,
+    })
+
+
 # ==================== ADMIN ====================
 
 @app.route("/admin/routes", methods=["GET", "POST"])
@@ -1354,6 +3670,7 @@ def admin_routes():
             tuyen.tanSuatPhut = tan_suat_val
             tuyen.soChuyenMoiNgay = so_chuyen_val
             tuyen.giaVe = gia_ve or None
+            bump_route_revision(tuyen.maTuyen)
             db.session.commit()
             flash("Đã cập nhật tuyến thành công!")
             return redirect(url_for("admin_routes"))
@@ -1369,6 +3686,7 @@ def admin_routes():
             tuyen.tanSuatPhut = tan_suat_val if tan_suat_val is not None else tuyen.tanSuatPhut
             tuyen.soChuyenMoiNgay = so_chuyen_val if so_chuyen_val is not None else tuyen.soChuyenMoiNgay
             tuyen.giaVe = gia_ve or tuyen.giaVe
+            bump_route_revision(tuyen.maTuyen)
             flash("Đã cập nhật tuyến cũ thành công!")
         else:
             tuyen = TuyenXe(
@@ -1389,12 +3707,18 @@ def admin_routes():
         return redirect(url_for("admin_routes"))
 
     danh_sach_tuyen = TuyenXe.query.order_by(TuyenXe.maTuyen).all()
-    return render_template("admin_routes.html", routes=danh_sach_tuyen, edit_route=edit_route)
+    stats = route_stop_stats([r.maTuyen for r in danh_sach_tuyen])
+    route_summaries = {r.maTuyen: build_route_summary(r, dir_stats=stats[r.maTuyen]) for r in danh_sach_tuyen}
+    return render_template(
+        "admin_routes.html",
+        routes=danh_sach_tuyen,
+        edit_route=edit_route,
+        route_summaries=route_summaries,
+    )
 
 
 @app.route("/admin/cards", methods=["GET", "POST"])
 def admin_cards():
-    ensure_schema()
     user = current_user()
     if not user or user.vai_tro != "ADMIN":
         flash("Bạn không có quyền truy cập!")
@@ -1515,12 +3839,16 @@ def admin_route_stops(tuyen_id):
         if ma_tram:
             tram = TramDung.query.get(int(ma_tram))
             if tram and tram.tuyen_id == tuyen_id:
+                dirs = {tram.huongChuan or "DI", huong}  # đổi hướng -> tính lại cả hướng cũ
                 tram.tenTram = ten_tram
                 tram.diaChi = dia_chi
                 tram.thuTuTrenTuyen = int(thu_tu)
                 tram.lat = float(lat)
                 tram.lng = float(lng)
                 tram.huong = huong
+                db.session.flush()
+                rebuild_stop_offsets(tuyen, dirs=tuple(sorted(dirs)), commit=False)
+                bump_route_revision(tuyen.maTuyen)
                 db.session.commit()
                 flash("Đã cập nhật trạm dừng.")
             else:
@@ -1536,6 +3864,9 @@ def admin_route_stops(tuyen_id):
                 tuyen_id=tuyen_id,
             )
             db.session.add(tram)
+            db.session.flush()
+            rebuild_stop_offsets(tuyen, dirs=(huong,), commit=False)
+            bump_route_revision(tuyen.maTuyen)
             db.session.commit()
             flash("Đã thêm trạm dừng mới.")
 
@@ -1573,13 +3904,30 @@ def admin_delete_stop(tuyen_id, tram_id):
         flash("Trạm không thuộc tuyến này.")
         return redirect(url_for("admin_route_stops", tuyen_id=tuyen_id))
 
+    StopOffset.query.filter(StopOffset.tram_id == tram.maTram).delete(synchronize_session=False)
+    tuyen, huong = tram.tuyen, tram.huongChuan or "DI"
     db.session.delete(tram)
+    db.session.flush()
+    rebuild_stop_offsets(tuyen, dirs=(huong,), commit=False)
+    bump_route_revision(tuyen_id)
     db.session.commit()
     flash("Đã xóa trạm dừng.")
 
     return redirect(url_for("admin_route_stops", tuyen_id=tuyen_id))
 
 
+def _cancel_regular_slot(tuyen, ngay, gio, huong):
+    """Thêm dòng HUY cho 1 giờ xuất bến theo lịch (nếu giờ đó thuộc lịch và chưa có ngoại lệ nào giữ)."""
+    if _parse_hhmm_minutes(gio) not in route_context(tuyen).departure_minutes:
+        return None
+    same_slot = ChuyenXe.query.filter_by(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, huong=huong)
+    if same_slot.filter((ChuyenXe.gioGoc == gio) | (ChuyenXe.gioKhoiHanh == gio)).first():
+        return None
+    huy = ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, gioGoc=gio, gioKhoiHanh=gio, huong=huong, loaiChuyen="HUY")
+    db.session.add(huy)
+    return huy
+
+
 @app.route("/admin/routes/<int:tuyen_id>/trips", methods=["GET", "POST"])
 def admin_route_trips(tuyen_id):
     user = current_user()
@@ -1601,18 +3949,19 @@ def admin_route_trips(tuyen_id):
         action = request.form.get("action", "add_trip")
 
         if action == "add_trip":
-            ngay = request.form.get("ngayKhoiHanh")
-            gio = request.form.get("gioKhoiHanh")
+            slot = normalize_trip_slot(request.form.get("ngayKhoiHanh"), request.form.get("gioKhoiHanh"))
             huong = normalize_direction(request.form.get("huong"))
 
-            if not ngay or not gio:
-                flash("Ngày và giờ khởi hành không được để trống.")
+            if not slot:
+                flash("Ngày/giờ không hợp lệ (ngày YYYY-MM-DD, giờ HH:MM).")
             else:
+                ngay, gio = slot
                 trip = ChuyenXe(
                     tuyen_id=tuyen.maTuyen,
                     ngayKhoiHanh=ngay,
                     gioKhoiHanh=gio,
                     huong=huong,
+                    loaiChuyen="THEM",
                 )
                 db.session.add(trip)
                 try:
@@ -1622,25 +3971,71 @@ def admin_route_trips(tuyen_id):
                     db.session.rollback()
                     flash("Không thể thêm chuyến (có thể trùng ngày/giờ/hướng).")
 
+        elif action == "override_trip":
+            # Hủy / dời giờ một chuyến theo lịch tần suất: chỉ lưu 1 dòng ngoại lệ
+            ngay = request.form.get("ngayKhoiHanh")
+            gio_moi = (request.form.get("gioKhoiHanh") or "").strip()
+            huong = normalize_direction(request.form.get("huong"))
+
+            slot = normalize_trip_slot(ngay, request.form.get("gioGoc"))
+            slot_moi = normalize_trip_slot(ngay, gio_moi) if gio_moi else None
+
+            if not slot or (gio_moi and not slot_moi):
+                flash("Ngày/giờ không hợp lệ (ngày YYYY-MM-DD, giờ HH:MM).")
+            else:
+                ngay, gio_goc = slot
+                gio_moi = slot_moi[1] if slot_moi else ""
+                goc_min = _parse_hhmm_minutes(gio_goc)
+                same_slot = ChuyenXe.query.filter_by(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, huong=huong)
+                # chuyến đã dời: tìm theo giờ gốc trước (dời lại lần nữa không tạo dòng trùng), rồi theo giờ đang chạy
+                existing = (
+                    same_slot.filter(ChuyenXe.gioGoc == gio_goc).first()
+                    or same_slot.filter(ChuyenXe.gioKhoiHanh == gio_goc).first()
+                )
+                if not existing and goc_min not in route_context(tuyen).departure_minutes:
+                    flash(f"{gio_goc} không phải giờ xuất bến theo lịch của tuyến.")
+                elif existing and existing.ve_xe:
+                    flash("Không thể hủy/dời chuyến vì đã có vé được đặt.")
+                else:
+                    trip = existing or ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, huong=huong)
+                    trip.gioGoc = (existing.gioGoc if existing else None) or gio_goc
+                    trip.gioKhoiHanh = gio_moi or gio_goc
+                    trip.loaiChuyen = "DOI_GIO" if gio_moi else "HUY"
+                    db.session.add(trip)
+                    try:
+                        db.session.commit()
+                        flash("Đã dời giờ chuyến." if gio_moi else "Đã hủy chuyến.")
+                    except Exception:
+                        db.session.rollback()
+                        flash("Không thể lưu (có thể trùng ngày/giờ/hướng).")
+
         elif action == "edit_trip":
             trip_id = request.form.get("trip_id")
-            ngay = request.form.get("ngayKhoiHanh")
-            gio = request.form.get("gioKhoiHanh")
+            slot = normalize_trip_slot(request.form.get("ngayKhoiHanh"), request.form.get("gioKhoiHanh"))
             huong = normalize_direction(request.form.get("huong"))
 
             if not trip_id:
                 flash("Thiếu trip_id.")
+            elif not slot:
+                flash("Ngày/giờ không hợp lệ (ngày YYYY-MM-DD, giờ HH:MM).")
             else:
+                ngay, gio = slot
                 trip = ChuyenXe.query.get(int(trip_id))
                 if not trip or trip.tuyen_id != tuyen.maTuyen:
                     flash("Chuyến không hợp lệ.")
                 elif trip.ve_xe:
                     flash("Không thể sửa chuyến vì đã có vé được đặt.")
                 else:
+                    goc = (trip.ngayKhoiHanh, trip.gioKhoiHanh, normalize_direction(trip.huong))
+                    regular = (trip.loaiChuyen or "THUONG").upper() == "THUONG"
                     trip.ngayKhoiHanh = ngay
                     trip.gioKhoiHanh = gio
                     trip.huong = huong
                     try:
+                        if regular and goc != (ngay, gio, huong):
+                            # Chuyến thường dời đi: giữ giờ gốc bằng 1 dòng HUY, nếu không lịch tần suất sinh lại chuyến đó
+                            db.session.flush()
+                            _cancel_regular_slot(tuyen, *goc)
                         db.session.commit()
                         flash("Đã cập nhật chuyến.")
                     except Exception:
@@ -1652,7 +4047,7 @@ def admin_route_trips(tuyen_id):
     danh_sach_chuyen = (
         ChuyenXe.query
         .filter_by(tuyen_id=tuyen.maTuyen)
-        .order_by(ChuyenXe.ngayKhoiHanh.asc(), ChuyenXe.gioKhoiHanh.asc(), ChuyenXe.huong.asc(), ChuyenXe.maChuyen.asc())
+        .order_by(ChuyenXe.departure_at.asc(), ChuyenXe.huong.asc(), ChuyenXe.maChuyen.asc())
         .all()
     )
     danh_sach_tram = (
@@ -1726,9 +4121,6 @@ def api_osrm_route():
     if not isinstance(coords, list) or len(coords) < 2:
         return jsonify({"ok": False, "error": "coords phải là list và có ít nhất 2 điểm"}), 400
 
-    if len(coords) > OSRM_MAX_COORDS:
-        return jsonify({"ok": False, "error": f"Quá nhiều điểm ({len(coords)}). Giới hạn: {OSRM_MAX_COORDS}"}), 400
-
     points = []
     try:
         for item in coords:
@@ -1741,51 +4133,67 @@ def api_osrm_route():
     except Exception:
         return jsonify({"ok": False, "error": "coords có giá trị không chuyển được sang số"}), 400
 
-    coord_str = ";".join([f"{lng},{lat}" for (lng, lat) in points])
-    url = f"{OSRM_BASE_URL}/route/v1/{OSRM_PROFILE}/{coord_str}"
-    params = {"overview": "full", "geometries": "geojson", "steps": "false"}
-
     try:
-        r = requests.get(url, params=params, timeout=OSRM_TIMEOUT, headers={"User-Agent": "smartbus-demo"})
-        j = r.json() if r.content else {}
-    except Exception as e:
-        return jsonify({"ok": False, "error": "Gọi OSRM thất bại", "detail": str(e)}), 502
-
-    if r.status_code != 200 or j.get("code") != "Ok" or not j.get("routes"):
-        return jsonify({"ok": False, "error": "OSRM không trả route", "raw": j}), 502
+        route = osrm_route_chunked(points, geometry=True, deadline_sec=OSRM_REQUEST_DEADLINE_SEC)
+    except OsrmError as e:
+        body = {"ok": False, "error": str(e)}
+        if e.raw is not None:
+            body["raw"] = e.raw
+        return jsonify(body), e.status
 
-    route = j["routes"][0]
     return jsonify({
         "ok": True,
-        "distance_m": route.get("distance"),
-        "duration_s": route.get("duration"),
-        "geometry": route.get("geometry"),
+        "distance_m": route["distance_m"],
+        "duration_s": route["duration_s"],
+        "geometry": route["geometry"],
     })
 
 
+@app.route("/api/routes/summary")
+def api_routes_summary():
+    """Tóm tắt (số trạm, độ phủ tọa độ, data_status) của mọi tuyến; ETag theo revision mạng."""
+    etag = f"summary-{network_revision()}"
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        items = build_all_route_summaries()
+        resp = jsonify({"ok": True, "count": len(items), "items": items})
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
 @app.route("/api/routes/<int:tuyen_id>/summary")
 def api_route_summary(tuyen_id):
-    tuyen = TuyenXe.query.get_or_404(tuyen_id)
-    return jsonify(build_route_summary(tuyen))
+    def build():
+        tuyen = TuyenXe.query.get_or_404(tuyen_id)
+        return jsonify(build_route_summary(tuyen))
+
+    return route_conditional_response(tuyen_id, "summary", build)
 
 @app.route("/api/routes/<int:tuyen_id>/endpoints")
 def api_route_endpoints(tuyen_id):
-    tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    return route_conditional_response(tuyen_id, "endpoints", lambda: _route_endpoints_response(tuyen_id))
+
+
+def pick_route_endpoints(stops, dir_):
+    """Bến đầu/cuối (có tọa độ) của 1 hướng; None nếu chưa đủ 2 trạm có tọa độ."""
+    pts = [s for s in stops if s.lat is not None and s.lng is not None]
+    pts.sort(key=lambda s: (s.thuTuTrenTuyen or 0, s.maTram or 0))
+    if len(pts) < 2:
+        return None
+    a, b = pts[0], pts[-1]
+    return {
+        "direction": dir_,
+        "start": {"lat": float(a.lat), "lng": float(a.lng), "name": a.tenTram, "order": a.thuTuTrenTuyen},
+        "end": {"lat": float(b.lat), "lng": float(b.lng), "name": b.tenTram, "order": b.thuTuTrenTuyen},
+    }
 
-    def pick_endpoints(dir_):
-        stops = _query_stops_by_direction(tuyen, dir_).all()
-        pts = [s for s in stops if s.lat is not None and s.lng is not None]
-        pts.sort(key=lambda s: (s.thuTuTrenTuyen or 0, s.maTram or 0))
-        if len(pts) < 2:
-            return None
-        a, b = pts[0], pts[-1]
-        return {
-            "direction": dir_,
-            "start": {"lat": float(a.lat), "lng": float(a.lng), "name": a.tenTram, "order": a.thuTuTrenTuyen},
-            "end": {"lat": float(b.lat), "lng": float(b.lng), "name": b.tenTram, "order": b.thuTuTrenTuyen},
-        }
 
-    data = pick_endpoints("DI") or pick_endpoints("VE")
+def _route_endpoints_response(tuyen_id):
+    tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    ctx = route_context(tuyen)
+    data = pick_route_endpoints(ctx.stops("DI"), "DI") or pick_route_endpoints(ctx.stops("VE"), "VE")
     if not data:
         return jsonify({"ok": False, "error": "Tuyến chưa đủ 2 trạm có tọa độ để vẽ tổng quan."})
 
@@ -1803,54 +4211,302 @@ def api_route_trips(tuyen_id):
         limit = 12
     limit = max(1, min(limit, 50))
 
-    now = datetime.now()
-    ensure_upcoming_trips(tuyen, now=now)
-    today = now.strftime("%Y-%m-%d")
-
     items = []
-    for t in (
-        ChuyenXe.query
-        .filter(ChuyenXe.tuyen_id == tuyen_id, ChuyenXe.ngayKhoiHanh == today)
-        .order_by(ChuyenXe.gioKhoiHanh.asc(), ChuyenXe.huong.asc(), ChuyenXe.maChuyen.asc())
+    for dep in upcoming_departures(tuyen, now=datetime.now(), limit=limit):
+        items.append({
+            "trip_id": dep["trip_id"],
+            "date": dep["date"],
+            "time": dep["time"],
+            "direction": dep["direction"],
+            "dt": dep["dt"].isoformat(),
+            "detail_url": departure_detail_url(dep),
+        })
+
+    return jsonify({
+        "ok": True,
+        "route_id": tuyen_id,
+        "count": len(items),
+        "items": items,
+    })
+
+
+ROUTE_BUNDLE_FIELDS = ("summary", "endpoints", "stops", "trips", "etas")
+ROUTE_BUNDLE_STATIC_FIELDS = {"summary", "endpoints", "stops"}
+
+
+def build_route_bundle(tuyen, fields, now=None, trips_limit=12):
+    """Gói dữ liệu 1 tuyến cho dashboard/trang tuyến, dựng từ RouteContext (1 lần đọc tuyến + trạm + offset)."""
+    now = now or datetime.now()
+    ctx = route_context(tuyen)
+    stops_by_dir = ctx.stops_by_dir
+
+    out = {"ok": True, "route_id": tuyen.maTuyen, "route_code": tuyen.maHienThi}
+    if "summary" in fields:
+        out["summary"] = build_route_summary(tuyen, stops_by_dir=stops_by_dir)
+    if "endpoints" in fields:
+        out["endpoints"] = (
+            pick_route_endpoints(stops_by_dir["DI"], "DI") or pick_route_endpoints(stops_by_dir["VE"], "VE")
+        )
+    if "stops" in fields:
+        out["stops"] = {d: build_stops_geo(stops_by_dir[d], route_code=tuyen.maHienThi) for d in ("DI", "VE")}
+    if "trips" in fields:
+        out["trips"] = [
+            {
+                "trip_id": dep["trip_id"],
+                "date": dep["date"],
+                "time": dep["time"],
+                "direction": dep["direction"],
+                "dt": dep["dt"].isoformat(),
+                "detail_url": departure_detail_url(dep),
+            }
+            for dep in upcoming_departures(tuyen, now=now, limit=trips_limit, ctx=ctx)
+        ]
+    if "etas" in fields:
+        out["etas"] = {}
+        for d in ("DI", "VE"):
+            if not stops_by_dir[d]:
+                out["etas"][d] = {"ok": False, "error": "Hướng này chưa có trạm.", "items": []}
+                continue
+            out["etas"][d] = compute_next_stop_etas(ctx, d, at=now)
+    return out
+
+
+@app.route("/api/routes/<int:tuyen_id>/bundle")
+def api_route_bundle(tuyen_id):
+    """
+    Gói dữ liệu tuyến trong 1 request: summary, endpoints, stops (DI+VE), trips (chuyến sắp tới), etas (DI+VE).
+    Query: fields=summary,trips,... (mặc định: tất cả), trips_limit (1-50), at (ISO, cho etas/trips).
+    Chỉ chọn phần tĩnh (summary/endpoints/stops) -> có ETag theo revision tuyến.
+    """
+    raw_fields = (request.args.get("fields") or "").replace(" ", "")
+    fields = {f for f in raw_fields.split(",") if f} if raw_fields else set(ROUTE_BUNDLE_FIELDS)
+    unknown = fields - set(ROUTE_BUNDLE_FIELDS)
+    if unknown:
+        return jsonify({"ok": False, "error": f"fields không hợp lệ: {', '.join(sorted(unknown))}"}), 400
+
+    trips_limit = max(1, min(request.args.get("trips_limit", default=12, type=int) or 12, 50))
+    at = None
+    at_raw = (request.args.get("at") or "").strip()
+    if at_raw:
+        try:
+            at = parse_local_iso(at_raw)
+        except ValueError:
+            return jsonify({"ok": False, "error": "at phải có dạng ISO (YYYY-MM-DDTHH:MM)."}), 400
+
+    def build():
+        tuyen = TuyenXe.query.get_or_404(tuyen_id)
+        return jsonify(build_route_bundle(tuyen, fields, now=at, trips_limit=trips_limit))
+
+    if fields <= ROUTE_BUNDLE_STATIC_FIELDS:
+        return route_conditional_response(tuyen_id, "bundle-" + "-".join(sorted(fields)), build)
+    return build()
+
+
+# ---- Tổng quan toàn mạng (1 tài liệu cho bản đồ mọi tuyến) ----
+# Hình dạng tuyến = dãy trạm có tọa độ đã giản lược (Douglas-Peucker), không gọi OSRM.
+# Tài liệu JSON được nén gzip sẵn, cache theo network_revision() -> chỉ dựng lại khi dữ liệu tuyến đổi.
+
+_NETWORK_OVERVIEW = {}
+_NETWORK_OVERVIEW_LOCK = threading.Lock()
+
+
+def simplify_polyline(points, tolerance_m):
+    """Douglas-Peucker trên [(lat, lng)] (chiếu phẳng cục bộ, đủ chính xác ở quy mô thành phố)."""
+    if len(points) <= 2:
+        return list(points)
+    lat0 = math.radians(sum(p[0] for p in points) / len(points))
+    kx = 111320.0 * math.cos(lat0)
+    ky = 110540.0
+    xy = [(p[1] * kx, p[0] * ky) for p in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        (x1, y1), (x2, y2) = xy[i], xy[j]
+        dx, dy = x2 - x1, y2 - y1
+        seg2 = dx * dx + dy * dy
+        best_k, best_d = None, tolerance_m
+        for k in range(i + 1, j):
+            px, py = xy[k]
+            if seg2 == 0:
+                d = math.hypot(px - x1, py - y1)
+            else:
+                t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / seg2))
+                d = math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+            if d > best_d:
+                best_k, best_d = k, d
+        if best_k is not None:
+            keep[best_k] = True
+            stack.append((i, best_k))
+            stack.append((best_k, j))
+    return [p for p, kept in zip(points, keep) if kept]
+
+
+def build_network_overview(revision):
+    routes = TuyenXe.query.order_by(TuyenXe.maTuyen.asc()).all()
+    rows = (
+        db.session.query(
+            TramDung.tuyen_id, TramDung.huongChuan, TramDung.tenTram, TramDung.lat, TramDung.lng,
+        )
+        .filter(TramDung.lat.isnot(None), TramDung.lng.isnot(None))
+        .order_by(TramDung.tuyen_id.asc(), TramDung.huongChuan.asc(),
+                  TramDung.thuTuTrenTuyen.asc(), TramDung.maTram.asc())
         .all()
-    ):
-        dt = None
+    )
+    by_route = {}
+    for tuyen_id, dir_, name, lat, lng in rows:
+        by_route.setdefault(tuyen_id, {}).setdefault(dir_ or "DI", []).append((float(lat), float(lng), name))
+
+    items = []
+    for tuyen in routes:
+        directions = {}
+        for dir_, pts in sorted(by_route.get(tuyen.maTuyen, {}).items()):
+            if len(pts) < 2:
+                continue
+            shape = simplify_polyline([(p[0], p[1]) for p in pts], NETWORK_SHAPE_TOLERANCE_M)
+            directions[dir_] = {
+                "shape": [[round(lat, 5), round(lng, 5)] for lat, lng in shape],
+                "start": {"lat": pts[0][0], "lng": pts[0][1], "name": pts[0][2]},
+                "end": {"lat": pts[-1][0], "lng": pts[-1][1], "name": pts[-1][2]},
+            }
+        items.append({
+            "route_id": tuyen.maTuyen,
+            "route_code": tuyen.maHienThi,
+            "route_name": tuyen.tenTuyen,
+            "directions": directions,
+        })
+
+    return {
+        "ok": True,
+        "revision": revision,
+        "generated_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "count": len(items),
+        "routes": items,
+    }
+
+
+def network_overview_document():
+    """(revision, gzip bytes) của tài liệu tổng quan; dựng lại khi network_revision() đổi."""
+    revision = network_revision()
+    cached = _NETWORK_OVERVIEW.get("doc")
+    if cached and cached[0] == revision:
+        return cached
+    with _NETWORK_OVERVIEW_LOCK:
+        cached = _NETWORK_OVERVIEW.get("doc")
+        if cached and cached[0] == revision:
+            return cached
+        raw = json.dumps(build_network_overview(revision), ensure_ascii=False, separators=(",", ":"))
+        cached = (revision, gzip.compress(raw.encode("utf-8"), compresslevel=9, mtime=0))
+        _NETWORK_OVERVIEW["doc"] = cached
+        return cached
+
+
+@app.route("/api/network/overview")
+def api_network_overview():
+    """Mọi tuyến: hình dạng giản lược + bến đầu/cuối mỗi hướng, trong 1 tài liệu nén (ETag theo revision mạng)."""
+    revision, gz = network_overview_document()
+    etag = f"net-{revision}"
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    elif request.accept_encodings["gzip"]:
+        resp = app.response_class(gz, mimetype="application/json")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = app.response_class(gzip.decompress(gz), mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+
+@app.route("/api/departures")
+def api_departures():
+    """
+    Lịch xuất bến phân trang theo con trỏ (keyset), lọc theo tuyến (+ hướng) hoặc theo trạm.
+    Query: route_id | stop_id, dir (DI/VE), date (YYYY-MM-DD, mặc định hôm nay), limit, cursor.
+    Trang đầu của hôm nay bắt đầu từ bây giờ; trang sau dùng `next_cursor` của trang trước.
+    """
+    stop = None
+    offset_s = 0.0
+    stop_id = request.args.get("stop_id", type=int)
+    route_id = request.args.get("route_id", type=int)
+
+    if stop_id:
+        stop = TramDung.query.get_or_404(stop_id)
+        tuyen = stop.tuyen
+        dirs = (normalize_direction(stop.huong),)
+        offsets_data = route_context(tuyen).offsets(dirs[0])
+        if offsets_data.get("ok"):
+            offset_s = float(offsets_data.get("offsets", {}).get(stop.maTram) or 0.0)
+    elif route_id:
+        tuyen = TuyenXe.query.get_or_404(route_id)
+        dir_raw = (request.args.get("dir") or "").strip()
+        dirs = (normalize_direction(dir_raw),) if dir_raw else ("DI", "VE")
+    else:
+        return jsonify({"ok": False, "error": "Cần route_id hoặc stop_id."}), 400
+
+    now = datetime.now()
+    date_raw = (request.args.get("date") or "").strip()
+    try:
+        day = datetime.strptime(date_raw, "%Y-%m-%d").date() if date_raw else now.date()
+    except ValueError:
+        return jsonify({"ok": False, "error": "date phải có dạng YYYY-MM-DD."}), 400
+
+    limit = request.args.get("limit", default=20, type=int) or 20
+    limit = max(1, min(limit, 200))
+
+    after = None
+    cursor = (request.args.get("cursor") or "").strip()
+    if cursor:
         try:
-            if t.ngayKhoiHanh and t.gioKhoiHanh:
-                dt = datetime.strptime(f"{t.ngayKhoiHanh} {t.gioKhoiHanh}", "%Y-%m-%d %H:%M")
-        except Exception:
-            dt = None
+            after = decode_departure_cursor(cursor)
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
 
-        is_past = bool(dt and dt < now)
-        if is_past:
-            continue
+    # hôm nay: bắt đầu từ chuyến còn chưa qua trạm (trạm giữa tuyến: lùi theo offset)
+    from_dt = (now - timedelta(seconds=offset_s)) if (day == now.date() and not after) else None
+    deps, next_key = departures_page(tuyen, day, dirs=dirs, after=after, from_dt=from_dt, limit=limit)
 
+    items = []
+    for dep in deps:
+        eta_dt = dep["dt"] + timedelta(seconds=offset_s)
         items.append({
-            "trip_id": t.maChuyen,
-            "date": t.ngayKhoiHanh,
-            "time": t.gioKhoiHanh,
-            "direction": normalize_direction(getattr(t, "huong", None)),
-            "dt": dt.isoformat() if dt else None,
-            "detail_url": url_for("trip_detail", trip_id=t.maChuyen),
+            "trip_id": dep["trip_id"],
+            "route_id": tuyen.maTuyen,
+            "date": dep["date"],
+            "time": dep["time"],
+            "direction": dep["direction"],
+            "dt": dep["dt"].isoformat(),
+            "eta_time": eta_dt.strftime("%H:%M"),
+            "eta_iso": eta_dt.isoformat(timespec="seconds"),
+            "detail_url": departure_detail_url(dep),
         })
 
-    items.sort(key=lambda x: (0 if x["dt"] else 1, x["dt"] or "9999", x["trip_id"]))
-    items = items[:limit]
-
     return jsonify({
         "ok": True,
-        "route_id": tuyen_id,
+        "route_id": tuyen.maTuyen,
+        "stop_id": stop.maTram if stop else None,
+        "date": day.isoformat(),
         "count": len(items),
         "items": items,
+        "next_cursor": encode_departure_cursor(next_key) if next_key else None,
     })
 
 
 @app.route("/api/routes/<int:tuyen_id>/stop_offsets")
 def api_route_stop_offsets(tuyen_id):
-    tuyen = TuyenXe.query.get_or_404(tuyen_id)
     dir_ = normalize_direction(request.args.get("dir") or "DI")
+    return route_conditional_response(
+        tuyen_id, f"stop_offsets-{dir_}", lambda: _route_stop_offsets_response(tuyen_id, dir_)
+    )
+
+
+def _route_stop_offsets_response(tuyen_id, dir_):
+    tuyen = TuyenXe.query.get_or_404(tuyen_id)
 
-    data = get_stop_offsets(tuyen, dir_)
+    data = route_context(tuyen).offsets(dir_)
     if not data.get("ok"):
         return jsonify({"ok": False, "error": data.get("error") or "Không tính được offset trạm."}), 400
 
@@ -1889,11 +4545,29 @@ def api_route_stop_etas(tuyen_id):
     at = None
     if at_raw:
         try:
-            at = datetime.fromisoformat(at_raw)
+            at = parse_local_iso(at_raw)
         except Exception:
             at = None
 
-    data = compute_next_stop_etas(tuyen, dir_, at=at)
+    n = request.args.get("n", default=1, type=int) or 1
+    data = compute_next_stop_etas(route_context(tuyen), dir_, at=at, n=n)
+    if not data.get("ok"):
+        return jsonify(data), 400
+    return jsonify(data)
+
+
+@app.route("/api/routes/<int:tuyen_id>/timetable")
+def api_route_timetable(tuyen_id):
+    """Bảng giờ in tại trạm (cả ngày) cho 1 hướng. Query: dir (DI/VE), date (YYYY-MM-DD, mặc định hôm nay)."""
+    tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    dir_ = normalize_direction(request.args.get("dir") or "DI")
+    date_raw = (request.args.get("date") or "").strip()
+    try:
+        day = datetime.strptime(date_raw, "%Y-%m-%d").date() if date_raw else datetime.now().date()
+    except ValueError:
+        return jsonify({"ok": False, "error": "date phải có dạng YYYY-MM-DD."}), 400
+
+    data = build_stop_timetable(route_context(tuyen), dir_, day)
     if not data.get("ok"):
         return jsonify(data), 400
     return jsonify(data)
@@ -1907,53 +4581,301 @@ def api_validate_card():
         return jsonify({"ok": False, "error": "Bạn không có quyền truy cập."}), 403
 
     data = request.get_json(silent=True) or {}
-    code = (data.get("code") or data.get("maSoThe") or "").strip().upper()
+    code = normalize_card_code(data.get("code") or data.get("maSoThe"))
     if not code:
         return jsonify({"ok": False, "error": "Thiếu mã thẻ (code)."}), 400
 
-    card = TheTu.query.filter(func.upper(TheTu.maSoThe) == code).first()
+    # Index trong bộ nhớ (không đọc bảng thẻ; chỉ đọc bộ đếm phiên bản tối đa 1 lần/CARD_INDEX_SYNC_SEC)
+    card = CARD_INDEX.get(code)
     if not card:
         return jsonify({"ok": False, "error": "Không tìm thấy thẻ."}), 404
 
-    today = datetime.utcnow().date()
+    valid, start_ord, end_ord = card_entry_verdict(card, datetime.utcnow().date())
+
+    return jsonify({
+        "ok": True,
+        "valid": bool(valid),
+        "status": card.status,
+        "paid": bool(card.paid),
+        "start": datetime.fromordinal(start_ord).date().isoformat(),
+        "end": datetime.fromordinal(end_ord).date().isoformat(),
+        "card_id": card.card_id,
+        "card_code": card.code,
+        "customer_id": card.customer_id,
+    })
+
+
+def _validator_authorized():
+    # Máy soát vé dùng header X-Validator-Key; admin đăng nhập cũng được phép
+    key = (request.headers.get("X-Validator-Key") or "").strip()
+    if VALIDATOR_API_KEY and hmac.compare_digest(key, VALIDATOR_API_KEY):
+        return True
+    user = current_user()
+    return bool(user and user.vai_tro == "ADMIN")
+
+
+def card_tap_verdict(entry, day):
+    """Kết luận cho 1 lượt quẹt: (valid, reason)."""
+    if entry is None:
+        return False, "NOT_FOUND"
+    valid, _, _ = card_entry_verdict(entry, day)
+    if valid:
+        return True, "OK"
+    if entry.status != "KICH_HOAT":
+        return False, "NOT_ACTIVE"
+    if not entry.paid:
+        return False, "UNPAID"
+    return False, "OUT_OF_PERIOD"
+
+
+def _parse_tap_time(raw, default):
+    if raw in (None, ""):
+        return default
+    if isinstance(raw, bool):
+        raise TypeError("ts không được là true/false")  # bool là int trong Python -> không coi là epoch 0/1
+    if isinstance(raw, (int, float)):
+        return datetime.fromtimestamp(raw, timezone.utc).replace(tzinfo=None)  # epoch giây
+    dt = datetime.fromisoformat(str(raw).strip().replace("Z", "+00:00"))
+    # có múi giờ -> đổi về UTC (cùng quy ước ngày với soát thẻ đơn lẻ)
+    return (dt - dt.utcoffset()).replace(tzinfo=None) if dt.tzinfo else dt
+
+
+@app.route("/api/cards/validate/batch", methods=["POST"])
+def api_validate_cards_batch():
+    """
+    Soát thẻ hàng loạt cho máy soát vé mất mạng rồi đồng bộ lại.
+    Body: {"taps": [{"code": "...", "ts": "2024-05-01T07:30:00" | epoch, "route_id": 1}, ...]}
+    Trả về verdict theo đúng thứ tự đầu vào; tra cứu theo tập (index thẻ + 1 truy vấn tuyến).
+    """
+    if not _validator_authorized():
+        return jsonify({"ok": False, "error": "Bạn không có quyền truy cập."}), 403
 
-    def _parse_date(s):
+    data = request.get_json(silent=True) or {}
+    taps = data.get("taps")
+    if not isinstance(taps, list):
+        return jsonify({"ok": False, "error": "Thiếu danh sách lượt quẹt (taps)."}), 400
+    if len(taps) > CARD_BATCH_MAX_TAPS:
+        return jsonify({"ok": False, "error": f"Tối đa {CARD_BATCH_MAX_TAPS} lượt quẹt / request."}), 413
+
+    now = datetime.utcnow()
+    parsed = []
+    codes = set()
+    route_ids = set()
+    for tap in taps:
+        tap = tap if isinstance(tap, dict) else {}
+        code = normalize_card_code(tap.get("code") or tap.get("maSoThe"))
         try:
-            return datetime.strptime(str(s), "%Y-%m-%d").date()
-        except Exception:
-            return None
+            at = _parse_tap_time(tap.get("ts"), now)
+        except (ValueError, TypeError, OverflowError, OSError):
+            at = None
+        try:
+            route_id = int(tap["route_id"]) if tap.get("route_id") not in (None, "") else None
+        except (ValueError, TypeError):
+            route_id = -1
+        parsed.append((code, at, route_id))
+        if code:
+            codes.add(code)
+        if route_id is not None and route_id > 0:
+            route_ids.add(route_id)
+
+    entries = CARD_INDEX.get_many(codes)
+    known_routes = set()
+    if route_ids:
+        known_routes = {
+            r[0] for r in db.session.query(TuyenXe.maTuyen).filter(TuyenXe.maTuyen.in_(route_ids)).all()
+        }
+
+    results = []
+    counts = {"valid": 0, "invalid": 0}
+    for code, at, route_id in parsed:
+        entry = entries.get(code) if code else None
+        if not code:
+            valid, reason = False, "MISSING_CODE"
+        elif at is None:
+            valid, reason = False, "BAD_TIMESTAMP"
+        elif route_id is not None and route_id not in known_routes:
+            valid, reason = False, "UNKNOWN_ROUTE"
+        else:
+            valid, reason = card_tap_verdict(entry, at.date())
+        counts["valid" if valid else "invalid"] += 1
+        results.append({
+            "code": code or None,
+            "valid": valid,
+            "reason": reason,
+            "card_id": entry.card_id if entry else None,
+            "customer_id": entry.customer_id if entry else None,
+        })
 
-    start = _parse_date(card.ngayBatDau) or today
-    end = _parse_date(card.ngayHetHan) or today
+    return jsonify({"ok": True, "count": len(results), **counts, "results": results})
 
-    status = (card.trangThai or "").upper()
-    paid = (card.payment_status or "").upper() == "DA_THANH_TOAN"
-    active = status == "KICH_HOAT" and paid and (start <= today <= end)
 
+# ---- Snapshot thẻ cho máy soát vé offline ----
+# Bản ghi cố định: mã thẻ (ASCII, đệm \0 tới `width` byte) + ngày bắt đầu + ngày hết hạn
+# (uint16 big-endian, số ngày kể từ 1970-01-01), sắp xếp theo mã -> máy soát vé tìm nhị phân O(log n).
+# Chữ ký: HMAC-SHA256(key, header + data), hex; header snapshot "snapshot|<version>|<width>|<count>|",
+# header delta "delta|<since>|<version>|" (data = JSON gọn, sort_keys, của {"upserts", "removals"}).
+
+_EPOCH_ORD = datetime(1970, 1, 1).toordinal()
+_CARD_SNAPSHOT_CACHE = {}
+
+
+def _card_signing_key():
+    return (CARD_SNAPSHOT_KEY or app.config["SECRET_KEY"]).encode("utf-8")
+
+
+def _card_day_number(raw):
+    ord_ = _date_ordinal(raw)
+    return None if ord_ is None else ord_ - _EPOCH_ORD
+
+
+def _active_card_filter(q):
+    return q.filter(TheTu.trangThai == "KICH_HOAT", TheTu.payment_status == "DA_THANH_TOAN")
+
+
+def _snapshot_record(code, start, end, today_day):
+    """(mã, ngày bắt đầu, ngày hết hạn) dạng số ngày; None nếu thẻ không đưa vào snapshot."""
+    code = normalize_card_code(code)
+    if not code or not code.isascii():
+        return None
+    start_day = _card_day_number(start)
+    end_day = _card_day_number(end)
+    # thiếu ngày -> coi như hôm nay (giống soát thẻ online)
+    start_day = today_day if start_day is None else start_day
+    end_day = today_day if end_day is None else end_day
+    if end_day < today_day:
+        return None  # đã hết hạn
+    return code, max(0, min(start_day, 0xFFFF)), max(0, min(end_day, 0xFFFF))
+
+
+def sign_card_payload(header, data):
+    return hmac.new(_card_signing_key(), header.encode("ascii") + data, hashlib.sha256).hexdigest()
+
+
+def current_card_version():
+    # Đọc bộ đếm (đã commit): mọi thay đổi có version <= giá trị này đều đã commit và nhìn thấy được
+    value = db.session.execute(text("SELECT value FROM card_version_counter WHERE id = 1")).scalar()
+    return value if value is not None else _max_card_version(db.session)
+
+
+def build_card_snapshot():
+    """Snapshot thẻ đang KICH_HOAT + đã thanh toán, chưa hết hạn. Cache theo (version, ngày)."""
+    version = current_card_version()
+    today_day = datetime.utcnow().date().toordinal() - _EPOCH_ORD
+    cache_key = (version, today_day)
+    cached = _CARD_SNAPSHOT_CACHE.get("snapshot")
+    if cached and cached["key"] == cache_key:
+        return cached["value"]
+
+    rows = _active_card_filter(
+        db.session.query(TheTu.maSoThe, TheTu.ngayBatDau, TheTu.ngayHetHan)
+    ).all()
+    records = {}
+    for code, start, end in rows:
+        rec = _snapshot_record(code, start, end, today_day)
+        if rec:
+            records[rec[0]] = rec
+    ordered = [records[c] for c in sorted(records)]
+    width = max([13] + [len(r[0]) for r in ordered])
+    fmt = struct.Struct(f">{width}sHH")
+    data = b"".join(fmt.pack(code.encode("ascii"), start, end) for code, start, end in ordered)
+
+    value = {
+        "version": version,
+        "generated_day": today_day,
+        "day_epoch": "1970-01-01",
+        "count": len(ordered),
+        "width": width,
+        "record_size": fmt.size,
+        "data": base64.b64encode(data).decode("ascii"),
+        "signature": sign_card_payload(f"snapshot|{version}|{width}|{len(ordered)}|", data),
+    }
+    _CARD_SNAPSHOT_CACHE["snapshot"] = {"key": cache_key, "value": value}
+    return value
+
+
+@app.route("/api/cards/snapshot")
+def api_cards_snapshot():
+    if not _validator_authorized():
+        return jsonify({"ok": False, "error": "Bạn không có quyền truy cập."}), 403
+    return jsonify({"ok": True, **build_card_snapshot()})
+
+
+@app.route("/api/cards/delta")
+def api_cards_delta():
+    """
+    Thay đổi kể từ `since` (version của snapshot/delta trước):
+    - upserts: thẻ (đang) hợp lệ -> thêm/cập nhật trên máy soát vé
+    - removals: thẻ bị khóa/hủy/chưa thanh toán/đã xóa -> gỡ khỏi máy soát vé
+    """
+    if not _validator_authorized():
+        return jsonify({"ok": False, "error": "Bạn không có quyền truy cập."}), 403
+    try:
+        since = int(request.args.get("since", ""))
+    except ValueError:
+        return jsonify({"ok": False, "error": "Thiếu hoặc sai tham số since."}), 400
+
+    version = current_card_version()
+    today_day = datetime.utcnow().date().toordinal() - _EPOCH_ORD
+
+    upserts = {}
+    removals = set()
+    changed = (
+        db.session.query(
+            TheTu.maSoThe, TheTu.trangThai, TheTu.payment_status, TheTu.ngayBatDau, TheTu.ngayHetHan,
+        )
+        .filter(TheTu.phienBan > since, TheTu.phienBan <= version)
+        .all()
+    )
+    for code, status, pay, start, end in changed:
+        rec = None
+        if (status or "").upper() == "KICH_HOAT" and (pay or "").upper() == "DA_THANH_TOAN":
+            rec = _snapshot_record(code, start, end, today_day)
+        if rec:
+            upserts[rec[0]] = rec
+        elif normalize_card_code(code):
+            removals.add(normalize_card_code(code))
+
+    deleted = (
+        db.session.query(TheTuDaXoa.maSoThe)
+        .filter(TheTuDaXoa.phienBan > since, TheTuDaXoa.phienBan <= version)
+        .all()
+    )
+    for (code,) in deleted:
+        code = normalize_card_code(code)
+        if code and code not in upserts:
+            removals.add(code)
+    removals -= set(upserts)
+
+    items = [{"code": c, "start_day": upserts[c][1], "end_day": upserts[c][2]} for c in sorted(upserts)]
+    removed = sorted(removals)
+    body = json.dumps({"upserts": items, "removals": removed}, separators=(",", ":"), sort_keys=True)
     return jsonify({
         "ok": True,
-        "valid": bool(active),
-        "status": status,
-        "paid": bool(paid),
-        "start": start.isoformat() if start else None,
-        "end": end.isoformat() if end else None,
-        "card_id": card.maThe,
-        "card_code": card.maSoThe,
-        "customer_id": card.khach_hang_id,
+        "since": since,
+        "version": version,
+        "upserts": items,
+        "removals": removed,
+        "signature": sign_card_payload(f"delta|{since}|{version}|", body.encode("utf-8")),
     })
 
 
 @app.route("/api/routes/<int:tuyen_id>/stops_geo")
 def api_route_stops_geo(tuyen_id):
-    tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    dir_ = normalize_direction(request.args.get("dir") or "DI")
+
+    def build():
+        tuyen = TuyenXe.query.get_or_404(tuyen_id)
+        stops = route_context(tuyen).stops(dir_)
+        return jsonify(build_stops_geo(stops, route_code=tuyen.maHienThi))
+
+    return route_conditional_response(tuyen_id, f"stops_geo-{dir_}", build)
 
-    dir_ = (request.args.get("dir") or "DI").strip().upper()
-    stops = _query_stops_by_direction(tuyen, dir_).all()
 
-    return jsonify(build_stops_geo(stops, route_code=tuyen.maHienThi))
 # ==================== MAIN ====================
 
 if __name__ == "__main__":
     # Dev server (đừng dùng cho production). Khi deploy hãy dùng gunicorn/WSGI.
     debug = os.getenv("FLASK_DEBUG", "1").strip() == "1"
+    with app.app_context():
+        bootstrap_db()  # local: tự tạo/nâng cấp DB SQLite cho tiện
     app.run(debug=debug)
@@ -1,5 +1,7 @@
 #!/bin/bash
-# 1. Tạo database và 3 tuyến xe mẫu
+# 1. Tạo/nâng cấp schema DB (1 lần, không chạy lại trong từng worker) và 3 tuyến xe mẫu
+flask --app app bootstrap
+flask --app app build-assets
 python create_my_routes.py
 # ... các lệnh khác
 python create_admin.py
@@ -11,4 +13,4 @@ python scripts/seed_stops_from_csv.py --csv data/stops_tuyen_03.csv --route-code
 python scripts/seed_stops_from_csv.py --csv data/stops_tuyen_04.csv --route-code 04
 
 # 3. Chạy web server
-gunicorn app:app
+gunicorn wsgi:app --worker-class gthread --threads 50
@@ -248,6 +248,12 @@ def main():
                     db.session.add(stop)
                     inserted += 1
 
+            db.session.flush()
+            # Trạm của tuyến đã đổi -> tính lại offset lưu sẵn (bảng stop_offset).
+            # Script thoát ngay -> không mở worker OSRM nền; request đọc đầu tiên ở web worker sẽ xếp hàng.
+            from app import bump_route_revision, rebuild_stop_offsets  # type: ignore
+            rebuild_stop_offsets(tuyen, commit=False, schedule_osrm=False)
+            bump_route_revision(tuyen_id)  # ETag API tuyến đổi theo
             db.session.commit()
         except Exception as e:
             db.session.rollback()
@@ -24,8 +24,60 @@ document.addEventListener("DOMContentLoaded", () => {
   const kpiStopsGeo = document.getElementById("kpiStopsGeo");
   const kpiDataStatus = document.getElementById("kpiDataStatus");
 
+  const ETA_REFRESH_MS = 60000;
+
   let currentDir = "DI";
+  let currentStops = null;
   let requestSeq = 0;
+  let stopsPromise = null; // trạm 2 hướng: tải 1 lần (ETag), đổi hướng không gọi lại API
+  let etasPromise = null; // ETA 2 hướng: server tính cả 2 -> đổi hướng dùng lại, chỉ làm mới theo timer
+
+  async function fetchBundle(fields) {
+    const res = await fetch(`/api/routes/${routeId}/bundle?fields=${fields}`);
+    const data = await res.json();
+    if (!res.ok || !data?.ok) throw new Error("API bundle lỗi");
+    return data;
+  }
+
+  function loadRouteStops() {
+    if (!stopsPromise) {
+      stopsPromise = fetchBundle("stops").catch((e) => {
+        stopsPromise = null; // lần sau thử lại
+        throw e;
+      });
+    }
+    return stopsPromise;
+  }
+
+  function loadRouteEtas() {
+    if (!etasPromise) {
+      etasPromise = fetchBundle("etas").catch((e) => {
+        etasPromise = null;
+        throw e;
+      });
+    }
+    return etasPromise;
+  }
+
+  // ETA dự kiến tại từng trạm (theo lịch + OSRM/fallback). Không block map; lỗi ETA bỏ qua.
+  async function applyEtas(stops, dir, seq) {
+    try {
+      const etaData = (await loadRouteEtas()).etas?.[dir];
+      if (seq !== requestSeq || !etaData?.ok || !Array.isArray(etaData.items)) return;
+      const etaMap = new Map(etaData.items.map((it) => [String(it.stop_id), it]));
+      stops.forEach((s) => {
+        const it = etaMap.get(String(s.id ?? s.stop_id ?? ""));
+        if (it) {
+          s.eta_time = it.eta_time;
+          const mins = typeof it.eta_in_min === "number" ? it.eta_in_min : null;
+          s.eta_in_min = mins != null ? Math.max(0, mins) : null;
+        }
+      });
+      renderStops(stops);
+    } catch (e) {
+      // ignore ETA errors; map/list vẫn hoạt động bình thường
+    }
+  }
 
   function setActiveDir(dir) {
     const isDi = dir === "DI";
@@ -119,6 +171,7 @@ document.addEventListener("DOMContentLoaded", () => {
     requestSeq += 1;
     const seq = requestSeq;
 
+    currentStops = null;
     setActiveDir(dir);
     showStatus("Đang tải dữ liệu trạm…", "info");
     setLoading(true);
@@ -126,12 +179,16 @@ document.addEventListener("DOMContentLoaded", () => {
     if (typeof window.renderRouteMap === "function") await window.renderRouteMap([], mapId);
 
     try {
-      const res = await fetch(`/api/routes/${routeId}/stops_geo?dir=${dir}`);
-      const data = await res.json();
+      let data = null;
+      try {
+        data = (await loadRouteStops()).stops?.[dir];
+      } catch (e) {
+        data = null;
+      }
 
       if (seq !== requestSeq) return; // có yêu cầu mới hơn
 
-      if (!res.ok || !Array.isArray(data)) {
+      if (!Array.isArray(data)) {
         showStatus("Không tải được trạm. Kiểm tra dữ liệu tuyến hoặc API.", "warning");
         await window.renderRouteMap([], mapId);
         setLoading(false);
@@ -147,25 +204,8 @@ document.addEventListener("DOMContentLoaded", () => {
 
       if (typeof window.renderRouteMap === "function") await window.renderRouteMap(stops, mapId);
 
-      // ETA dự kiến tại từng trạm (theo lịch + OSRM/fallback). Không block map.
-      try {
-        const etaRes = await fetch(`/api/routes/${routeId}/stop_etas?dir=${dir}`);
-        const etaData = await etaRes.json();
-        if (seq === requestSeq && etaRes.ok && etaData?.ok && Array.isArray(etaData.items)) {
-          const etaMap = new Map(etaData.items.map((it) => [String(it.stop_id), it]));
-          stops.forEach((s) => {
-            const it = etaMap.get(String(s.id ?? s.stop_id ?? ""));
-            if (it) {
-              s.eta_time = it.eta_time;
-              const mins = typeof it.eta_in_min === "number" ? it.eta_in_min : null;
-              s.eta_in_min = mins != null ? Math.max(0, mins) : null;
-            }
-          });
-          renderStops(stops);
-        }
-      } catch (e) {
-        // ignore ETA errors; map/list vẫn hoạt động bình thường
-      }
+      currentStops = stops;
+      await applyEtas(stops, dir, seq);
 
       if (!stops.length) {
         showStatus("Lượt này chưa có trạm hoặc đang trống dữ liệu.", "secondary");
@@ -186,5 +226,12 @@ document.addEventListener("DOMContentLoaded", () => {
   btnDi.addEventListener("click", () => loadStops("DI"));
   btnVe.addEventListener("click", () => loadStops("VE"));
 
+  // làm mới ETA (cả 2 hướng trong 1 lần gọi) theo chu kỳ; tab ẩn thì bỏ qua
+  setInterval(() => {
+    if (document.hidden || !currentStops) return;
+    etasPromise = null;
+    applyEtas(currentStops, currentDir, requestSeq);
+  }, ETA_REFRESH_MS);
+
   loadStops(currentDir);
 });
@@ -38,7 +38,6 @@ document.addEventListener("DOMContentLoaded", () => {
   }
 
   let requestSeq = 0;
-  let tripsSeq = 0;
 
   function escapeHtml(str) {
     return String(str ?? "")
@@ -215,27 +214,38 @@ document.addEventListener("DOMContentLoaded", () => {
     if (errorAlert) errorAlert.classList.add("d-none");
   }
 
-  async function loadSummary(routeId) {
+  // API bundle: tóm tắt (tĩnh, có ETag -> thường chỉ nhận 304 khi chọn lại tuyến) + chuyến sắp tới, gọi song song
+  async function loadRoute(routeId) {
     if (!routeId) {
       resetSummary();
       setDetailLink(null);
+      if (hasTripsPanel) resetTrips("Chưa tải dữ liệu.");
       return;
     }
 
     requestSeq += 1;
     const seq = requestSeq;
     showLoading();
+    if (hasTripsPanel) showTripsLoading();
 
     try {
-      const res = await fetch(`/api/routes/${routeId}/summary`);
-      const data = await res.json();
+      const getBundle = async (fields) => {
+        const res = await fetch(`/api/routes/${routeId}/bundle?fields=${fields}&trips_limit=12`);
+        const bundle = await res.json();
+        if (!res.ok || !bundle?.ok) throw new Error("API bundle lỗi");
+        return bundle;
+      };
+      const [summaryBundle, tripsBundle] = await Promise.all([
+        getBundle("summary"),
+        hasTripsPanel ? getBundle("trips") : null,
+      ]);
 
       if (seq !== requestSeq) return; // đã có yêu cầu mới hơn
 
-      if (!res.ok) throw new Error("API summary lỗi");
-
+      const data = summaryBundle.summary;
       renderSummary(data);
       setDetailLink(routeId);
+      if (hasTripsPanel) renderTrips(tripsBundle.trips || []);
 
        // cập nhật data-status cho filter chip
       const row = tbody.querySelector(`.route-row[data-route-id="${routeId}"]`);
@@ -248,31 +258,7 @@ document.addEventListener("DOMContentLoaded", () => {
       resetSummary();
       if (errorAlert) errorAlert.classList.remove("d-none");
       setDetailLink(routeId);
-    }
-  }
-
-  async function loadTrips(routeId) {
-    if (!routeId) {
-      resetTrips("Chưa tải dữ liệu.");
-      return;
-    }
-
-    tripsSeq += 1;
-    const seq = tripsSeq;
-    showTripsLoading();
-
-    try {
-      const res = await fetch(`/api/routes/${routeId}/trips?limit=12`);
-      const data = await res.json();
-
-      if (seq !== tripsSeq) return;
-      if (!res.ok || !data?.ok) throw new Error("API trips lỗi");
-
-      renderTrips(data.items || []);
-    } catch (e) {
-      if (seq !== tripsSeq) return;
-      console.error(e);
-      resetTrips("Không tải được chuyến.");
+      if (hasTripsPanel) resetTrips("Không tải được chuyến.");
     }
   }
 
@@ -291,8 +277,7 @@ document.addEventListener("DOMContentLoaded", () => {
     if (row) setInfoFromRow(row);
 
     highlight(routeId);
-    loadSummary(routeId);
-    if (hasTripsPanel) loadTrips(routeId);
+    loadRoute(routeId);
     if (window.SBRouteOverview && typeof window.SBRouteOverview.setRoute === "function") {
       window.SBRouteOverview.setRoute(routeId, "routes-overview-map");
     }
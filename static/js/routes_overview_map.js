@@ -1,6 +1,7 @@
 // static/js/routes_overview_map.js
 // Bản đồ tổng quan ở /routes:
-// vẽ tuyến đang chọn dựa trên 2 điểm đầu/cuối (OSRM nếu có, fallback đường thẳng).
+// vẽ tuyến đang chọn từ tài liệu tổng quan toàn mạng (/api/network/overview, tải 1 lần cho mọi tuyến):
+// hình dạng tuyến giản lược theo trạm + 2 điểm đầu/cuối.
 
 (function () {
   const DEFAULT_CENTER = [16.047079, 108.206230];
@@ -66,25 +67,24 @@
     el.textContent = msg;
   }
 
-  async function fetchEndpoints(routeId) {
-    const res = await fetch(`/api/routes/${routeId}/endpoints`);
-    const data = await res.json();
-    return { res, data };
-  }
-
-  async function fetchOsrmLine(a, b) {
-    const res = await fetch("/api/osrm/route", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ coords: [[a.lat, a.lng], [b.lat, b.lng]] }),
-    });
-    const data = await res.json();
-    return { res, data };
-  }
-
-  function geoJsonLineToLatLng(geometry) {
-    if (!geometry || geometry.type !== "LineString" || !Array.isArray(geometry.coordinates)) return [];
-    return geometry.coordinates.map((c) => [c[1], c[0]]);
+  let networkPromise = null;
+
+  // 1 request cho mọi tuyến; chọn tuyến khác không gọi thêm API/OSRM
+  function loadNetwork() {
+    if (!networkPromise) {
+      networkPromise = fetch("/api/network/overview")
+        .then((res) => res.json().then((data) => {
+          if (!res.ok || !data.ok) throw new Error("API overview lỗi");
+          const byId = {};
+          (data.routes || []).forEach((r) => { byId[String(r.route_id)] = r; });
+          return byId;
+        }))
+        .catch((e) => {
+          networkPromise = null; // cho phép thử lại lần chọn tuyến sau
+          throw e;
+        });
+    }
+    return networkPromise;
   }
 
   function drawStraight(a, b) {
@@ -158,30 +158,28 @@
     setStatus("Đang tải tuyến…", "info");
 
     try {
-      const { res: epRes, data: ep } = await fetchEndpoints(routeId);
+      const network = await loadNetwork();
       if (seq !== requestSeq) return;
 
-      if (!epRes.ok || !ep.ok) {
-        setStatus(ep?.error || "Không đủ dữ liệu để vẽ tuyến.", "warning");
+      const route = network[String(routeId)];
+      const dir = route && (route.directions.DI || route.directions.VE);
+      if (!dir) {
+        setStatus("Tuyến chưa đủ 2 trạm có tọa độ để vẽ tổng quan.", "warning");
         map.setView(DEFAULT_CENTER, DEFAULT_ZOOM);
         return;
       }
 
-      const a = ep.start;
-      const b = ep.end;
+      const a = dir.start;
+      const b = dir.end;
 
       addMarkers(a, b);
 
-      const { res: osrmRes, data: osrm } = await fetchOsrmLine(a, b);
-      if (seq !== requestSeq) return;
-
-      if (osrmRes.ok && osrm.ok && osrm.geometry) {
-        const line = geoJsonLineToLatLng(osrm.geometry);
-        routeLayer = L.polyline(line, { color: "#0d6efd", weight: 4, opacity: 0.9 }).addTo(map);
-        setStatus("Đang hiển thị đường đi giữa điểm đầu/cuối (OSRM).", "success");
+      if (Array.isArray(dir.shape) && dir.shape.length >= 2) {
+        routeLayer = L.polyline(dir.shape, { color: "#0d6efd", weight: 4, opacity: 0.9 }).addTo(map);
+        setStatus("Đang hiển thị hình dạng tuyến theo các trạm dừng.", "success");
       } else {
         routeLayer = drawStraight(a, b).addTo(map);
-        setStatus("Không lấy được OSRM, dùng đường thẳng để xem tổng quan.", "secondary");
+        setStatus("Chưa có hình dạng tuyến, dùng đường thẳng để xem tổng quan.", "secondary");
       }
 
       fitAll();
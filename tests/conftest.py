@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py nằm ở thư mục gốc repo (không phải package)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# DB SQLite tạm cho test; đặt env trước khi import app (cấu hình đọc lúc import)
+_DB_DIR = tempfile.mkdtemp(prefix="smartbus-test-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_DB_DIR, "test.db")
+os.environ.setdefault("OSRM_BACKGROUND_OFFSETS", "0")  # không gọi OSRM thật từ worker nền
+
+
+@pytest.fixture
+def db_app():
+    """App với schema mới tinh (create_all + migrations), cache cấp module đã xoá."""
+    import app as A
+
+    with A.app.app_context():
+        A.db.session.remove()
+        A.db.drop_all()
+        with A.db.engine.begin() as conn:
+            conn.exec_driver_sql("DROP TABLE IF EXISTS schema_migrations")
+        A.db.create_all()
+        A.run_migrations()
+
+        A._ROUTE_REVISIONS.clear()
+        A._ROUTE_REVISIONS_LOADED_AT = 0.0
+        A._PHYSICAL_STOPS.clear()
+        A._STOP_OFFSET_CACHE.clear()
+        A._CARD_SNAPSHOT_CACHE.clear()
+        A.CARD_INDEX.reset()
+        yield A.app
+        A.db.session.remove()
+
+
+@pytest.fixture
+def client(db_app):
+    return db_app.test_client()
+
+
+@pytest.fixture
+def make_route(db_app):
+    """Tạo tuyến + trạm DI (và VE nếu truyền), kèm offset fallback đã lưu."""
+    import app as A
+
+    def _make(code="01", window="06:00 - 08:00", headway=15, stops_di=3, stops_ve=0):
+        tuyen = A.TuyenXe(maHienThi=code, tenTuyen=f"Tuyến {code}", thoiGianHoatDong=window, tanSuatPhut=headway)
+        A.db.session.add(tuyen)
+        A.db.session.flush()
+        for dir_, n in (("DI", stops_di), ("VE", stops_ve)):
+            for k in range(n):
+                A.db.session.add(A.TramDung(
+                    tenTram=f"Trạm {code}-{dir_}-{k + 1}", thuTuTrenTuyen=k + 1,
+                    lat=16.05 + 0.005 * k, lng=108.20 + (0.01 if dir_ == "VE" else 0.0), huong=dir_, tuyen_id=tuyen.maTuyen,
+                ))
+        A.db.session.flush()
+        A.rebuild_stop_offsets(tuyen, commit=False, schedule_osrm=False)
+        A.db.session.commit()
+        return tuyen
+
+    return _make
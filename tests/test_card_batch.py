@@ -0,0 +1,30 @@
+"""Soát thẻ hàng loạt: verdict theo thứ tự đầu vào, timestamp epoch/ISO, từ chối ts kiểu bool."""
+from datetime import date, datetime, timedelta, timezone
+
+import app as A
+
+KEY = "test-validator-key"
+TODAY = date.today()
+
+
+def test_batch_verdicts_and_timestamps(client, monkeypatch):
+    monkeypatch.setattr(A, "VALIDATOR_API_KEY", KEY)
+    A.db.session.add(A.TheTu(
+        maSoThe="SB-BATCH", trangThai="KICH_HOAT", payment_status="DA_THANH_TOAN",
+        ngayBatDau=(TODAY - timedelta(days=1)).isoformat(), ngayHetHan=(TODAY + timedelta(days=5)).isoformat(),
+    ))
+    A.db.session.commit()
+    noon = datetime.combine(TODAY, datetime.min.time()).replace(hour=12, tzinfo=timezone.utc)
+
+    resp = client.post("/api/cards/validate/batch", headers={"X-Validator-Key": KEY}, json={"taps": [
+        {"code": "sb-batch", "ts": noon.timestamp()},
+        {"code": "SB-BATCH", "ts": noon.isoformat()},
+        {"code": "SB-BATCH", "ts": True},
+        {"code": "SB-BATCH", "ts": "hôm qua"},
+        {"code": "SB-BATCH", "ts": (noon + timedelta(days=30)).isoformat()},
+        {"code": 12345},
+        {"ts": 0},
+    ]})
+    assert resp.status_code == 200
+    reasons = [r["reason"] for r in resp.get_json()["results"]]
+    assert reasons == ["OK", "OK", "BAD_TIMESTAMP", "BAD_TIMESTAMP", "OUT_OF_PERIOD", "NOT_FOUND", "MISSING_CODE"]
@@ -0,0 +1,143 @@
+"""Index thẻ trong bộ nhớ: áp thay đổi cục bộ ngay, đồng bộ thay đổi của worker khác qua bộ đếm phiên bản."""
+import threading
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy.orm import Session
+
+import app as A
+
+TODAY = date.today()
+
+
+def _card(code, status="KICH_HOAT", paid=True):
+    return A.TheTu(
+        maSoThe=code,
+        loaiThe="THANG",
+        trangThai=status,
+        payment_status="DA_THANH_TOAN" if paid else "CHO_THANH_TOAN",
+        ngayBatDau=(TODAY - timedelta(days=1)).isoformat(),
+        ngayHetHan=(TODAY + timedelta(days=30)).isoformat(),
+    )
+
+
+@pytest.fixture
+def other_worker(db_app):
+    """Session riêng, không gắn listener after_commit của db.session (giống 1 worker gunicorn khác)."""
+    sess = Session(bind=A.db.engine)
+    yield sess
+    sess.close()
+
+
+def _valid(code):
+    entry = A.CARD_INDEX.get(code)
+    return entry is not None and A.card_entry_verdict(entry, TODAY)[0]
+
+
+def test_local_changes_apply_without_db_sync(db_app, monkeypatch):
+    monkeypatch.setattr(A.CARD_INDEX, "sync_sec", 3600)
+    A.db.session.add(_card("SB-LOCAL"))
+    A.db.session.commit()
+    assert _valid("sb-local")
+
+    card = A.TheTu.query.filter_by(maSoThe="SB-LOCAL").one()
+    card.trangThai = "KHOA"
+    A.db.session.commit()
+    assert A.CARD_INDEX.get("SB-LOCAL").status == "KHOA"
+    assert not _valid("SB-LOCAL")
+
+    A.db.session.delete(card)
+    A.db.session.commit()
+    assert A.CARD_INDEX.get("SB-LOCAL") is None
+
+
+def test_other_worker_lock_is_seen_on_next_sync(db_app, other_worker, monkeypatch):
+    monkeypatch.setattr(A.CARD_INDEX, "sync_sec", 0)
+    A.db.session.add(_card("SB-REMOTE"))
+    A.db.session.commit()
+    assert _valid("SB-REMOTE")
+
+    card = other_worker.query(A.TheTu).filter_by(maSoThe="SB-REMOTE").one()
+    card.trangThai = "KHOA"
+    other_worker.commit()
+
+    assert not _valid("SB-REMOTE")
+
+
+def test_sync_waits_for_interval(db_app, other_worker, monkeypatch):
+    monkeypatch.setattr(A.CARD_INDEX, "sync_sec", 3600)
+    A.db.session.add(_card("SB-WAIT"))
+    A.db.session.commit()
+    assert _valid("SB-WAIT")
+
+    card = other_worker.query(A.TheTu).filter_by(maSoThe="SB-WAIT").one()
+    card.trangThai = "KHOA"
+    other_worker.commit()
+    assert _valid("SB-WAIT")  # chưa tới lần đồng bộ
+
+    monkeypatch.setattr(A.CARD_INDEX, "_synced_at", 0.0)
+    assert not _valid("SB-WAIT")
+
+
+def test_other_worker_rename_and_delete(db_app, other_worker, monkeypatch):
+    monkeypatch.setattr(A.CARD_INDEX, "sync_sec", 0)
+    A.db.session.add_all([_card("SB-OLD"), _card("SB-GONE")])
+    A.db.session.commit()
+    assert _valid("SB-OLD") and _valid("SB-GONE")
+
+    other_worker.query(A.TheTu).filter_by(maSoThe="SB-OLD").one().maSoThe = "SB-NEW"
+    other_worker.delete(other_worker.query(A.TheTu).filter_by(maSoThe="SB-GONE").one())
+    other_worker.commit()
+
+    entries = A.CARD_INDEX.get_many(["SB-OLD", "SB-NEW", "SB-GONE"])
+    assert entries["SB-OLD"] is None
+    assert entries["SB-NEW"] is not None
+    assert entries["SB-GONE"] is None
+
+
+def test_stale_change_never_overwrites_newer_entry(db_app, monkeypatch):
+    monkeypatch.setattr(A.CARD_INDEX, "sync_sec", 3600)
+    A.db.session.add(_card("SB-RACE"))
+    A.db.session.commit()
+    fresh = A.CARD_INDEX.get("SB-RACE")
+
+    # bản đọc delta cũ hơn (đọc trước commit cục bộ, áp sau) không được đè trạng thái mới
+    stale = fresh._replace(status="KHOA", version=fresh.version - 1)
+    A.CARD_INDEX._commit_changes([(stale.version, stale, "SB-RACE")])
+    assert A.CARD_INDEX.get("SB-RACE") == fresh
+
+    A.CARD_INDEX._commit_changes([(fresh.version - 1, None, "SB-RACE")])
+    assert A.CARD_INDEX.get("SB-RACE") == fresh
+
+
+def test_concurrent_reads_during_updates(db_app, monkeypatch):
+    monkeypatch.setattr(A.CARD_INDEX, "sync_sec", 3600)
+    A.db.session.add_all([_card(f"SB-C{i}") for i in range(50)])
+    A.db.session.commit()
+    codes = [f"SB-C{i}" for i in range(50)]
+    A.CARD_INDEX.ensure_fresh()
+
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                entries = A.CARD_INDEX.get_many(codes)
+                assert all(e is not None for e in entries.values())
+        except Exception as e:  # pragma: no cover - chỉ để báo lỗi từ luồng phụ
+            errors.append(e)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    try:
+        for i, entry in enumerate(A.CARD_INDEX.get_many(codes).values()):
+            A.CARD_INDEX.apply([entry._replace(status="KHOA", version=entry.version + 1000 + i)], [])
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    assert errors == []
+    assert {e.status for e in A.CARD_INDEX.get_many(codes).values()} == {"KHOA"}
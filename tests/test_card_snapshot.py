@@ -0,0 +1,123 @@
+"""Bộ đếm phiên bản thẻ, snapshot nhị phân và delta có chữ ký HMAC cho máy soát vé offline."""
+import base64
+import hashlib
+import hmac
+import json
+import struct
+from datetime import date, timedelta
+
+import pytest
+
+import app as A
+
+TODAY = date.today()
+KEY = "test-validator-key"
+
+
+def _card(code, status="KICH_HOAT", paid=True, end_days=30):
+    return A.TheTu(
+        maSoThe=code,
+        loaiThe="THANG",
+        trangThai=status,
+        payment_status="DA_THANH_TOAN" if paid else "CHO_THANH_TOAN",
+        ngayBatDau=(TODAY - timedelta(days=1)).isoformat(),
+        ngayHetHan=(TODAY + timedelta(days=end_days)).isoformat(),
+    )
+
+
+@pytest.fixture
+def validator(client, monkeypatch):
+    monkeypatch.setattr(A, "VALIDATOR_API_KEY", KEY)
+    monkeypatch.setattr(A, "CARD_SNAPSHOT_KEY", "test-signing-key")
+
+    def get(url):
+        resp = client.get(url, headers={"X-Validator-Key": KEY})
+        assert resp.status_code == 200, resp.get_json()
+        return resp.get_json()
+
+    return get
+
+
+def _sign(header, data):
+    return hmac.new(b"test-signing-key", header.encode("ascii") + data, hashlib.sha256).hexdigest()
+
+
+def _decode_snapshot(snap):
+    data = base64.b64decode(snap["data"])
+    fmt = struct.Struct(f">{snap['width']}sHH")
+    assert fmt.size == snap["record_size"] and len(data) == fmt.size * snap["count"]
+    return data, [
+        (code.rstrip(b"\0").decode("ascii"), start, end) for code, start, end in fmt.iter_unpack(data)
+    ]
+
+
+def _delta_body(delta):
+    return json.dumps(
+        {"upserts": delta["upserts"], "removals": delta["removals"]}, separators=(",", ":"), sort_keys=True,
+    ).encode("utf-8")
+
+
+def test_version_counter_increments_once_per_change(db_app):
+    v0 = A.current_card_version()
+    card = _card("SB-V1")
+    A.db.session.add(card)
+    A.db.session.commit()
+    assert card.phienBan == A.current_card_version() == v0 + 1
+
+    card.trangThai = "KHOA"
+    A.db.session.commit()
+    assert card.phienBan == A.current_card_version() == v0 + 2
+
+    A.db.session.delete(card)
+    A.db.session.commit()
+    tomb = A.TheTuDaXoa.query.filter_by(maSoThe="SB-V1").one()
+    assert tomb.phienBan == A.current_card_version() == v0 + 3
+
+
+def test_snapshot_lists_only_usable_cards_sorted_and_signed(db_app, validator):
+    A.db.session.add_all([
+        _card("SB-B"), _card("sb-a"),
+        _card("SB-LOCKED", status="KHOA"),
+        _card("SB-UNPAID", paid=False),
+        _card("SB-EXPIRED", end_days=-2),
+    ])
+    A.db.session.commit()
+
+    snap = validator("/api/cards/snapshot")
+    data, records = _decode_snapshot(snap)
+    assert [r[0] for r in records] == ["SB-A", "SB-B"]
+    today_day = (TODAY - date(1970, 1, 1)).days
+    assert records[0][1:] == (today_day - 1, today_day + 30)
+    assert snap["version"] == A.current_card_version()
+
+    header = f"snapshot|{snap['version']}|{snap['width']}|{snap['count']}|"
+    assert snap["signature"] == _sign(header, data)
+    assert snap["signature"] != _sign(header, data[:-1] + b"\x01")
+
+
+def test_delta_since_snapshot_carries_changes_and_signature(db_app, validator):
+    A.db.session.add_all([_card("SB-KEEP"), _card("SB-LOCK"), _card("SB-DROP"), _card("SB-RENAME")])
+    A.db.session.commit()
+    since = validator("/api/cards/snapshot")["version"]
+
+    A.TheTu.query.filter_by(maSoThe="SB-LOCK").one().trangThai = "KHOA"
+    A.db.session.delete(A.TheTu.query.filter_by(maSoThe="SB-DROP").one())
+    A.TheTu.query.filter_by(maSoThe="SB-RENAME").one().maSoThe = "SB-RENAMED"
+    A.db.session.add(_card("SB-NEW"))
+    A.db.session.commit()
+
+    delta = validator(f"/api/cards/delta?since={since}")
+    assert delta["version"] == A.current_card_version() > since
+    assert [u["code"] for u in delta["upserts"]] == ["SB-NEW", "SB-RENAMED"]
+    assert delta["removals"] == ["SB-DROP", "SB-LOCK", "SB-RENAME"]
+    assert delta["signature"] == _sign(f"delta|{since}|{delta['version']}|", _delta_body(delta))
+
+    empty = validator(f"/api/cards/delta?since={delta['version']}")
+    assert empty["upserts"] == [] and empty["removals"] == []
+
+
+def test_snapshot_and_delta_require_validator_key(client, monkeypatch):
+    monkeypatch.setattr(A, "VALIDATOR_API_KEY", KEY)
+    assert client.get("/api/cards/snapshot").status_code == 403
+    assert client.get("/api/cards/delta?since=0", headers={"X-Validator-Key": "wrong"}).status_code == 403
+    assert client.get("/api/cards/delta", headers={"X-Validator-Key": KEY}).status_code == 400
@@ -0,0 +1,67 @@
+"""Phân trang keyset /api/departures: đi hết các trang bằng next_cursor phải ra đúng lịch cả ngày."""
+from datetime import date, timedelta
+
+import pytest
+
+import app as A
+
+DAY = date.today() + timedelta(days=1)  # ngày mai: trang đầu không bị cắt theo giờ hiện tại
+
+
+@pytest.fixture
+def route_with_exceptions(make_route):
+    tuyen = make_route(window="06:00 - 08:00", headway=15, stops_di=3, stops_ve=3)
+    ngay = DAY.isoformat()
+    A.db.session.add_all([
+        A.ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, gioKhoiHanh="06:07", huong="DI", loaiChuyen="THEM"),
+        A.ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, gioKhoiHanh="06:07", huong="VE", loaiChuyen="THEM"),
+        A.ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, gioKhoiHanh="06:30", huong="DI", loaiChuyen="THUONG"),
+        A.ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, gioKhoiHanh="06:45", gioGoc="06:45",
+                   huong="VE", loaiChuyen="HUY"),
+    ])
+    A.db.session.commit()
+    return tuyen
+
+
+def _walk(client, url, limit):
+    items, cursor, pages = [], None, 0
+    while True:
+        page = client.get(url + f"&limit={limit}" + (f"&cursor={cursor}" if cursor else "")).get_json()
+        assert page["ok"]
+        assert page["count"] <= limit
+        items += page["items"]
+        pages += 1
+        cursor = page["next_cursor"]
+        if not cursor:
+            return items, pages
+        assert page["count"] == limit
+
+
+@pytest.mark.parametrize("limit", [1, 2, 5, 200])
+def test_cursor_walk_matches_full_timetable(client, route_with_exceptions, limit):
+    tuyen = route_with_exceptions
+    expected = A.timetable_departures(tuyen, DAY)
+    assert len(expected) == 9 * 2 + 2 - 1  # 9 chuyến/hướng + 2 chuyến thêm - 1 chuyến hủy
+
+    items, pages = _walk(client, f"/api/departures?route_id={tuyen.maTuyen}&date={DAY.isoformat()}", limit)
+
+    got = [(i["dt"], i["direction"], i["trip_id"]) for i in items]
+    assert got == [(d["dt"].isoformat(), d["direction"], d["trip_id"]) for d in expected]
+    assert len(set(got)) == len(got)
+    assert pages == max(1, -(-len(expected) // limit))
+
+
+def test_cursor_walk_by_direction(client, route_with_exceptions):
+    tuyen = route_with_exceptions
+    items, _ = _walk(client, f"/api/departures?route_id={tuyen.maTuyen}&date={DAY.isoformat()}&dir=VE", 3)
+    assert {i["direction"] for i in items} == {"VE"}
+    assert [i["time"] for i in items] == [d["time"] for d in A.timetable_departures(tuyen, DAY, dirs=("VE",))]
+    assert "06:45" not in [i["time"] for i in items]
+
+
+def test_cursor_round_trip_and_rejects_garbage(client, route_with_exceptions):
+    key = (A.datetime(2026, 5, 1, 6, 7), "VE", 12)
+    assert A.decode_departure_cursor(A.encode_departure_cursor(key)) == key
+
+    resp = client.get(f"/api/departures?route_id={route_with_exceptions.maTuyen}&cursor=not-a-cursor")
+    assert resp.status_code == 400
@@ -0,0 +1,22 @@
+"""Ma trận ETA (chuyến × trạm): đường numpy và đường Python thuần (môi trường thiếu numpy) cho cùng kết quả."""
+import numpy
+
+import app as A
+
+DEP_S = [6 * 3600 + 900 * i for i in range(12)]
+OFF_S = [0.0, 95.5, 240.0, 610.25, 1800.0]
+
+
+def test_numpy_is_used_when_installed():
+    assert A.np is numpy
+    assert isinstance(A.arrival_matrix(DEP_S, OFF_S), numpy.ndarray)
+
+
+def test_pure_python_fallback_matches_numpy(monkeypatch):
+    vec_matrix = A.arrival_matrix(DEP_S, OFF_S).tolist()
+    vec_next = [A.next_arrival_indices(DEP_S, OFF_S, at_s, 3) for at_s in (0, 6 * 3600 + 300, 8 * 3600 + 1, 24 * 3600)]
+
+    monkeypatch.setattr(A, "np", None)
+    assert A.arrival_matrix(DEP_S, OFF_S) == vec_matrix
+    assert [A.next_arrival_indices(DEP_S, OFF_S, at_s, 3) for at_s in (0, 6 * 3600 + 300, 8 * 3600 + 1, 24 * 3600)] == vec_next
+    assert vec_next[-1] == [[-1, -1, -1]] * len(OFF_S)
@@ -0,0 +1,29 @@
+"""Migration: unique index không tạo được thì migration lỗi, không ghi version, chạy lại được sau khi dọn dữ liệu."""
+import pytest
+
+import app as A
+
+
+def _applied():
+    with A.db.engine.connect() as conn:
+        return {r[0] for r in conn.exec_driver_sql("SELECT version FROM schema_migrations")}
+
+
+def test_duplicate_codes_keep_unique_migration_pending(db_app):
+    with A.db.engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX idx_card_code_unique")
+        conn.exec_driver_sql("DELETE FROM schema_migrations WHERE version = 3")
+        conn.exec_driver_sql("INSERT INTO the_tu (\"maSoThe\") VALUES ('SB-DUP'), ('SB-DUP')")
+
+    with pytest.raises(RuntimeError, match="unique index"):
+        A.run_migrations()
+    assert 3 not in _applied()
+    with pytest.raises(RuntimeError):
+        A.run_migrations()  # vẫn chờ, không bị ghi nhận im lặng
+
+    with A.db.engine.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM the_tu WHERE \"maThe\" = (SELECT MAX(\"maThe\") FROM the_tu)")
+    assert A.run_migrations() == [3]
+    with A.db.engine.connect() as conn:
+        names = {r[0] for r in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "idx_card_code_unique" in names
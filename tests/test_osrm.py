@@ -0,0 +1,96 @@
+"""Gọi OSRM: 429/timeout mở circuit breaker, chia cửa sổ dùng chung 1 thread pool."""
+import pytest
+import requests
+
+import app as A
+
+
+class _Resp:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+        self.content = b"{}"
+
+    def json(self):
+        return self._body
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    b = A._CircuitBreaker(max_failures=2, cooldown_s=60)
+    monkeypatch.setattr(A, "_OSRM_BREAKER", b)
+    return b
+
+
+@pytest.mark.parametrize("failure", [
+    lambda *a, **k: _Resp(429, {"message": "Too Many Requests"}),
+    lambda *a, **k: _Resp(503, {}),
+    lambda *a, **k: (_ for _ in ()).throw(requests.ReadTimeout("read timed out")),
+])
+def test_rate_limit_and_timeouts_open_the_breaker(monkeypatch, breaker, failure):
+    monkeypatch.setattr(A, "_osrm_get", failure)
+    for _ in range(2):
+        with pytest.raises(A.OsrmError):
+            A._osrm_request_route([(108.2, 16.0), (108.3, 16.1)], {})
+    assert breaker.is_open
+    with pytest.raises(A.OsrmError) as exc:
+        A._osrm_request_route([(108.2, 16.0), (108.3, 16.1)], {})
+    assert exc.value.status == 503
+
+
+def test_client_error_does_not_open_the_breaker(monkeypatch, breaker):
+    monkeypatch.setattr(A, "_osrm_get", lambda *a, **k: _Resp(400, {"code": "InvalidQuery"}))
+    for _ in range(3):
+        with pytest.raises(A.OsrmError):
+            A._osrm_request_route([(108.2, 16.0), (108.3, 16.1)], {})
+    assert not breaker.is_open
+
+
+def test_chunked_route_stitches_windows_on_shared_pool(monkeypatch, breaker):
+    def fake_get(url, params=None, deadline_sec=None):
+        n = url.rsplit("/", 1)[1].count(";") + 1
+        return _Resp(200, {"code": "Ok", "routes": [
+            {"distance": 10.0 * (n - 1), "duration": 1.0 * (n - 1), "legs": [{"distance": 10.0, "duration": 1.0}] * (n - 1)}
+        ]})
+
+    monkeypatch.setattr(A, "_osrm_get", fake_get)
+    monkeypatch.setattr(A, "OSRM_MAX_COORDS", 4)
+    points = [(108.2 + 0.001 * i, 16.0) for i in range(10)]
+
+    first = A.osrm_route_chunked(points, deadline_sec=5)
+    pool = A._osrm_chunk_pool()
+    second = A.osrm_route_chunked(points)
+
+    assert first == second
+    assert len(first["legs"]) == len(points) - 1
+    assert first["distance_m"] == 10.0 * (len(points) - 1)
+    assert A._osrm_chunk_pool() is pool
+
+
+def test_half_open_lets_a_single_probe_through():
+    b = A._CircuitBreaker(max_failures=1, cooldown_s=60)
+    b.record_failure()
+    assert not b.allow()
+
+    b._opened_at -= 61  # hết cooldown
+    assert b.allow()
+    assert not any(b.allow() for _ in range(5))  # lời gọi đồng thời khác chờ kết quả lần thử
+    b.record_failure()
+    assert b.is_open and not b.allow()  # thử lỗi -> mở lại cả cooldown
+
+    b._opened_at -= 61
+    assert b.allow()
+    b._probe_at -= 61  # lần thử không bao giờ báo kết quả -> cho thử lần mới
+    assert b.allow() and not b.allow()
+    b.record_success()
+    assert not b.is_open and b.allow() and b.allow()
+
+
+def test_client_error_ends_half_open_probe(monkeypatch, breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker._opened_at -= 61
+    monkeypatch.setattr(A, "_osrm_get", lambda *a, **k: _Resp(400, {"code": "InvalidQuery"}))
+    with pytest.raises(A.OsrmError):
+        A._osrm_request_route([(108.2, 16.0), (108.3, 16.1)], {})
+    assert not breaker.is_open
@@ -0,0 +1,37 @@
+"""Gom trạm vật lý: cùng chỗ / cùng tên gần nhau được gom, nhưng không nối chuỗi thành cụm dài."""
+import app as A
+
+M_LAT = 1 / 110540.0  # 1 mét theo vĩ độ
+
+
+def _row(stop_id, name, north_m, route_id=1, direction="DI"):
+    return (stop_id, name, 16.05 + north_m * M_LAT, 108.2, route_id, f"{route_id:02d}", direction)
+
+
+def _groups(rows):
+    clusters, _ = A.build_physical_stops(rows)
+    return sorted(sorted(c["stop_ids"]) for c in clusters.values())
+
+
+def test_same_spot_and_same_name_are_merged():
+    rows = [
+        _row(1, "Chợ Hàn", 0, route_id=1),
+        _row(2, "Cho Han", 60, route_id=2),      # cùng tên (không dấu), 60 m
+        _row(3, "Trạm khác", 10, route_id=3),    # khác tên nhưng cùng chỗ
+        _row(4, "Chợ Hàn", 500, route_id=4),     # cùng tên nhưng xa
+    ]
+    assert _groups(rows) == [[1, 2, 3], [4]]
+
+
+def test_chain_of_similar_names_does_not_snowball():
+    # 6 trạm "Nguyễn Văn Linh" cách nhau 60 m dọc 1 con đường: cặp kề nhau khớp, cả chuỗi dài 300 m
+    rows = [_row(i + 1, "Nguyễn Văn Linh", 60 * i, route_id=i + 1) for i in range(6)]
+    groups = _groups(rows)
+    assert sorted(s for g in groups for s in g) == [1, 2, 3, 4, 5, 6]
+
+    by_id = {r[0]: r for r in rows}
+    for g in groups:
+        for a in g:
+            for b in g:
+                assert A.haversine_m(by_id[a][2], by_id[a][3], by_id[b][2], by_id[b][3]) <= A.STOP_CLUSTER_RADIUS_M + 1e-6
+    assert len(groups) >= 3
@@ -0,0 +1,82 @@
+"""RAPTOR (raptor_rounds) đối chiếu với Connection Scan trên mạng tổng hợp ngẫu nhiên."""
+import math
+import random
+from types import SimpleNamespace
+
+import pytest
+
+import app as A
+
+
+def _random_network(rng, n_stops=40, n_patterns=10):
+    pattern_stops, pattern_offsets, deps = [], [], []
+    stop_patterns = [[] for _ in range(n_stops)]
+    for p in range(n_patterns):
+        seq = rng.sample(range(n_stops), rng.randint(3, 10))
+        offs, t = [], 0
+        for _ in seq:
+            offs.append(t)
+            t += rng.randint(60, 600)
+        first = rng.randint(5 * 3600, 7 * 3600)
+        headway = rng.choice([600, 900, 1200, 1800])
+        pattern_stops.append(seq)
+        pattern_offsets.append(offs)
+        deps.append(list(range(first, 21 * 3600, headway)))
+        for pos, i in enumerate(seq):
+            stop_patterns[i].append((p, pos))
+
+    transfers = [[] for _ in range(n_stops)]
+    for _ in range(n_stops):
+        i, j = rng.sample(range(n_stops), 2)
+        w = rng.randint(30, 400)
+        transfers[i].append((j, w))
+        transfers[j].append((i, w))
+
+    net = SimpleNamespace(
+        stop_ids=list(range(n_stops)),
+        pattern_stops=pattern_stops,
+        pattern_offsets=pattern_offsets,
+        stop_patterns=stop_patterns,
+        transfers=transfers,
+    )
+    return net, deps
+
+
+def _connection_scan(net, deps, src, t0):
+    """Tới sớm nhất bằng CSA: đi bộ chuyển tuyến chỉ sau khi xuống xe (giống RAPTOR, không nối 2 chặng đi bộ)."""
+    conns = []
+    for p, seq in enumerate(net.pattern_stops):
+        offs = net.pattern_offsets[p]
+        for t, dep in enumerate(deps[p]):
+            for k in range(len(seq) - 1):
+                conns.append((dep + offs[k], dep + offs[k + 1], seq[k], seq[k + 1], (p, t)))
+    conns.sort()
+
+    best = [math.inf] * len(net.stop_ids)
+    by_bus = [math.inf] * len(net.stop_ids)
+    best[src] = t0
+    boarded = set()
+    for dep, arr, a, b, trip in conns:
+        if trip in boarded or best[a] <= dep:
+            boarded.add(trip)
+            if arr < by_bus[b]:
+                by_bus[b] = arr
+                best[b] = min(best[b], arr)
+                for j, w in net.transfers[b]:
+                    best[j] = min(best[j], arr + w)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_raptor_matches_connection_scan(monkeypatch, seed):
+    monkeypatch.setattr(A, "PLANNER_MIN_TRANSFER_SEC", 0)  # CSA không có thời gian chuyển tuyến tối thiểu
+    rng = random.Random(seed)
+    net, deps = _random_network(rng)
+    n = len(net.stop_ids)
+    for _ in range(60):
+        src, dst = rng.sample(range(n), 2)
+        t0 = rng.randint(5 * 3600, 18 * 3600)
+        expected = _connection_scan(net, deps, src, t0)[dst]
+        rounds = A.raptor_rounds(net, deps, {src: t0}, {dst: 0}, n)
+        got = min((r[dst][0] for r in rounds if dst in r), default=math.inf)
+        assert got == expected, (seed, src, dst, t0)
@@ -0,0 +1,42 @@
+"""Trang/API công khai chỉ đọc DB: không sinh chuyến hay ghi offset trong GET."""
+from datetime import datetime
+
+from sqlalchemy import event
+
+import app as A
+
+
+def _capture_writes():
+    writes = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in ("INSERT", "UPDATE", "DELETE"):
+            writes.append(statement)
+
+    event.listen(A.db.engine, "before_cursor_execute", before_cursor_execute)
+    return writes, lambda: event.remove(A.db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_public_gets_issue_no_writes(client, make_route):
+    tuyen = make_route(window="00:00 - 23:59", headway=10, stops_di=3, stops_ve=2)
+    stop = A.TramDung.query.filter_by(tuyen_id=tuyen.maTuyen).first()
+    trips_before = A.ChuyenXe.query.count()
+
+    writes, stop_capture = _capture_writes()
+    try:
+        for url in (
+            f"/routes/{tuyen.maTuyen}",
+            f"/stops/{stop.maTram}",
+            f"/api/routes/{tuyen.maTuyen}/trips",
+            f"/api/routes/{tuyen.maTuyen}/stop_etas",
+            f"/api/departures?route_id={tuyen.maTuyen}",
+        ):
+            assert client.get(url).status_code == 200, url
+        trips = client.get(f"/api/routes/{tuyen.maTuyen}/trips").get_json()
+    finally:
+        stop_capture()
+
+    assert writes == []
+    if datetime.now().hour < 23:  # sát nửa đêm thì hết chuyến trong ngày
+        assert trips["count"] > 0  # chuyến tính từ lịch, không cần dòng ChuyenXe
+    assert A.ChuyenXe.query.count() == trips_before == 0
@@ -0,0 +1,73 @@
+"""GET có điều kiện trên API tuyến: ETag theo revision tuyến, 304 không dựng payload, admin sửa trạm -> ETag mới."""
+import pytest
+
+import app as A
+
+
+@pytest.fixture
+def admin_client(client):
+    admin = A.TaiKhoan(email="admin@test.local", mat_khau_hash="x", vai_tro="ADMIN")
+    A.db.session.add(admin)
+    A.db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = admin.id
+    return client
+
+
+def test_matching_etag_returns_304_without_building(client, make_route, monkeypatch):
+    tuyen = make_route()
+    url = f"/api/routes/{tuyen.maTuyen}/summary"
+
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "no-cache"
+
+    def boom(*args, **kwargs):
+        raise AssertionError("304 không được dựng lại payload")
+
+    monkeypatch.setattr(A, "build_route_summary", boom)
+    again = client.get(url, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.data == b""
+    assert again.headers["ETag"] == etag
+
+
+def test_etag_differs_per_variant_and_route(client, make_route):
+    r1, r2 = make_route("01"), make_route("02")
+    tags = {
+        client.get(url).headers["ETag"]
+        for url in (
+            f"/api/routes/{r1.maTuyen}/summary",
+            f"/api/routes/{r1.maTuyen}/stops_geo?dir=DI",
+            f"/api/routes/{r1.maTuyen}/stops_geo?dir=VE",
+            f"/api/routes/{r2.maTuyen}/summary",
+        )
+    }
+    assert len(tags) == 4
+
+
+def test_admin_stop_edit_bumps_revision(admin_client, make_route):
+    tuyen = make_route(stops_di=2)
+    url = f"/api/routes/{tuyen.maTuyen}/stops_geo?dir=DI"
+    rev_before = A.route_revision(tuyen.maTuyen)
+    first = admin_client.get(url)
+    etag = first.headers["ETag"]
+    assert len(first.get_json()) == 2
+
+    resp = admin_client.post(f"/admin/routes/{tuyen.maTuyen}/stops", data={
+        "tenTram": "Trạm mới", "diaChi": "", "thuTuTrenTuyen": "3", "lat": "16.07", "lng": "108.21", "huong": "DI",
+    })
+    assert resp.status_code == 302
+
+    assert A.route_revision(tuyen.maTuyen) == rev_before + 1
+    after = admin_client.get(url, headers={"If-None-Match": etag})
+    assert after.status_code == 200
+    assert after.headers["ETag"] != etag
+    assert [s["name"] for s in after.get_json()][-1] == "Trạm mới"
+
+    assert admin_client.get(url, headers={"If-None-Match": after.headers["ETag"]}).status_code == 304
+
+
+def test_unknown_route_is_404_not_304(client, db_app):
+    assert client.get("/api/routes/999/summary", headers={"If-None-Match": "*"}).status_code == 404
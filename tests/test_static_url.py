@@ -0,0 +1,47 @@
+"""static_url khi chưa build-assets: ?v=mtime, sửa file thì URL đổi (sau TTL, hoặc ngay ở chế độ debug)."""
+import os
+
+import pytest
+
+import app as A
+
+
+@pytest.fixture
+def static_file(tmp_path, monkeypatch):
+    (tmp_path / "static").mkdir()
+    path = tmp_path / "static" / "site.css"
+    path.write_text("body{}")
+    os.utime(path, (1_700_000_000, 1_700_000_000))
+    monkeypatch.setattr(A.app, "root_path", str(tmp_path))
+    monkeypatch.setattr(A, "_ASSET_MANIFEST", {})
+    monkeypatch.setattr(A, "_ASSET_MTIME_CACHE", {})
+    return path
+
+
+def _touch(path, ts):
+    os.utime(path, (ts, ts))
+
+
+def test_mtime_is_restatted_after_ttl(db_app, static_file, monkeypatch):
+    monkeypatch.setattr(A, "STATIC_MTIME_TTL_SEC", 60)
+    with db_app.test_request_context():
+        assert A.static_url("site.css").endswith("site.css?v=1700000000")
+        _touch(static_file, 1_700_000_100)
+        assert A.static_url("site.css").endswith("v=1700000000")  # còn trong TTL
+
+        monkeypatch.setattr(A, "STATIC_MTIME_TTL_SEC", 0)
+        assert A.static_url("site.css").endswith("v=1700000100")
+
+
+def test_debug_never_caches_mtime(db_app, static_file, monkeypatch):
+    monkeypatch.setattr(A, "STATIC_MTIME_TTL_SEC", 3600)
+    monkeypatch.setattr(A.app, "debug", True)
+    with db_app.test_request_context():
+        assert A.static_url("site.css").endswith("v=1700000000")
+        _touch(static_file, 1_700_000_200)
+        assert A.static_url("site.css").endswith("v=1700000200")
+
+
+def test_missing_file_has_no_version(db_app, static_file):
+    with db_app.test_request_context():
+        assert A.static_url("missing.js") == "/static/missing.js"
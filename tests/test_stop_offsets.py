@@ -0,0 +1,112 @@
+"""Offset trạm lưu sẵn (`stop_offset`): đọc bằng 1 truy vấn có index, rebuild giữ offset OSRM khi trạm không đổi."""
+import queue
+import time
+
+import pytest
+from sqlalchemy import event
+
+import app as A
+
+
+def test_read_path_joins_offsets_through_route_index(db_app, make_route):
+    tuyen = make_route(stops_di=3, stops_ve=2)
+    statements = []
+
+    def capture(conn, cursor, statement, params, context, executemany):
+        if "stop_offset" in statement:
+            statements.append((statement, params))
+
+    event.listen(A.db.engine, "before_cursor_execute", capture)
+    try:
+        stops_by_dir, offsets_by_dir = A.load_route_stops_with_offsets(tuyen)
+    finally:
+        event.remove(A.db.engine, "before_cursor_execute", capture)
+
+    assert [len(stops_by_dir[d]) for d in ("DI", "VE")] == [3, 2]
+    assert all(offsets_by_dir[d]["ok"] for d in ("DI", "VE"))
+    assert len(statements) == 1
+    statement, params = statements[0]
+    with A.db.engine.connect() as conn:
+        plan = " | ".join(str(r[-1]) for r in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, params))
+    assert "idx_stop_offset_route_dir_stop" in plan
+    assert "SCAN stop_offset" not in plan
+
+
+@pytest.fixture
+def admin_client(client):
+    admin = A.TaiKhoan(email="admin@test.local", mat_khau_hash="x", vai_tro="ADMIN")
+    A.db.session.add(admin)
+    A.db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = admin.id
+    return client
+
+
+@pytest.fixture
+def osrm_route(make_route, monkeypatch):
+    """Tuyến 2 hướng đã có offset OSRM do 1 worker khác tính (cache legs của process này rỗng)."""
+    tuyen = make_route(stops_di=3, stops_ve=3)
+    monkeypatch.setattr(A, "_fetch_osrm_legs", lambda coord_stops: [(60.0, 500.0)] * (len(coord_stops) - 1))
+    A.rebuild_stop_offsets(tuyen, allow_osrm=True)
+    A._STOP_OFFSET_CACHE.clear()
+    monkeypatch.setattr(A, "_fetch_osrm_legs", _no_osrm)
+    return tuyen
+
+
+def _no_osrm(coord_stops):
+    raise AssertionError("hướng không đổi không được gọi lại OSRM")
+
+
+def _sources(tuyen):
+    rows = A.StopOffset.query.filter_by(tuyen_id=tuyen.maTuyen).all()
+    return {d: {r.source for r in rows if r.huong == d} for d in ("DI", "VE")}
+
+
+def test_admin_stop_edit_rebuilds_only_that_direction(admin_client, osrm_route):
+    assert _sources(osrm_route) == {"DI": {"osrm"}, "VE": {"osrm"}}
+    stop = A.TramDung.query.filter_by(tuyen_id=osrm_route.maTuyen, huongChuan="DI").first()
+    resp = admin_client.post(f"/admin/routes/{osrm_route.maTuyen}/stops", data={
+        "maTram": stop.maTram, "tenTram": stop.tenTram, "diaChi": "", "thuTuTrenTuyen": "1",
+        "lat": "16.049", "lng": "108.2", "huong": "DI",
+    })
+    assert resp.status_code == 302
+    assert _sources(osrm_route) == {"DI": {"fallback"}, "VE": {"osrm"}}
+
+
+def test_rebuild_keeps_osrm_rows_while_stops_unchanged(osrm_route):
+    assert A.rebuild_stop_offsets(osrm_route) == 0
+    assert _sources(osrm_route) == {"DI": {"osrm"}, "VE": {"osrm"}}
+
+    A.TramDung.query.filter_by(tuyen_id=osrm_route.maTuyen, huongChuan="VE").first().lat = 16.2
+    A.db.session.flush()
+    assert A.rebuild_stop_offsets(osrm_route) == 3
+    assert _sources(osrm_route) == {"DI": {"osrm"}, "VE": {"fallback"}}
+
+
+@pytest.fixture
+def osrm_queue(monkeypatch):
+    """Bật worker nền nhưng không chạy thread thật: chỉ ghi lại tuyến được xếp hàng."""
+    q = queue.Queue()
+    monkeypatch.setattr(A, "OSRM_BACKGROUND_OFFSETS", True)
+    monkeypatch.setattr(A, "_OSRM_QUEUE", q)
+    monkeypatch.setattr(A, "_OSRM_WORKER", type("Alive", (), {"is_alive": lambda self: True})())
+    monkeypatch.setattr(A, "_OSRM_PENDING", set())
+    monkeypatch.setattr(A, "_OSRM_LAST_ATTEMPT", {})
+    return q
+
+
+def test_stop_change_retries_osrm_without_waiting_for_throttle(make_route, osrm_queue):
+    tuyen = make_route(stops_di=3)
+    A._OSRM_LAST_ATTEMPT[tuyen.maTuyen] = time.time()  # vừa thử (thất bại) gần đây
+    assert not A.schedule_osrm_offsets(tuyen.maTuyen)
+
+    A.TramDung.query.filter_by(tuyen_id=tuyen.maTuyen).first().lat = 16.2
+    A.db.session.flush()
+    A.rebuild_stop_offsets(tuyen, dirs=("DI",))
+    assert osrm_queue.get_nowait() == tuyen.maTuyen
+
+
+def test_cli_rebuild_does_not_start_background_worker(make_route, osrm_queue):
+    tuyen = make_route(stops_di=3)
+    A.rebuild_stop_offsets(tuyen, force=True, schedule_osrm=False)
+    assert osrm_queue.empty()
@@ -0,0 +1,122 @@
+"""Lịch tần suất + ngoại lệ THEM/HUY/DOI_GIO, và form admin chuẩn hoá ngày/giờ chuyến."""
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import app as A
+
+DAY = date.today() + timedelta(days=1)
+NGAY = DAY.isoformat()
+
+
+def _times(tuyen, dir_="DI"):
+    return [(d["time"], d["kind"]) for d in A.timetable_departures(tuyen, DAY, dirs=(dir_,))]
+
+
+def _add(tuyen, gio, kind, gio_goc=None, huong="DI", ngay=NGAY):
+    trip = A.ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay, gioKhoiHanh=gio, gioGoc=gio_goc,
+                      huong=huong, loaiChuyen=kind)
+    A.db.session.add(trip)
+    A.db.session.commit()
+    return trip
+
+
+@pytest.fixture
+def tuyen(make_route):
+    return make_route(window="06:00 - 07:00", headway=15, stops_di=3, stops_ve=2)
+
+
+@pytest.fixture
+def admin_client(client):
+    admin = A.TaiKhoan(email="admin@test.local", mat_khau_hash="x", vai_tro="ADMIN")
+    A.db.session.add(admin)
+    A.db.session.commit()
+    with client.session_transaction() as sess:
+        sess["user_id"] = admin.id
+    return client
+
+
+def test_regular_departures_need_no_rows(tuyen):
+    assert _times(tuyen) == [(t, "THUONG") for t in ("06:00", "06:15", "06:30", "06:45", "07:00")]
+    assert A.ChuyenXe.query.count() == 0
+
+
+def test_them_adds_and_huy_removes(tuyen):
+    _add(tuyen, "06:20", "THEM")
+    _add(tuyen, "06:15", "HUY", gio_goc="06:15")
+    assert _times(tuyen) == [
+        ("06:00", "THUONG"), ("06:20", "THEM"), ("06:30", "THUONG"), ("06:45", "THUONG"), ("07:00", "THUONG"),
+    ]
+    assert [t for t, _ in _times(tuyen, "VE")] == ["06:00", "06:15", "06:30", "06:45", "07:00"]
+
+
+def test_doi_gio_hides_only_original_slot(tuyen):
+    _add(tuyen, "06:35", "DOI_GIO", gio_goc="06:15")
+    assert _times(tuyen) == [
+        ("06:00", "THUONG"), ("06:30", "THUONG"), ("06:35", "DOI_GIO"), ("06:45", "THUONG"), ("07:00", "THUONG"),
+    ]
+
+
+def test_doi_gio_onto_another_regular_slot_keeps_that_departure(tuyen):
+    _add(tuyen, "06:45", "DOI_GIO", gio_goc="06:30")
+    assert _times(tuyen) == [
+        ("06:00", "THUONG"), ("06:15", "THUONG"), ("06:45", "THUONG"), ("06:45", "DOI_GIO"), ("07:00", "THUONG"),
+    ]
+
+
+def test_stored_regular_trip_replaces_computed_slot(tuyen):
+    trip = _add(tuyen, "06:30", "THUONG")
+    deps = A.timetable_departures(tuyen, DAY, dirs=("DI",))
+    at_630 = [d for d in deps if d["time"] == "06:30"]
+    assert len(at_630) == 1 and at_630[0]["trip_id"] == trip.maChuyen and not at_630[0]["virtual"]
+
+
+def test_admin_override_then_move_again_updates_same_row(admin_client, tuyen):
+    url = f"/admin/routes/{tuyen.maTuyen}/trips"
+    admin_client.post(url, data={"action": "override_trip", "ngayKhoiHanh": NGAY, "gioGoc": "6:15",
+                                 "gioKhoiHanh": "6:20", "huong": "DI"})
+    admin_client.post(url, data={"action": "override_trip", "ngayKhoiHanh": NGAY, "gioGoc": "06:15",
+                                 "gioKhoiHanh": "06:25", "huong": "DI"})
+    rows = A.ChuyenXe.query.all()
+    assert [(r.gioGoc, r.gioKhoiHanh, r.loaiChuyen) for r in rows] == [("06:15", "06:25", "DOI_GIO")]
+    assert ("06:15", "THUONG") not in _times(tuyen)
+
+
+@pytest.mark.parametrize("action", ["add_trip", "edit_trip"])
+def test_admin_add_and_edit_normalize_date_and_time(admin_client, tuyen, action):
+    url = f"/admin/routes/{tuyen.maTuyen}/trips"
+    data = {"action": action, "ngayKhoiHanh": f" {NGAY} ", "gioKhoiHanh": "6:50", "huong": "DI"}
+    if action == "edit_trip":
+        data["trip_id"] = _add(tuyen, "06:10", "THEM").maChuyen
+    admin_client.post(url, data=data)
+
+    trip = A.ChuyenXe.query.one()
+    assert (trip.ngayKhoiHanh, trip.gioKhoiHanh) == (NGAY, "06:50")
+    assert trip.departure_at == datetime.combine(DAY, datetime.min.time()) + timedelta(hours=6, minutes=50)
+    assert ("06:50", "THEM") in _times(tuyen)
+
+    # "06:50" trùng chuyến vừa lưu -> index unique bắt được (không còn "6:50" lẫn "06:50")
+    admin_client.post(url, data={"action": "add_trip", "ngayKhoiHanh": NGAY, "gioKhoiHanh": "06:50", "huong": "DI"})
+    assert A.ChuyenXe.query.count() == 1
+
+
+@pytest.mark.parametrize("ngay, gio", [("19/10/2026", "06:50"), (NGAY, "25:00"), ("", "06:50"), (NGAY, "")])
+def test_admin_add_rejects_bad_date_or_time(admin_client, tuyen, ngay, gio):
+    admin_client.post(f"/admin/routes/{tuyen.maTuyen}/trips",
+                      data={"action": "add_trip", "ngayKhoiHanh": ngay, "gioKhoiHanh": gio, "huong": "DI"})
+    assert A.ChuyenXe.query.count() == 0
+    with admin_client.session_transaction() as sess:
+        assert any("không hợp lệ" in msg for _, msg in sess.get("_flashes", []))
+
+
+def test_admin_retime_regular_trip_cancels_original_slot(admin_client, tuyen):
+    trip = _add(tuyen, "06:30", "THUONG")
+    admin_client.post(f"/admin/routes/{tuyen.maTuyen}/trips", data={
+        "action": "edit_trip", "trip_id": trip.maChuyen, "ngayKhoiHanh": NGAY, "gioKhoiHanh": "06:40", "huong": "DI",
+    })
+
+    assert _times(tuyen) == [
+        ("06:00", "THUONG"), ("06:15", "THUONG"), ("06:40", "THUONG"), ("06:45", "THUONG"), ("07:00", "THUONG"),
+    ]
+    rows = {(r.gioGoc, r.gioKhoiHanh, r.loaiChuyen) for r in A.ChuyenXe.query.all()}
+    assert rows == {(None, "06:40", "THUONG"), ("06:30", "06:30", "HUY")}
@@ -0,0 +1,68 @@
+"""departure_at: đồng bộ từ ngày/giờ chuỗi, backfill dòng cũ, và lọc/LIMIT trong SQL khớp lịch đầy đủ."""
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import app as A
+
+DAY = date.today() + timedelta(days=1)
+DAY_START = datetime.combine(DAY, datetime.min.time())
+
+
+def test_departure_at_follows_date_and_time(db_app, make_route):
+    tuyen = make_route()
+    trip = A.ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=DAY.isoformat(), gioKhoiHanh="06:20",
+                      huong="DI", loaiChuyen="THEM")
+    A.db.session.add(trip)
+    A.db.session.commit()
+    assert trip.departure_at == DAY_START + timedelta(hours=6, minutes=20)
+
+    trip.gioKhoiHanh = "07:05"
+    A.db.session.commit()
+    assert trip.departure_at == DAY_START + timedelta(hours=7, minutes=5)
+
+
+def test_backfill_fills_rows_written_before_the_column(db_app, make_route):
+    tuyen = make_route()
+    with A.db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            'INSERT INTO chuyen_xe (tuyen_id, "ngayKhoiHanh", "gioKhoiHanh", huong) VALUES (?, ?, ?, ?)',
+            (tuyen.maTuyen, DAY.isoformat(), "06:40", "DI"),
+        )
+        conn.exec_driver_sql(
+            'INSERT INTO chuyen_xe (tuyen_id, "ngayKhoiHanh", "gioKhoiHanh", huong) VALUES (?, ?, ?, ?)',
+            (tuyen.maTuyen, "sai-ngay", "06:40", "DI"),
+        )
+    assert A.backfill_trip_departure_at() == 1
+    rows = {r.ngayKhoiHanh: r.departure_at for r in A.ChuyenXe.query.all()}
+    assert rows == {DAY.isoformat(): DAY_START + timedelta(hours=6, minutes=40), "sai-ngay": None}
+
+
+@pytest.fixture
+def busy_route(make_route):
+    tuyen = make_route(window="06:00 - 09:00", headway=20, stops_di=3, stops_ve=3)
+    for ngay in (DAY - timedelta(days=1), DAY, DAY + timedelta(days=1)):
+        for gio in ("06:05", "06:10", "06:20", "07:35", "08:50"):
+            for huong in ("DI", "VE"):
+                A.db.session.add(A.ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=ngay.isoformat(),
+                                            gioKhoiHanh=gio, huong=huong, loaiChuyen="THEM"))
+    A.db.session.commit()
+    return tuyen
+
+
+@pytest.mark.parametrize("from_min", [0, 6 * 60, 6 * 60 + 7, 7 * 60 + 35, 8 * 60 + 55])
+@pytest.mark.parametrize("limit", [1, 3, 7, 50])
+def test_windowed_limit_matches_full_day(busy_route, from_min, limit):
+    full = A.timetable_departures(busy_route, DAY)
+    assert {d["date"] for d in full} == {DAY.isoformat()}  # hôm trước/hôm sau không lọt vào
+
+    lo = DAY_START + timedelta(minutes=from_min)
+    got = A.timetable_departures(busy_route, DAY, from_dt=lo, limit=limit)
+    assert got == [d for d in full if d["dt"] >= lo][:limit]
+
+
+def test_to_dt_bounds_listed_and_virtual(busy_route):
+    lo, hi = DAY_START + timedelta(hours=6, minutes=10), DAY_START + timedelta(hours=7)
+    got = A.timetable_departures(busy_route, DAY, from_dt=lo, to_dt=hi)
+    assert got and all(lo <= d["dt"] <= hi for d in got)
+    assert got == [d for d in A.timetable_departures(busy_route, DAY) if lo <= d["dt"] <= hi]
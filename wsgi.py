@@ -2,8 +2,8 @@
 WSGI entrypoint cho môi trường production.
 
 Ví dụ (Linux):
-  gunicorn wsgi:app
+  flask --app app bootstrap   # 1 lần khi deploy: tạo/nâng cấp schema
+  gunicorn wsgi:app --worker-class gthread --threads 50   # SSE giữ 1 luồng/kết nối
 """
 
 from app import app  # noqa: F401
-